@@ -1,7 +1,8 @@
 import json
 import random
-import csv
 import re
+import argparse
+from data_io import write_table
 
 # --- 1. 新的系统提示词 ---
 BASE_PROMPT = """你是一个强大的多模态AI助手。你的核心任务是理解并响应用户的需求。
@@ -274,9 +275,26 @@ TOOLS = {
 }
 
 
-def generate_data(num_samples):
+def _retrieved_tool_definition(retriever, user_question, required_tool, k):
+    """
+    与推理时一样，用检索器选出 top-k 候选工具 (加上它们的前置条件) 渲染进 prompt。
+    标签里的工具如果没被检索到，替换掉排名最靠后的候选，保证标签是可调用的。
+    插入位置随机，否则 "标签总在最后一个" 会成为模型能学到的捷径；它的前置条件也一并补上。
+    """
+    tool_names = retriever.top_k(user_question, k, with_prerequisites=False)
+    if required_tool not in tool_names:
+        tool_names = tool_names[:k - 1]
+        tool_names.insert(random.randint(0, len(tool_names)), required_tool)
+    return retriever.render(retriever.with_prerequisites(tool_names))
+
+
+def generate_data(num_samples, retrieval_top_k=None):
     data = []
     tool_names = list(TOOLS.keys())
+    retriever = None
+    if retrieval_top_k:
+        from tool_retrieval import ToolRetriever
+        retriever = ToolRetriever(TOOLS)
     for _ in range(num_samples):
         tool_name = random.choice(tool_names)
         tool_info = TOOLS[tool_name]
@@ -344,16 +362,24 @@ def generate_data(num_samples):
 
         if is_date_dependent and use_relative_date:
             # 场景1: 链式调用的第一步，模型应该去获取日期
+            if retriever is not None:
+                tool_definition = _retrieved_tool_definition(retriever, user_question, "get_current_date", retrieval_top_k)
+            else:
+                tool_definition = json.dumps(TOOLS["get_current_date"]["definition"], ensure_ascii=False, indent=2)
             input_prompt = BASE_PROMPT.format(
-                tool_definition=json.dumps(TOOLS["get_current_date"]["definition"], ensure_ascii=False, indent=2),
+                tool_definition=tool_definition,
                 user_question=user_question
             )
             output_obj = {
                 "tool_name": "get_current_date",
                 "arguments": {}
             }
+            # 标签只是链的第一步；完整的链 (相对日期原样保留) 供 rollout.py 给最终调用打分
+            chain = [output_obj, {"tool_name": tool_name, "arguments": args}]
         else:
             # 场景2: 普通的单步调用
+            if retriever is not None:
+                tool_definition_str = _retrieved_tool_definition(retriever, user_question, tool_name, retrieval_top_k)
             input_prompt = BASE_PROMPT.format(
                 tool_definition=tool_definition_str,
                 user_question=user_question
@@ -362,25 +388,28 @@ def generate_data(num_samples):
                 "tool_name": tool_name,
                 "arguments": args
             }
+            chain = [output_obj]
 
         output_str = "output：" + json.dumps(output_obj, ensure_ascii=False)
 
         data.append({
             "text": input_prompt,
-            "label": output_str
+            "label": output_str,
+            "chain": json.dumps(chain, ensure_ascii=False)
         })
 
     return data
 
 # --- Main execution ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate tool-calling fine-tuning data.")
+    parser.add_argument("--retrieval_top_k", type=int, default=None, help="Render the top-k retrieved tools (see tool_retrieval.py) instead of only the target tool.")
+    cli_args = parser.parse_args()
+
     NUM_SAMPLES = 1000
-    generated_data = generate_data(NUM_SAMPLES)
+    generated_data = generate_data(NUM_SAMPLES, retrieval_top_k=cli_args.retrieval_top_k)
 
-    file_path = "./data/finetuning_data.csv"
-    with open(file_path, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=["text", "label"])
-        writer.writeheader()
-        writer.writerows(generated_data)
+    file_path = "./data/finetuning_data.parquet"
+    write_table(generated_data, file_path)
 
     print(f"✅ 成功生成了 {NUM_SAMPLES} 条包含用户问题的微调数据，并已保存到文件：{file_path}")
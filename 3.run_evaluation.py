@@ -2,24 +2,32 @@ import os
 import re
 import json
 import argparse
-import pandas as pd
-import torch
 import sys
-from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import time
 
 # --- 路径配置 ---
 project_root = os.path.dirname(os.path.abspath(__file__))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
+from utils import load_script, extract_user_question, parse_size, EVAL_MAX_NEW_TOKENS
+
 BASE_MODEL_PATH = "./models/gemma-3-270m"
-PROMPT_VAL_CSV = "./data/test.csv"
+MERGED_MODEL_PATH = "./models/merged_gemma_lora"
+PROMPT_VAL_FILE = "./data/test.parquet"
 RESULTS_DIR = "./results/"
 
 # --- 全局变量 ---
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 RESULTS_FILE = os.path.join(RESULTS_DIR, "evaluation_results.json")
+QUANTIZED_RESULTS_FILE = os.path.join(RESULTS_DIR, "quantized_evaluation_results.json")
+EARLY_EXIT_RESULTS_FILE = os.path.join(RESULTS_DIR, "early_exit_results.json")
+ACCURACY_METRICS = [
+    "exact_match_rate",
+    "tool_name_accuracy",
+    "average_argument_precision",
+    "average_argument_recall",
+    "average_argument_f1",
+]
 
 # ---
 
@@ -59,11 +67,53 @@ def calculate_argument_f1(predicted_args, true_args):
     
     return precision, recall, f1
 
-def evaluate_model(model, tokenizer, val_file, num_samples=None):
+def score_prediction(prompt, true_json, generated_text):
     """
-    Evaluates the model on the validation set.
+    Parses the generated text and scores it against the ground truth; returns one detailed-results row.
     """
-    df = pd.read_csv(val_file)
+    predicted_json = extract_json_output(generated_text)
+
+    is_exact_match = False
+    is_tool_name_match = False
+    arg_precision, arg_recall, arg_f1 = 0, 0, 0
+
+    if predicted_json:
+        is_exact_match = predicted_json == true_json
+        is_tool_name_match = predicted_json.get("tool_name") == true_json.get("tool_name")
+        arg_precision, arg_recall, arg_f1 = calculate_argument_f1(
+            predicted_json.get("arguments", {}),
+            true_json.get("arguments", {})
+        )
+
+    return {
+        'prompt': prompt,
+        'ground_truth': true_json,
+        'generated_text': generated_text,
+        'predicted_json': predicted_json,
+        'exact_match': is_exact_match,
+        'tool_name_match': is_tool_name_match,
+        'arg_precision': arg_precision,
+        'arg_recall': arg_recall,
+        'arg_f1': arg_f1
+    }
+
+
+def evaluate_model(model, tokenizer, val_file, num_samples=None, decoding="greedy", detailed_results_file=None, lexical_router=None, batch_size=1,
+                   early_exit_decoder=None, pipelined=False, desc="Evaluating"):
+    """
+    Evaluates the model on the validation set. Prompts are generated `batch_size` at a time
+    (left-padded); prompt_lookup and early-exit decoding always run one prompt at a time.
+    With `pipelined`, tokenization and scoring run in thread pools alongside generation (see pipelined_eval.py).
+    Shared with 5.eval_lora.py, which passes its own `detailed_results_file` and `desc`.
+    """
+    # torch / pandas 等重依赖在用到时才导入，`--help` 和只用 extract_json_output 的工具不必付出启动开销
+    import pandas as pd
+    from tqdm import tqdm
+    from prompt_lookup import PromptLookupStats, generate_and_compare
+    from batch_planner import generate_batch
+    from data_io import read_table
+
+    df = read_table(val_file, columns=["text", "label"])
     if num_samples:
         df = df.head(num_samples)
     
@@ -73,18 +123,97 @@ def evaluate_model(model, tokenizer, val_file, num_samples=None):
     total_arg_precision = 0
     total_arg_recall = 0
     total_count = 0
+    total_generation_time = 0.0
     results_data = []
+    prompt_lookup_stats = PromptLookupStats()
+    fast_path_count = 0
 
     model.eval()
 
-    for i, row in tqdm(df.iterrows(), total=df.shape[0], desc="Evaluating"):
+    # 1. 解析标签，词法快速路径命中的直接给出答案，其余的排队等模型生成
+    rows = []
+    generated_texts = {}
+    pending = []
+    for i, row in df.iterrows():
         prompt = row["text"]
         true_label_str = row["label"]
-        
         try:
             true_json_str = true_label_str.split('：', 1)[1]
             true_json = json.loads(true_json_str)
         except (json.JSONDecodeError, IndexError):
+            true_json = None
+        rows.append((i, prompt, true_label_str, true_json))
+        if true_json is None:
+            continue
+
+        start = time.perf_counter()
+        fast_path_call = lexical_router.route(extract_user_question(prompt)) if lexical_router else None
+        if fast_path_call is not None:
+            # 词法快速路径命中，不调用模型
+            fast_path_count += 1
+            generated_texts[i] = "output：" + json.dumps(fast_path_call, ensure_ascii=False)
+            total_generation_time += time.perf_counter() - start
+        else:
+            pending.append((i, prompt))
+
+    # 2. 按 batch 生成
+    generate_kwargs = dict(
+        max_new_tokens=EVAL_MAX_NEW_TOKENS,
+        pad_token_id=tokenizer.eos_token_id,
+        do_sample=False,
+        top_p=None,
+        top_k=None
+    )
+    step = 1 if decoding == "prompt_lookup" or early_exit_decoder is not None else batch_size
+    if early_exit_decoder is not None:
+        from early_exit import stop_token_ids
+        early_exit_stop_ids = stop_token_ids(model, tokenizer)
+        early_exit_decoder.stats.reset()
+    scored = {}
+    pipeline_report = None
+    if pipelined:
+        from pipelined_eval import run_pipeline, print_stage_report
+
+        def generate_fn(inputs):
+            inputs = inputs.to(model.device)
+            if decoding == "prompt_lookup":
+                outputs = generate_and_compare(model, inputs, prompt_lookup_stats, **generate_kwargs)
+            elif early_exit_decoder is not None:
+                outputs = early_exit_decoder.generate(inputs["input_ids"], generate_kwargs["max_new_tokens"], early_exit_stop_ids)
+            else:
+                outputs = model.generate(**inputs, **generate_kwargs)
+            return outputs[:, inputs["input_ids"].shape[1]:].cpu()
+
+        # 解码、解析和逐行打分都在后处理线程池里完成
+        true_jsons = {i: true_json for i, _, _, true_json in rows}
+        prompts = dict(pending)
+        scored, pipeline_report = run_pipeline(
+            tokenizer, [pending[b:b + step] for b in range(0, len(pending), step)], generate_fn,
+            lambda i, text: score_prediction(prompts[i], true_jsons[i], text), desc=desc,
+        )
+        total_generation_time += pipeline_report["stages"]["generate"]["busy_s"]
+        print_stage_report(pipeline_report)
+    else:
+        for b in tqdm(range(0, len(pending), step), desc=desc):
+            batch = pending[b:b + step]
+            start = time.perf_counter()
+            if decoding == "prompt_lookup":
+                inputs = tokenizer(batch[0][1], return_tensors="pt", max_length=2048, truncation=True).to(model.device)
+                outputs = generate_and_compare(model, inputs, prompt_lookup_stats, **generate_kwargs)
+                texts = [tokenizer.decode(outputs[0][len(inputs["input_ids"][0]):], skip_special_tokens=True)]
+            elif early_exit_decoder is not None:
+                inputs = tokenizer(batch[0][1], return_tensors="pt", max_length=2048, truncation=True).to(model.device)
+                outputs = early_exit_decoder.generate(inputs["input_ids"], generate_kwargs["max_new_tokens"], early_exit_stop_ids)
+                texts = [tokenizer.decode(outputs[0][len(inputs["input_ids"][0]):], skip_special_tokens=True)]
+            else:
+                texts, _ = generate_batch(model, tokenizer, [prompt for _, prompt in batch], **generate_kwargs)
+            total_generation_time += time.perf_counter() - start
+            for (i, _), text in zip(batch, texts):
+                generated_texts[i] = text
+
+    # 3. 打分
+    for i, prompt, true_label_str, true_json in rows:
+        if true_json is None:
             results_data.append({
                 'prompt': prompt,
                 'ground_truth': true_label_str,
@@ -98,59 +227,18 @@ def evaluate_model(model, tokenizer, val_file, num_samples=None):
             })
             continue
 
-        inputs = tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=150,
-                pad_token_id=tokenizer.eos_token_id,
-                do_sample=False,
-                top_p=None,
-                top_k=None
-            )
-        
-        generated_text = tokenizer.decode(
-            outputs[0][len(inputs["input_ids"][0]):], skip_special_tokens=True
-        )
-        
-        predicted_json = extract_json_output(generated_text)
-
-        is_exact_match = False
-        is_tool_name_match = False
-        arg_precision, arg_recall, arg_f1 = 0, 0, 0
-
-        if predicted_json:
-            if predicted_json == true_json:
-                exact_match_count += 1
-                is_exact_match = True
-            
-            if predicted_json.get("tool_name") == true_json.get("tool_name"):
-                tool_name_match_count += 1
-                is_tool_name_match = True
-
-            arg_precision, arg_recall, arg_f1 = calculate_argument_f1(
-                predicted_json.get("arguments", {}),
-                true_json.get("arguments", {})
-            )
-            total_arg_precision += arg_precision
-            total_arg_recall += arg_recall
-            total_arg_f1 += arg_f1
-
+        result = scored[i] if i in scored else score_prediction(prompt, true_json, generated_texts[i])
+        exact_match_count += result['exact_match']
+        tool_name_match_count += result['tool_name_match']
+        total_arg_precision += result['arg_precision']
+        total_arg_recall += result['arg_recall']
+        total_arg_f1 += result['arg_f1']
         total_count += 1
-        results_data.append({
-            'prompt': prompt,
-            'ground_truth': true_json,
-            'generated_text': generated_text,
-            'predicted_json': predicted_json,
-            'exact_match': is_exact_match,
-            'tool_name_match': is_tool_name_match,
-            'arg_precision': arg_precision,
-            'arg_recall': arg_recall,
-            'arg_f1': arg_f1
-        })
+        results_data.append(result)
 
     results_df = pd.DataFrame(results_data)
-    detailed_results_file = os.path.join(RESULTS_DIR, "detailed_evaluation_results.csv")
+    if detailed_results_file is None:
+        detailed_results_file = os.path.join(RESULTS_DIR, "detailed_evaluation_results.csv")
     results_df.to_csv(detailed_results_file, index=False)
     print(f"\n✅ Detailed evaluation results saved to {detailed_results_file}")
 
@@ -167,34 +255,135 @@ def evaluate_model(model, tokenizer, val_file, num_samples=None):
         "average_argument_recall": avg_arg_recall,
         "average_argument_f1": avg_arg_f1,
         "total_samples": total_count,
+        "average_latency_ms": total_generation_time / total_count * 1000 if total_count > 0 else 0,
+        "batch_size": step,
     }
+    if decoding == "prompt_lookup":
+        summary["prompt_lookup"] = prompt_lookup_stats.summary()
+    if early_exit_decoder is not None:
+        summary["early_exit"] = early_exit_decoder.stats.summary()
+    if pipeline_report is not None:
+        summary["pipeline"] = pipeline_report
+    if lexical_router is not None:
+        summary["lexical_fast_path"] = {
+            "routed_samples": fast_path_count,
+            "coverage": fast_path_count / total_count if total_count > 0 else 0,
+        }
     
     return summary
 
 
+def compare_with_quantized(reference_summary, quantized_summary, reference_bytes, quantized_bytes):
+    """
+    Accuracy deltas (int8 - reference), latency and weight memory of the two runs.
+    """
+    return {
+        "reference": reference_summary,
+        "int8": quantized_summary,
+        "accuracy_deltas": {
+            metric: quantized_summary[metric] - reference_summary[metric] for metric in ACCURACY_METRICS
+        },
+        "latency_speedup": (
+            reference_summary["average_latency_ms"] / quantized_summary["average_latency_ms"]
+            if quantized_summary["average_latency_ms"] > 0 else 0
+        ),
+        "memory": {
+            "reference_weight_mib": reference_bytes / 1024 ** 2,
+            "int8_weight_mib": quantized_bytes / 1024 ** 2,
+            "ratio": quantized_bytes / reference_bytes if reference_bytes > 0 else 0,
+        },
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Evaluate a model for tool calling.")
     parser.add_argument("--num_samples", type=int, default=None, help="Number of samples to evaluate on. Defaults to all.")
+    parser.add_argument("--decoding", type=str, default="greedy", choices=["greedy", "prompt_lookup"], help="Decoding mode. prompt_lookup drafts tokens from the prompt and also times plain generate for comparison.")
+    parser.add_argument("--model_path", type=str, default=None, help="Model to evaluate. Defaults to the base model; with --quantized_model_path to the fp model it was quantized from (the reference), with --early_exit_heads to the model the heads were trained on.")
+    parser.add_argument("--fast_load", action="store_true", help="Load weights via memory-mapped safetensors without random init (see fast_load.py).")
+    parser.add_argument("--fast_load_snapshot", action="store_true", help="With --fast_load: cache a dtype-converted copy of the weights under ./cached/fast_load so later loads skip the conversion.")
+    parser.add_argument("--quantized_model_path", type=str, default=None, help="int8 artifact from 6.merge_base_lora.py --quantize int8. Both models are evaluated on CPU and compared.")
+    parser.add_argument("--lexical_fast_path", action="store_true", help="Answer confident argument-free tool calls with lexical_router.py and skip the model for them.")
+    parser.add_argument("--early_exit_heads", type=str, default=None, help="Exit heads from early_exit.py. Also evaluates early-exit decoding at each --exit_thresholds value against full depth.")
+    parser.add_argument("--exit_thresholds", type=float, nargs="+", default=[0.99, 0.95, 0.9, 0.8], help="Confidence thresholds for --early_exit_heads.")
+    parser.add_argument("--pipelined", action="store_true", help="Overlap tokenization, generation and scoring and report per-stage utilization (see pipelined_eval.py).")
+    parser.add_argument("--batch_size", type=int, default=1, help="Prompts generated together (left-padded). Ignored with prompt_lookup decoding.")
+    parser.add_argument("--auto_batch", action="store_true", help="Pick the batch size with the highest measured tokens/sec within the memory budget (see batch_planner.py).")
+    parser.add_argument("--memory_budget", type=str, default=None, help="Memory budget for --auto_batch, e.g. 8GB. Defaults to 90%% of GPU memory or RAM.")
     args = parser.parse_args()
 
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from quantization import load_quantized_model, model_memory_bytes, quantized_source_model
+    from prune_vocab import PrunedTokenizer, VOCAB_MAP_NAME
+    from fast_load import load_model_fast
+    from lexical_router import LexicalRouter
+    from batch_planner import plan_eval
+    from data_io import read_table
+
+    if args.quantized_model_path:
+        # 参照模型必须是被量化的那个 fp 模型，否则准确率差异和加速比比较的是两个不同的模型
+        source_model_path = quantized_source_model(args.quantized_model_path)
+        if args.model_path is None:
+            args.model_path = source_model_path or MERGED_MODEL_PATH
+            if source_model_path is None:
+                print(f"⚠️ 警告: {args.quantized_model_path} 没有记录量化前的模型，参照模型默认使用 {MERGED_MODEL_PATH}")
+        elif source_model_path and os.path.abspath(args.model_path) != os.path.abspath(source_model_path):
+            raise ValueError(f"--model_path {args.model_path} 不是量化前的模型 {source_model_path}，对比没有意义")
+    if args.model_path is None and args.early_exit_heads:
+        # exit head 只对训练它的模型有意义
+        from early_exit import exit_heads_source_model
+        args.model_path = exit_heads_source_model(args.early_exit_heads)
+    args.model_path = args.model_path or BASE_MODEL_PATH
+
     os.makedirs(RESULTS_DIR, exist_ok=True)
+    lexical_router = LexicalRouter(load_script("1.generate_data.py").TOOLS) if args.lexical_fast_path else None
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.quantized_model_path:
+        # 动态量化只支持 CPU，参照模型也放在 CPU 上保证对比公平
+        device = torch.device("cpu")
 
     print("Loading tokenizer and model...")
-    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True)
+    if os.path.exists(os.path.join(args.model_path, VOCAB_MAP_NAME)):
+        # 词表裁剪后的模型 (prune_vocab.py)，需要用映射后的 token id
+        tokenizer = PrunedTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
         
-    model = AutoModelForCausalLM.from_pretrained(
-        BASE_MODEL_PATH, 
-        trust_remote_code=True, 
-        torch_dtype=torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
-    ).to(device)
+    dtype = torch.bfloat16 if device.type == "cuda" and torch.cuda.is_bf16_supported() else torch.float32
+    if args.fast_load:
+        model = load_model_fast(args.model_path, device=device, dtype=dtype, use_snapshot=args.fast_load_snapshot)
+    else:
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_path, 
+            trust_remote_code=True, 
+            torch_dtype=dtype
+        ).to(device)
+    if args.early_exit_heads:
+        # 在评估开始前加载，head 和模型不匹配时立即报错
+        from early_exit import load_exit_heads
+        heads = load_exit_heads(args.early_exit_heads, model, args.model_path)
 
     print("\n" + "=" * 30)
     print(f"1. Starting evaluation on {args.num_samples or 'all'} samples...")
     print("=" * 30)
 
-    evaluation_summary = evaluate_model(model, tokenizer, PROMPT_VAL_CSV, num_samples=args.num_samples)
+    batch_size, batch_plan = args.batch_size, None
+    if args.auto_batch and args.decoding == "prompt_lookup":
+        print("⚠️ prompt_lookup 解码只支持 batch 1，忽略 --auto_batch")
+    elif args.auto_batch:
+        print("🔍 正在实测各 batch 大小的生成吞吐...")
+        memory_budget = parse_size(args.memory_budget) if args.memory_budget else None
+        prompts = read_table(PROMPT_VAL_FILE, columns=["text"])["text"].tolist()
+        batch_plan = plan_eval(model, tokenizer, prompts, memory_budget=memory_budget)
+        batch_size = batch_plan["batch_size"]
+        print(f"✅ 评估 batch 大小: {batch_size}")
+
+    evaluation_summary = evaluate_model(model, tokenizer, PROMPT_VAL_FILE, num_samples=args.num_samples, decoding=args.decoding, lexical_router=lexical_router, batch_size=batch_size, pipelined=args.pipelined)
+    if batch_plan is not None:
+        evaluation_summary["batch_plan"] = batch_plan
 
     print("\n--- Evaluation Summary ---")
     print(json.dumps(evaluation_summary, indent=2))
@@ -203,6 +392,61 @@ if __name__ == "__main__":
         json.dump(evaluation_summary, f, indent=2)
     
     print(f"\n✅ Evaluation summary saved to {RESULTS_FILE}")
+
+    if args.early_exit_heads:
+        from early_exit import EarlyExitDecoder, summarize_thresholds
+
+        print("\n" + "=" * 30)
+        print(f"Early-exit decoding with heads at layers {heads.exit_layers}...")
+        print("=" * 30)
+        # 阈值为 inf 时永远不会提前退出，也不计算 exit head：同一个解码循环跑满所有层，作为准确率和延迟的基准
+        runs = []
+        for threshold in [float("inf")] + args.exit_thresholds:
+            runs.append((threshold, evaluate_model(
+                model, tokenizer, PROMPT_VAL_FILE,
+                num_samples=args.num_samples, lexical_router=lexical_router,
+                early_exit_decoder=EarlyExitDecoder(model, heads, threshold),
+                detailed_results_file=os.path.join(RESULTS_DIR, f"early_exit_{threshold}_detailed_results.csv"),
+            )))
+        early_exit_report = summarize_thresholds(runs[0][1], runs[1:])
+
+        print("\n--- Early Exit: accuracy / latency per threshold ---")
+        print(f"{'threshold':>9} | {'exact':>6} | {'arg F1':>6} | {'latency ms':>10} | {'speedup':>7} | {'exit rate':>9}")
+        for row in early_exit_report["thresholds"]:
+            print(f"{row['threshold']:>9} | {row['exact_match_rate']:>6.3f} | {row['average_argument_f1']:>6.3f} | "
+                  f"{row['average_latency_ms']:>10.1f} | {row['latency_speedup']:>6.2f}x | {row['exit_rate']:>9.2%}")
+        with open(EARLY_EXIT_RESULTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(early_exit_report, f, indent=2)
+        print(f"\n✅ Early-exit results saved to {EARLY_EXIT_RESULTS_FILE}")
+
+    if args.quantized_model_path:
+        reference_bytes = model_memory_bytes(model)
+        del model
+
+        print("\n" + "=" * 30)
+        print(f"2. Starting evaluation of int8 model from {args.quantized_model_path}...")
+        print("=" * 30)
+        quantized_model, quantized_tokenizer = load_quantized_model(args.quantized_model_path)
+        if quantized_tokenizer.pad_token is None:
+            quantized_tokenizer.pad_token = quantized_tokenizer.eos_token
+
+        quantized_summary = evaluate_model(
+            quantized_model, quantized_tokenizer, PROMPT_VAL_FILE,
+            num_samples=args.num_samples, decoding=args.decoding, lexical_router=lexical_router,
+            # 与参照模型用同一个 batch 大小，延迟对比才公平
+            batch_size=batch_size,
+            detailed_results_file=os.path.join(RESULTS_DIR, "quantized_detailed_evaluation_results.csv")
+        )
+        comparison = compare_with_quantized(
+            evaluation_summary, quantized_summary, reference_bytes, model_memory_bytes(quantized_model)
+        )
+
+        print("\n--- int8 vs Reference ---")
+        print(json.dumps(comparison, indent=2))
+        with open(QUANTIZED_RESULTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(comparison, f, indent=2)
+        print(f"\n✅ Quantization comparison saved to {QUANTIZED_RESULTS_FILE}")
+
     print("\n" + "=" * 30)
     print(f"🎉 Evaluation complete!")
-    print("=" * 30)
\ No newline at end of file
+    print("=" * 30)
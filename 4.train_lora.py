@@ -2,32 +2,27 @@
 import os
 import sys
 import json
+import argparse
 import hashlib
 import random
 import shutil
-import pandas as pd
-from datasets import Dataset, load_from_disk
-from transformers import (
-    AutoTokenizer,
-    AutoModelForCausalLM,
-    TrainingArguments,
-    Trainer,
-    default_data_collator,
-)
-from peft import LoraConfig, get_peft_model, TaskType
-import torch
+import functools
 
 # --- 路径 & 配置 ---
 project_root = os.path.dirname(os.path.abspath(__file__))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
+from data_io import load_hf_dataset
+from utils import parse_size
+
 BASE_MODEL_PATH = "./models/gemma-3-270m"
-PROMPT_TRAIN_CSV = "./data/train.csv"
-PROMPT_VAL_CSV = "./data/test.csv"
+PROMPT_TRAIN_FILE = "./data/train.parquet"
+PROMPT_VAL_FILE = "./data/test.parquet"
 TOKENIZED_TRAIN_PATH = "./cached/tokenized_train_gen"
 TOKENIZED_VAL_PATH = "./cached/tokenized_val_gen"
 OUTPUT_DIR = "./checkpoints/lora_gemma_generation"
+BATCH_PLAN_FILE_NAME = "batch_plan.json"
 
 # --- Lora Config ---
 LORA_R = 16
@@ -42,33 +37,53 @@ GRAD_ACCUMULATION_STEPS = 4
 NUM_TRAIN_EPOCHS = 5
 LEARNING_RATE = 2e-4
 
-# --- Tokenizer & 模型 ---
-tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True)
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-tokenizer.truncation_side = "left"
+DEFAULT_HYPERPARAMS = {
+    "lora_r": LORA_R,
+    "lora_alpha": LORA_ALPHA,
+    "lora_target_modules": LORA_TARGET_MODULES,
+    "lora_dropout": LORA_DROPOUT,
+    "learning_rate": LEARNING_RATE,
+    "num_train_epochs": NUM_TRAIN_EPOCHS,
+}
+
+# --- Tokenizer ---
+@functools.lru_cache(maxsize=None)
+def get_tokenizer():
+    """Loaded on first use rather than at import, so `--help` and load_script callers stay fast."""
+    from transformers import AutoTokenizer
 
-model = AutoModelForCausalLM.from_pretrained(
-    BASE_MODEL_PATH, trust_remote_code=True, attn_implementation="eager"
-)
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.truncation_side = "left"
+    return tokenizer
 
 # --- LoRA 配置 & 注入 ---
-lora_config = LoraConfig(
-    r=LORA_R,
-    lora_alpha=LORA_ALPHA,
-    target_modules=LORA_TARGET_MODULES,
-    lora_dropout=LORA_DROPOUT,
-    bias="none",
-    task_type=TaskType.CAUSAL_LM,
-)
-model = get_peft_model(model, lora_config)
-model.config.use_cache = False
-model.gradient_checkpointing_enable()
-model.enable_input_require_grads()
-model.print_trainable_parameters()
+def build_lora_model(lora_r=LORA_R, lora_alpha=LORA_ALPHA, lora_target_modules=LORA_TARGET_MODULES, lora_dropout=LORA_DROPOUT):
+    from transformers import AutoModelForCausalLM
+    from peft import LoraConfig, get_peft_model, TaskType
+
+    model = AutoModelForCausalLM.from_pretrained(
+        BASE_MODEL_PATH, trust_remote_code=True, attn_implementation="eager"
+    )
+    lora_config = LoraConfig(
+        r=lora_r,
+        lora_alpha=lora_alpha,
+        target_modules=list(lora_target_modules),
+        lora_dropout=lora_dropout,
+        bias="none",
+        task_type=TaskType.CAUSAL_LM,
+    )
+    model = get_peft_model(model, lora_config)
+    model.config.use_cache = False
+    model.gradient_checkpointing_enable()
+    model.enable_input_require_grads()
+    model.print_trainable_parameters()
+    return model
 
 # --- 预处理函数 ---
 def preprocess_data(examples, max_len=512):
+    tokenizer = get_tokenizer()
     batch = {k: [] for k in ["input_ids", "attention_mask", "labels"]}
     
     for text, label_str in zip(examples["text"], examples["label"]):
@@ -108,6 +123,8 @@ def _sig_hex(d: dict) -> str:
 PREPROC_SIG_HEX = _sig_hex(PREPROC_SIGNATURE)
 
 def build_or_load_datasets():
+    from datasets import load_from_disk
+
     sig_file = os.path.join(os.path.dirname(TOKENIZED_TRAIN_PATH), f"sig_{PREPROC_SIG_HEX}.json")
 
     if os.path.exists(TOKENIZED_TRAIN_PATH) and os.path.exists(sig_file):
@@ -120,13 +137,13 @@ def build_or_load_datasets():
     if os.path.exists(TOKENIZED_VAL_PATH):
         shutil.rmtree(TOKENIZED_VAL_PATH)
 
-    train_df = pd.read_csv(PROMPT_TRAIN_CSV)
-    val_df = pd.read_csv(PROMPT_VAL_CSV)
-    train_ds = Dataset.from_pandas(train_df)
-    val_ds = Dataset.from_pandas(val_df)
+    # Arrow 缓存是 memory-mapped 的，不再经过 pandas 复制一份
+    train_ds = load_hf_dataset(PROMPT_TRAIN_FILE)
+    val_ds = load_hf_dataset(PROMPT_VAL_FILE)
 
-    train_ds = train_ds.map(preprocess_data, batched=True, remove_columns=["text", "label"])
-    val_ds = val_ds.map(preprocess_data, batched=True, remove_columns=["text", "label"])
+    # 除了 text / label 还可能有 chain 等只用于评估的列，全部去掉，只留下 tokenize 的结果
+    train_ds = train_ds.map(preprocess_data, batched=True, remove_columns=train_ds.column_names)
+    val_ds = val_ds.map(preprocess_data, batched=True, remove_columns=val_ds.column_names)
 
     train_ds.save_to_disk(TOKENIZED_TRAIN_PATH)
     val_ds.save_to_disk(TOKENIZED_VAL_PATH)
@@ -136,44 +153,147 @@ def build_or_load_datasets():
     print(f"💾 已保存新 tokenized 数据及签名 {PREPROC_SIG_HEX}。")
     return train_ds, val_ds
 
+# --- 批大小规划 ---
+def plan_batch_size(train_dataset, memory_budget=None, **hyperparams):
+    """
+    Probes the largest micro-batch that fits `memory_budget` for this LoRA config and keeps the
+    effective batch (TRAIN_BATCH_SIZE * GRAD_ACCUMULATION_STEPS) constant; returns the batch plan.
+    """
+    import gc
+    import torch
+    from batch_planner import plan_training
+
+    hyperparams = {**DEFAULT_HYPERPARAMS, **hyperparams}
+    model = build_lora_model(
+        lora_r=hyperparams["lora_r"],
+        lora_alpha=hyperparams["lora_alpha"],
+        lora_target_modules=hyperparams["lora_target_modules"],
+        lora_dropout=hyperparams["lora_dropout"],
+    )
+    if torch.cuda.is_available():
+        model.to("cuda")
+    plan = plan_training(
+        model, train_dataset, TRAIN_BATCH_SIZE * GRAD_ACCUMULATION_STEPS,
+        memory_budget=memory_budget, mixed_precision=torch.cuda.is_available(),
+    )
+    del model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return plan
+
 # --- 训练 ---
-if __name__ == "__main__":
-    random.seed(42)
-    train_dataset, val_dataset = build_or_load_datasets()
+def train_lora(train_dataset, val_dataset, output_dir=OUTPUT_DIR, callbacks=None, training_overrides=None,
+               resume_from_checkpoint=None, **hyperparams):
+    """
+    Trains one LoRA adapter. `hyperparams` override DEFAULT_HYPERPARAMS and `training_overrides`
+    override TrainingArguments fields; returns (model, trainer).
+    """
+    import torch
+    from transformers import TrainingArguments, Trainer, default_data_collator
 
-    training_args = TrainingArguments(
-        output_dir=OUTPUT_DIR,
-        per_device_train_batch_size=TRAIN_BATCH_SIZE,
-        per_device_eval_batch_size=EVAL_BATCH_SIZE,
-        gradient_accumulation_steps=GRAD_ACCUMULATION_STEPS,
-        learning_rate=LEARNING_RATE,
-        num_train_epochs=NUM_TRAIN_EPOCHS,
-        lr_scheduler_type="cosine",
-        warmup_ratio=0.1,
-        logging_steps=20,
-        save_strategy="epoch",
-        # evaluation_strategy="no",
-        fp16=True,
-        gradient_checkpointing=True,
-        report_to="none",
-        # load_best_model_at_end=True,
-        weight_decay=0.01,
+    hyperparams = {**DEFAULT_HYPERPARAMS, **hyperparams}
+    model = build_lora_model(
+        lora_r=hyperparams["lora_r"],
+        lora_alpha=hyperparams["lora_alpha"],
+        lora_target_modules=hyperparams["lora_target_modules"],
+        lora_dropout=hyperparams["lora_dropout"],
     )
 
+    training_args = TrainingArguments(**{
+        "output_dir": output_dir,
+        "per_device_train_batch_size": TRAIN_BATCH_SIZE,
+        "per_device_eval_batch_size": EVAL_BATCH_SIZE,
+        "gradient_accumulation_steps": GRAD_ACCUMULATION_STEPS,
+        "learning_rate": hyperparams["learning_rate"],
+        "num_train_epochs": hyperparams["num_train_epochs"],
+        "lr_scheduler_type": "cosine",
+        "warmup_ratio": 0.1,
+        "logging_steps": 20,
+        "save_strategy": "epoch",
+        # "evaluation_strategy": "no",
+        "fp16": torch.cuda.is_available(),
+        "gradient_checkpointing": True,
+        "report_to": "none",
+        # "load_best_model_at_end": True,
+        "weight_decay": 0.01,
+        **(training_overrides or {}),
+    })
+
     trainer = Trainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
-        tokenizer=tokenizer,
+        tokenizer=get_tokenizer(),
         data_collator=default_data_collator,
+        callbacks=callbacks,
     )
+    trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+    return model, trainer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the LoRA adapter, or run a hyperparameter sweep.")
+    parser.add_argument("--sweep", type=str, default=None, help="JSON sweep spec (see lora_sweep.py); trials run in parallel worker processes.")
+    parser.add_argument("--auto_batch", action="store_true", help="Probe the largest micro-batch within the memory budget and adjust gradient accumulation to keep the effective batch (see batch_planner.py).")
+    parser.add_argument("--memory_budget", type=str, default=None, help="Memory budget for --auto_batch, e.g. 12GB. Defaults to 90%% of GPU memory or RAM.")
+    parser.add_argument("--adapter_save_steps", type=int, default=None, help="Save adapter-only checkpoints every N steps, written by a background thread (see async_checkpoint.py).")
+    parser.add_argument("--full_save_steps", type=int, default=None, help="With --adapter_save_steps: full checkpoints (optimizer/scheduler state, for resume) every N steps. Defaults to once per epoch.")
+    parser.add_argument("--no_full_checkpoints", action="store_true", help="With --adapter_save_steps: skip full checkpoints entirely (nothing left for --resume_from_checkpoint).")
+    parser.add_argument("--keep_adapter_checkpoints", type=int, default=3, help="Adapter-only checkpoints to keep.")
+    parser.add_argument("--keep_full_checkpoints", type=int, default=1, help="Full checkpoints to keep.")
+    parser.add_argument("--gen_eval", action="store_true", help="Run generation eval (exact match, tool accuracy, argument F1) on a stratified test subsample during training and keep the best adapter (see generation_eval.py).")
+    parser.add_argument("--gen_eval_steps", type=int, default=None, help="With --gen_eval: evaluate every N steps instead of every epoch.")
+    parser.add_argument("--gen_eval_per_tool", type=int, default=4, help="With --gen_eval: test samples per tool in the fixed subsample.")
+    parser.add_argument("--early_stopping_patience", type=int, default=None, help="With --gen_eval: stop after N evaluations without argument F1 improvement.")
+    parser.add_argument("--resume_from_checkpoint", type=str, default=None, help="Full checkpoint directory to resume from, or 'latest'.")
+    args = parser.parse_args()
+
+    random.seed(42)
+    train_dataset, val_dataset = build_or_load_datasets()
 
-    print("\n" + "=" * 30)
-    print("🚀 开始 LoRA 微调训练...")
-    print("=" * 30)
-    trainer.train()
+    if args.sweep:
+        from lora_sweep import run_sweep
+        run_sweep(args.sweep)
+    else:
+        print("\n" + "=" * 30)
+        print("🚀 开始 LoRA 微调训练...")
+        print("=" * 30)
+        training_overrides = {}
+        if args.auto_batch:
+            print("🔍 正在探测显存预算内的最大 micro-batch...")
+            memory_budget = parse_size(args.memory_budget) if args.memory_budget else None
+            batch_plan = plan_batch_size(train_dataset, memory_budget=memory_budget)
+            training_overrides = {
+                "per_device_train_batch_size": batch_plan["micro_batch_size"],
+                "gradient_accumulation_steps": batch_plan["gradient_accumulation_steps"],
+            }
+            # plan 和测量值跟训练输出放在一起，之后能知道这次训练用的是什么配置
+            os.makedirs(OUTPUT_DIR, exist_ok=True)
+            with open(os.path.join(OUTPUT_DIR, BATCH_PLAN_FILE_NAME), "w", encoding="utf-8") as f:
+                json.dump(batch_plan, f, indent=2)
+            print(f"✅ micro-batch {batch_plan['micro_batch_size']} x 梯度累积 {batch_plan['gradient_accumulation_steps']} "
+                  f"= 有效 batch {batch_plan['effective_batch_size']}")
+        callbacks = []
+        if args.adapter_save_steps:
+            from async_checkpoint import AsyncAdapterCheckpointCallback, full_checkpoint_overrides
+            training_overrides.update(full_checkpoint_overrides(args.full_save_steps, args.keep_full_checkpoints, disabled=args.no_full_checkpoints))
+            callbacks.append(AsyncAdapterCheckpointCallback(OUTPUT_DIR, args.adapter_save_steps, keep_last=args.keep_adapter_checkpoints))
+        gen_eval_callback = None
+        if args.gen_eval:
+            from generation_eval import GenerationEvalCallback, stratified_subsample, BEST_ADAPTER_DIR_NAME
+            gen_eval_callback = GenerationEvalCallback(
+                get_tokenizer(), stratified_subsample(PROMPT_VAL_FILE, args.gen_eval_per_tool), OUTPUT_DIR,
+                eval_steps=args.gen_eval_steps, early_stopping_patience=args.early_stopping_patience,
+            )
+            callbacks.append(gen_eval_callback)
+        resume = True if args.resume_from_checkpoint == "latest" else args.resume_from_checkpoint
+        model, _ = train_lora(train_dataset, val_dataset, callbacks=callbacks, training_overrides=training_overrides, resume_from_checkpoint=resume)
 
-    model.save_pretrained(OUTPUT_DIR)
-    tokenizer.save_pretrained(OUTPUT_DIR)
-    print(f"✅ 训练完成，最终模型已保存至: {OUTPUT_DIR}")
\ No newline at end of file
+        model.save_pretrained(OUTPUT_DIR)
+        get_tokenizer().save_pretrained(OUTPUT_DIR)
+        print(f"✅ 训练完成，最终模型已保存至: {OUTPUT_DIR}")
+        if gen_eval_callback is not None and gen_eval_callback.best is not None:
+            best = gen_eval_callback.best
+            print(f"⭐ 最佳 adapter (step {best['step']}, arg F1 {best['average_argument_f1']:.3f}) 保存在: {os.path.join(OUTPUT_DIR, BEST_ADAPTER_DIR_NAME)}")
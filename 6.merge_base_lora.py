@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
+import json
+import shutil
+import resource
+import argparse
 import sys
 
 # --- 路径配置 ---
@@ -10,17 +11,24 @@ project_root = os.path.dirname(os.path.abspath(__file__))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
+from utils import parse_size
+from lora_weights import load_lora_deltas
+
 BASE_MODEL_PATH = "./models/gemma-3-270m-it"
 LORA_MODEL_PATH = "./checkpoints/lora_gemma_generation"
 MERGED_MODEL_PATH = "./models/merged_gemma_lora"
+QUANTIZED_MODEL_PATH = "./models/merged_gemma_lora_int8"
+DEFAULT_SHARD_SIZE = "2GB"
 
-# --- 设备配置 ---
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-def merge_lora_with_base_model():
+def merge_lora_with_base_model(quantize=None):
     """
     加载基础模型和LoRA适配器，将它们合并，并保存合并后的模型。
+    quantize="int8" 时额外保存一份 int8 动态量化的模型用于 CPU 推理。
     """
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    from peft import PeftModel
+
     print("=" * 30)
     print("🚀 开始融合 LoRA 模型与基础模型...")
     print("=" * 30)
@@ -79,8 +87,181 @@ def merge_lora_with_base_model():
         print(f"❌ 复制 tokenizer.model 时出错: {e}")
 
     print(f"🎉 成功！合并后的模型已保存至: {MERGED_MODEL_PATH}")
+
+    # --- 6. 可选：int8 动态量化 ---
+    if quantize == "int8":
+        quantize_and_save(merged_model, tokenizer)
+    print("=" * 30)
+
+
+def quantize_and_save(merged_model, tokenizer):
+    from quantization import quantize_int8, save_quantized_model, model_memory_bytes
+
+    print("🔄 正在对线性层做 int8 动态量化...")
+    fp_bytes = model_memory_bytes(merged_model)
+    quantized_model = quantize_int8(merged_model)
+    save_quantized_model(quantized_model, tokenizer, QUANTIZED_MODEL_PATH, source_model_path=MERGED_MODEL_PATH)
+    int8_bytes = model_memory_bytes(quantized_model)
+    print(f"✅ 量化模型已保存至: {QUANTIZED_MODEL_PATH} "
+          f"(权重 {fp_bytes / 1024**2:.1f} MiB -> {int8_bytes / 1024**2:.1f} MiB)")
+
+
+# --- 流式合并 (不加载完整模型) ---
+SAFETENSORS_DTYPE_SIZES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+
+
+def _tensor_nbytes(dtype, shape):
+    nbytes = SAFETENSORS_DTYPE_SIZES[dtype]
+    for dim in shape:
+        nbytes *= dim
+    return nbytes
+
+
+def peak_rss_mib():
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _base_weight_files(model_path):
+    index_file = os.path.join(model_path, "model.safetensors.index.json")
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_path, name) for name in sorted(set(weight_map.values()))]
+    return [os.path.join(model_path, "model.safetensors")]
+
+
+def _write_safetensors_streaming(path, entries, tensor_iter):
+    """
+    Writes a safetensors file whose header is known up front (`entries`: [(name, dtype, shape)]),
+    pulling tensors one at a time from `tensor_iter` so only one tensor is in memory.
+    """
+    import torch
+    header = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for name, dtype, shape in entries:
+        nbytes = _tensor_nbytes(dtype, shape)
+        header[name] = {"dtype": dtype, "shape": list(shape), "data_offsets": [offset, offset + nbytes]}
+        offset += nbytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for (name, _, shape), tensor in zip(entries, tensor_iter):
+            assert tuple(tensor.shape) == tuple(shape), f"{name} 形状不一致"
+            f.write(tensor.contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+
+def streaming_merge_lora(base_model_path=BASE_MODEL_PATH, lora_model_path=LORA_MODEL_PATH,
+                         output_path=MERGED_MODEL_PATH, max_shard_size=DEFAULT_SHARD_SIZE):
+    """
+    逐个张量读取基础模型的 safetensors，对 LoRA 目标模块加上 B @ A * scaling，
+    按分片大小写出新的 safetensors。峰值内存约为一个张量加上适配器本身。
+    """
+    from safetensors import safe_open
+
+    print("=" * 30)
+    print("🚀 开始流式融合 LoRA 模型与基础模型...")
+    print("=" * 30)
+    max_shard_bytes = parse_size(max_shard_size)
+
+    print(f"🔄 正在从 '{lora_model_path}' 读取LoRA适配器...")
+    deltas, fan_in_fan_out = load_lora_deltas(lora_model_path)
+    print(f"✅ 读取到 {len(deltas)} 个 LoRA 模块。")
+
+    # 1. 只读 header，规划分片
+    weight_files = _base_weight_files(base_model_path)
+    entries = []
+    for weight_file in weight_files:
+        with safe_open(weight_file, framework="pt") as f:
+            for key in f.keys():
+                tensor_slice = f.get_slice(key)
+                entries.append((weight_file, key, tensor_slice.get_dtype(), tensor_slice.get_shape()))
+
+    shards = [[]]
+    shard_bytes = 0
+    for entry in entries:
+        nbytes = _tensor_nbytes(entry[2], entry[3])
+        if shards[-1] and shard_bytes + nbytes > max_shard_bytes:
+            shards.append([])
+            shard_bytes = 0
+        shards[-1].append(entry)
+        shard_bytes += nbytes
+    total_size = sum(_tensor_nbytes(dtype, shape) for _, _, dtype, shape in entries)
+
+    # 2. 逐张量合并并写出
+    os.makedirs(output_path, exist_ok=True)
+    # 清掉旧的权重文件，避免和新分片混在一起被加载
+    for file_name in os.listdir(output_path):
+        if file_name.endswith(".safetensors") or file_name == "model.safetensors.index.json":
+            os.remove(os.path.join(output_path, file_name))
+    weight_map = {}
+    merged_modules = set()
+
+    def _merged_tensors(shard):
+        handles = {}
+        try:
+            for weight_file, key, _, _ in shard:
+                if weight_file not in handles:
+                    handles[weight_file] = safe_open(weight_file, framework="pt")
+                tensor = handles[weight_file].get_tensor(key)
+                module_name = key[:-len(".weight")] if key.endswith(".weight") else None
+                if module_name in deltas:
+                    lora_a, lora_b, scaling = deltas[module_name]
+                    delta = (lora_b.float() @ lora_a.float()) * scaling
+                    if fan_in_fan_out:
+                        delta = delta.T
+                    tensor = (tensor.float() + delta).to(tensor.dtype)
+                    merged_modules.add(module_name)
+                yield tensor
+        finally:
+            handles.clear()
+
+    for shard_index, shard in enumerate(shards, start=1):
+        shard_name = "model.safetensors" if len(shards) == 1 else f"model-{shard_index:05d}-of-{len(shards):05d}.safetensors"
+        print(f"💾 正在写入分片 {shard_name} ({len(shard)} 个张量)...")
+        _write_safetensors_streaming(
+            os.path.join(output_path, shard_name),
+            [(key, dtype, shape) for _, key, dtype, shape in shard],
+            _merged_tensors(shard),
+        )
+        for _, key, _, _ in shard:
+            weight_map[key] = shard_name
+
+    missing = set(deltas) - merged_modules
+    if missing:
+        raise ValueError(f"以下 LoRA 模块在基础模型中找不到对应权重: {sorted(missing)[:5]} ...")
+
+    if len(shards) > 1:
+        with open(os.path.join(output_path, "model.safetensors.index.json"), "w", encoding="utf-8") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+
+    # 3. 复制 config / tokenizer 等非权重文件 (包括 tokenizer.model)
+    for file_name in os.listdir(base_model_path):
+        source = os.path.join(base_model_path, file_name)
+        if os.path.isfile(source) and not file_name.endswith(".safetensors") and file_name != "model.safetensors.index.json":
+            shutil.copyfile(source, os.path.join(output_path, file_name))
+
+    print(f"✅ 合并了 {len(merged_modules)} 个模块，共 {len(shards)} 个分片，{total_size / 1024**2:.1f} MiB。")
+    print(f"📈 峰值内存 (RSS): {peak_rss_mib():.1f} MiB")
+    print(f"🎉 成功！合并后的模型已保存至: {output_path}")
     print("=" * 30)
 
 
 if __name__ == "__main__":
-    merge_lora_with_base_model()
+    parser = argparse.ArgumentParser(description="Merge the LoRA adapter into the base model.")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"], help="Also save an int8 dynamically quantized copy for CPU inference.")
+    parser.add_argument("--streaming", action="store_true", help="Merge tensor by tensor from the safetensors files instead of loading the full model.")
+    parser.add_argument("--shard_size", type=str, default=DEFAULT_SHARD_SIZE, help="Maximum shard size for --streaming, e.g. 500MB or 2GB.")
+    args = parser.parse_args()
+
+    if args.streaming:
+        streaming_merge_lora(max_shard_size=args.shard_size)
+        if args.quantize == "int8":
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            merged_model = AutoModelForCausalLM.from_pretrained(MERGED_MODEL_PATH, trust_remote_code=True)
+            quantize_and_save(merged_model, AutoTokenizer.from_pretrained(MERGED_MODEL_PATH, trust_remote_code=True))
+    else:
+        merge_lora_with_base_model(quantize=args.quantize)
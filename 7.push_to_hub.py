@@ -1,60 +1,102 @@
 import os
-from huggingface_hub import HfApi, login
+import sys
+import json
+import argparse
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from utils import parse_size
+
+LOCAL_MODEL_PATH = "./models/merged_gemma_lora"
+BUNDLE_DIR = "./export/merged_gemma_lora_bundle"
+RESULTS_DIR = "./results/"
+
+# --- 全局变量 ---
+PUBLISH_REPORT_FILE = os.path.join(RESULTS_DIR, "publish_report.json")
+EVAL_RESULT_FILES = [
+    os.path.join(RESULTS_DIR, "evaluation_results.json"),
+    os.path.join(RESULTS_DIR, "lora_evaluation_results.json"),
+]
 
 def main():
     """
-    主函数，引导用户完成模型上传流程。
+    主函数：把模型导出为内容寻址的 bundle，再增量推送到 Hugging Face Hub (或代替 Hub 的本地目录)。
     """
-    # --- 1. 定义本地模型路径 ---
-    local_model_path = "./models/merged_gemma_lora"
-    
-    if not os.path.isdir(local_model_path):
-        print(f"❌ 错误：本地模型文件夹不存在于 '{local_model_path}'")
+    parser = argparse.ArgumentParser(description="Export the merged model as a content-addressed bundle and publish only the changed files.")
+    parser.add_argument("--model_path", type=str, default=LOCAL_MODEL_PATH, help="Merged model directory to export.")
+    parser.add_argument("--bundle_dir", type=str, default=BUNDLE_DIR, help="Where the bundle (shards + manifest) is written.")
+    parser.add_argument("--shard_size", type=str, default=None, help="Maximum bundle shard size, e.g. 64MB. Defaults to model_bundle.DEFAULT_BUNDLE_SHARD_SIZE.")
+    parser.add_argument("--eval_results", type=str, nargs="*", default=EVAL_RESULT_FILES, help="Evaluation summaries shipped under eval/ (missing files are skipped).")
+    parser.add_argument("--repo_id", type=str, default=None, help="Hub repo to publish to, e.g. user/merged_gemma_lora. Uses the cached token.")
+    parser.add_argument("--target_dir", type=str, default=None, help="Publish to a local directory standing in for the hub.")
+    parser.add_argument("--export_only", action="store_true", help="Only write the bundle.")
+    parser.add_argument("--dry_run", action="store_true", help="Compare manifests and report what would be transferred without uploading.")
+    args = parser.parse_args()
+
+    # safetensors / torch / huggingface_hub 在解析完参数后才导入，`--help` 不必付出启动开销
+    from model_bundle import export_bundle, publish_bundle, LocalDirTarget, HubTarget, DEFAULT_BUNDLE_SHARD_SIZE
+
+    # --- 1. 检查本地模型路径 ---
+    if not os.path.isdir(args.model_path):
+        print(f"❌ 错误：本地模型文件夹不存在于 '{args.model_path}'")
         print("请确保您已经成功运行了模型融合脚本。")
         return
 
     print("=" * 40)
     print("🚀 开始推送模型到 Hugging Face Hub 🚀")
     print("=" * 40)
-    
-    # --- 2. 获取用户信息 ---
-    hf_username = input("请输入您的 Hugging Face 用户名: ")
-    repo_name = input(f"请输入您想创建的仓库名 (例如: {os.path.basename(local_model_path)}): ")
-    repo_id = f"{hf_username}/{repo_name}"
-
-    print(f"✅ 准备就绪，将要把 '{local_model_path}' 的内容推送到仓库 '{repo_id}'")
-    
-    # --- 3. 登录 ---
-    print("\n--- 步骤 1/2: 登录 ---")
-    print("您需要一个有 'write' 权限的 Hugging Face Access Token。")
-    print("请从这里获取: https://huggingface.co/settings/tokens")
-    login()
-    print("✅ 登录成功！")
-
-    # --- 4. 创建仓库并上传 ---
-    api = HfApi()
+
+    # --- 2. 导出 bundle ---
+    print(f"\n--- 步骤 1/2: 导出 '{args.model_path}' → '{args.bundle_dir}' ---")
+    shard_size = parse_size(args.shard_size or DEFAULT_BUNDLE_SHARD_SIZE)
+    manifest = export_bundle(args.model_path, args.bundle_dir, shard_size, eval_files=args.eval_results)
+    shards = [entry for entry in manifest["files"].values() if entry["kind"] == "shard"]
+    print(f"✅ {len(shards)} 个分片 ({sum(entry['size'] for entry in shards) / 1024 ** 2:.1f} MiB)，"
+          f"共 {len(manifest['files'])} 个文件，manifest 已写入")
+    if args.export_only:
+        return
+
+    # --- 3. 选择发布目标 ---
+    if args.target_dir:
+        target = LocalDirTarget(args.target_dir)
+    else:
+        repo_id = args.repo_id
+        if repo_id is None:
+            # 没有指定目标时沿用交互流程
+            from huggingface_hub import login
+            hf_username = input("请输入您的 Hugging Face 用户名: ")
+            repo_name = input(f"请输入您想创建的仓库名 (例如: {os.path.basename(args.model_path)}): ")
+            repo_id = f"{hf_username}/{repo_name}"
+            print("您需要一个有 'write' 权限的 Hugging Face Access Token。")
+            print("请从这里获取: https://huggingface.co/settings/tokens")
+            login()
+            print("✅ 登录成功！")
+        target = HubTarget(repo_id)
+
+    # --- 4. 对比 manifest，只传输变化的文件 ---
+    print(f"\n--- 步骤 2/2: 发布到 {target} ---")
     try:
-        print("\n--- 步骤 2/3: 创建或确认远程仓库 ---")
-        api.create_repo(
-            repo_id=repo_id,
-            repo_type="model",
-            exist_ok=True  # 如果仓库已存在，则不报错
-        )
-        print(f"✅ 仓库 '{repo_id}' 已在 Hub 上准备就绪。")
-
-        print("\n--- 步骤 3/3: 上传文件 ---")
-        print("这可能需要一些时间，取决于您的网络速度和模型大小...")
-        api.upload_folder(
-            folder_path=local_model_path,
-            repo_id=repo_id,
-            repo_type="model",
-            commit_message=f"Upload merged model from {local_model_path}"
-        )
-        print(f"🎉 成功！模型已上传至: https://huggingface.co/{repo_id}")
+        report = publish_bundle(args.bundle_dir, target, message=f"Update model bundle from {args.model_path}", dry_run=args.dry_run)
     except Exception as e:
         print(f"❌ 上传过程中发生错误: {e}")
         print("请检查您的网络连接、token权限以及仓库名称是否有效。")
+        return
+
+    if not report["files_uploaded"] and not report["files_deleted"]:
+        print("✅ 目标已是最新，没有需要传输的文件。")
+    else:
+        print(f"{'🔍 (dry run) 将' if args.dry_run else '🎉 已'}传输 {report['files_uploaded']}/{report['files_total']} 个文件 "
+              f"(分片 {report['shards_uploaded']}/{report['shards_total']})，"
+              f"{report['uploaded_bytes'] / 1024 ** 2:.1f}/{report['bundle_bytes'] / 1024 ** 2:.1f} MiB "
+              f"({report['uploaded_fraction']:.1%})，删除 {report['files_deleted']} 个旧文件")
 
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(PUBLISH_REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ 发布报告已保存到 {PUBLISH_REPORT_FILE}")
     print("=" * 40)
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+异步 adapter-only checkpoint。
+
+save_strategy="epoch" 时 Trainer 同步写完整 checkpoint (权重 + optimizer + scheduler)，训练在每次保存时停住。
+这里每 `save_steps` 步只把 LoRA adapter 的张量拷贝到 CPU 内存 (几 MB)，交给后台线程写 safetensors，
+训练线程马上继续。完整的 optimizer 状态仍由 Trainer 按更慢的节奏 (`full_save_steps`，默认每个 epoch) 保存，
+用于断点续训；只有显式传 --no_full_checkpoints 才不保存。
+两类 checkpoint 各自只保留最近的若干个。
+
+训练结束时汇报训练线程被 I/O 阻塞的时间 (拷贝快照、队列已满时的等待、完整 checkpoint 的同步保存)，
+写到 output_dir/checkpoint_io.json。
+
+用法:
+    python 4.train_lora.py --adapter_save_steps 20 --full_save_steps 200
+"""
+import os
+import re
+import json
+import time
+import queue
+import shutil
+import threading
+from safetensors.torch import save_file
+from transformers import TrainerCallback
+from peft import get_peft_model_state_dict
+
+ADAPTER_CHECKPOINT_PREFIX = "adapter-checkpoint"
+ADAPTER_WEIGHTS_NAME = "adapter_model.safetensors"
+IO_REPORT_NAME = "checkpoint_io.json"
+DEFAULT_KEEP_ADAPTER_CHECKPOINTS = 3
+DEFAULT_KEEP_FULL_CHECKPOINTS = 1
+MAX_PENDING_SNAPSHOTS = 2
+
+
+def full_checkpoint_overrides(full_save_steps=None, keep_full_checkpoints=DEFAULT_KEEP_FULL_CHECKPOINTS, disabled=False):
+    """
+    TrainingArguments fields for the slow, synchronous full-state cadence: every `full_save_steps` steps,
+    or once per epoch (the Trainer's default here) when None. `disabled` turns full checkpoints off.
+    """
+    if disabled:
+        return {"save_strategy": "no"}
+    if not full_save_steps:
+        return {"save_strategy": "epoch", "save_total_limit": keep_full_checkpoints}
+    return {"save_strategy": "steps", "save_steps": full_save_steps, "save_total_limit": keep_full_checkpoints}
+
+
+class AsyncAdapterCheckpointCallback(TrainerCallback):
+    """
+    Every `save_steps` optimizer steps, snapshots the adapter weights to CPU and hands them to a
+    writer thread. At most MAX_PENDING_SNAPSHOTS snapshots wait in memory; beyond that the training
+    thread blocks (and that time is reported) instead of piling up copies.
+    """
+
+    def __init__(self, output_dir, save_steps, keep_last=DEFAULT_KEEP_ADAPTER_CHECKPOINTS, adapter_name="default"):
+        self.output_dir = output_dir
+        self.save_steps = save_steps
+        self.keep_last = keep_last
+        self.adapter_name = adapter_name
+        self.queue = queue.Queue(maxsize=MAX_PENDING_SNAPSHOTS)
+        self.error = None
+        self.stats = {
+            "adapter_saves": 0,
+            "adapter_bytes_written": 0,
+            "snapshot_blocked_s": 0.0,
+            "queue_blocked_s": 0.0,
+            "background_write_s": 0.0,
+            "full_saves": 0,
+            "full_save_blocked_s": 0.0,
+        }
+        self._full_save_start = None
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    # --- 后台写入 ---
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            step, tensors, peft_config = item
+            try:
+                start = time.perf_counter()
+                self._write_checkpoint(step, tensors, peft_config)
+                self._apply_retention()
+                self.stats["background_write_s"] += time.perf_counter() - start
+            except Exception as error:  # 在训练线程里重新抛出
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write_checkpoint(self, step, tensors, peft_config):
+        final_dir = os.path.join(self.output_dir, f"{ADAPTER_CHECKPOINT_PREFIX}-{step}")
+        tmp_dir = final_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        save_file(tensors, os.path.join(tmp_dir, ADAPTER_WEIGHTS_NAME), metadata={"format": "pt"})
+        peft_config.save_pretrained(tmp_dir)
+        # 先写临时目录再改名，读到的 checkpoint 不会是写了一半的
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        self.stats["adapter_saves"] += 1
+        self.stats["adapter_bytes_written"] += sum(t.numel() * t.element_size() for t in tensors.values())
+
+    def _apply_retention(self):
+        pattern = re.compile(rf"^{ADAPTER_CHECKPOINT_PREFIX}-(\d+)$")
+        steps = sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(self.output_dir)) if m)
+        for step in steps[:-self.keep_last] if self.keep_last else []:
+            shutil.rmtree(os.path.join(self.output_dir, f"{ADAPTER_CHECKPOINT_PREFIX}-{step}"), ignore_errors=True)
+
+    def _raise_writer_error(self):
+        if self.error is not None:
+            raise RuntimeError("后台写 adapter checkpoint 失败") from self.error
+
+    # --- Trainer 回调 ---
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        self._raise_writer_error()
+        if control.should_save:
+            # Trainer 接下来会同步保存完整 checkpoint，计时到 on_save
+            self._full_save_start = time.perf_counter()
+        if state.global_step % self.save_steps != 0:
+            return control
+
+        start = time.perf_counter()
+        state_dict = get_peft_model_state_dict(model, adapter_name=self.adapter_name)
+        tensors = {name: tensor.detach().to("cpu", copy=True).contiguous() for name, tensor in state_dict.items()}
+        self.stats["snapshot_blocked_s"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.queue.put((state.global_step, tensors, model.peft_config[self.adapter_name]))
+        self.stats["queue_blocked_s"] += time.perf_counter() - start
+        return control
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        if control.should_save:
+            # save_strategy="epoch" 时完整 checkpoint 在 epoch 结束时保存
+            self._full_save_start = time.perf_counter()
+        return control
+
+    def on_save(self, args, state, control, **kwargs):
+        if self._full_save_start is not None:
+            self.stats["full_saves"] += 1
+            self.stats["full_save_blocked_s"] += time.perf_counter() - self._full_save_start
+            self._full_save_start = None
+        return control
+
+    def on_train_end(self, args, state, control, **kwargs):
+        # 等后台写完，保证训练结束时最后一个 adapter checkpoint 已经落盘
+        start = time.perf_counter()
+        self.queue.put(None)
+        self._writer.join()
+        self.stats["final_flush_s"] = time.perf_counter() - start
+        self._raise_writer_error()
+        self.stats["io_blocked_s"] = (
+            self.stats["snapshot_blocked_s"] + self.stats["queue_blocked_s"]
+            + self.stats["full_save_blocked_s"] + self.stats["final_flush_s"]
+        )
+        print(f"💾 adapter checkpoint {self.stats['adapter_saves']} 次 "
+              f"({self.stats['adapter_bytes_written'] / 1024 ** 2:.1f} MiB，后台写入 {self.stats['background_write_s']:.2f}s)，"
+              f"完整 checkpoint {self.stats['full_saves']} 次；训练被 I/O 阻塞 {self.stats['io_blocked_s']:.2f}s")
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, IO_REPORT_NAME), "w", encoding="utf-8") as f:
+            json.dump(self.stats, f, indent=2)
+        return control
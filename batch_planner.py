@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+批大小 / 内存规划。
+
+训练: 在真实数据里取最长的样本组成 micro-batch，按 1, 2, 4, ... 依次跑一次 forward + backward，
+记录峰值内存 (GPU 用 max_memory_allocated，CPU 采样进程 RSS)，再加上 AdamW 状态的估计。
+取预算内最大的 micro-batch，梯度累积步数随之调整，保持有效 batch 不变。
+
+评估: 生成是按 batch 左 padding 做的，能放下的最大 batch 不一定最快 (padding 浪费、CPU 线程饱和)。
+这里对每个候选 batch 实测 tokens/s (只计到 EOS 为止的有效 token)，选吞吐最高且不超预算的那个。
+
+plan 连同每次探测的测量值一起返回，调用方把它写进训练输出目录或评估结果里。
+
+用法:
+    python 4.train_lora.py --auto_batch --memory_budget 12GB
+    python 3.run_evaluation.py --auto_batch
+    python 5.eval_lora.py --auto_batch --memory_budget 6GB
+"""
+import os
+import gc
+import time
+import random
+import resource
+import threading
+import statistics
+import torch
+from transformers import default_data_collator
+from utils import EVAL_MAX_NEW_TOKENS
+
+MEMORY_BUDGET_FRACTION = 0.9
+EVAL_BATCH_CANDIDATES = [1, 2, 4, 8, 16, 32]
+RSS_SAMPLE_INTERVAL_S = 0.002
+
+
+# --- 内存测量 ---
+def _current_rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # 没有 /proc 时退化为进程历史峰值
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def default_memory_budget(device):
+    """90% of the GPU's memory, or of physical RAM on CPU."""
+    if device.type == "cuda":
+        total = torch.cuda.get_device_properties(device).total_memory
+    else:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return int(total * MEMORY_BUDGET_FRACTION)
+
+
+class PeakMemoryMonitor:
+    """
+    Context manager measuring peak memory over its body: allocator peak on CUDA, sampled
+    process RSS on CPU (a background thread polls every few milliseconds).
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, _current_rss_bytes())
+            self._stop.wait(RSS_SAMPLE_INTERVAL_S)
+
+    def __enter__(self):
+        gc.collect()
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self.peak_bytes = _current_rss_bytes()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+            self.peak_bytes = torch.cuda.max_memory_allocated(self.device)
+        else:
+            self._stop.set()
+            self._thread.join()
+            self.peak_bytes = max(self.peak_bytes, _current_rss_bytes())
+        return False
+
+
+def _is_oom(error):
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error).lower()
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def _release_memory(device):
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+
+
+def sequence_length_stats(lengths):
+    lengths = sorted(lengths)
+    if not lengths:
+        return {}
+    return {
+        "count": len(lengths),
+        "mean": statistics.fmean(lengths),
+        "p50": lengths[len(lengths) // 2],
+        "p95": lengths[min(len(lengths) - 1, int(len(lengths) * 0.95))],
+        "max": lengths[-1],
+    }
+
+
+# --- 训练 ---
+def _optimizer_state_bytes(model):
+    # AdamW 为每个可训练参数保存 exp_avg 和 exp_avg_sq，以 fp32 计
+    return sum(2 * param.numel() * 4 for param in model.parameters() if param.requires_grad)
+
+
+def plan_training(model, train_dataset, effective_batch_size, memory_budget=None, mixed_precision=False):
+    """
+    Largest power-of-two micro-batch (dividing `effective_batch_size`) whose forward + backward on the
+    longest training rows fits `memory_budget`; gradient accumulation makes up the rest.
+    `mixed_precision` probes under fp16 autocast, matching TrainingArguments(fp16=True).
+    """
+    device = model.device
+    memory_budget = memory_budget or default_memory_budget(device)
+    lengths = [sum(mask) for mask in train_dataset["attention_mask"]]
+    # 最长的样本放在前面，探测的是最坏情况
+    longest = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    optimizer_bytes = _optimizer_state_bytes(model)
+
+    candidates = [2 ** k for k in range(effective_batch_size.bit_length()) if effective_batch_size % (2 ** k) == 0]
+    candidates = [size for size in candidates if size <= len(longest)] or [1]
+    probes = []
+    was_training = model.training
+    model.train()
+    for batch_size in candidates:
+        batch = default_data_collator([train_dataset[i] for i in longest[:batch_size]])
+        batch = {key: value.to(device) for key, value in batch.items()}
+        probe = {"batch_size": batch_size, "padded_seq_len": batch["input_ids"].shape[1]}
+        try:
+            with PeakMemoryMonitor(device) as monitor:
+                start = time.perf_counter()
+                with torch.autocast(device.type, dtype=torch.float16, enabled=mixed_precision):
+                    loss = model(**batch).loss
+                loss.backward()
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                step_s = time.perf_counter() - start
+        except RuntimeError as error:
+            if not _is_oom(error):
+                raise
+            probe.update({"fits": False, "oom": True})
+            probes.append(probe)
+            break
+        finally:
+            model.zero_grad(set_to_none=True)
+            del batch
+            _release_memory(device)
+
+        peak_bytes = monitor.peak_bytes + optimizer_bytes
+        probe.update({
+            "peak_bytes": peak_bytes,
+            "step_s": step_s,
+            "samples_per_s": batch_size / step_s if step_s > 0 else 0,
+            "fits": peak_bytes <= memory_budget,
+        })
+        probes.append(probe)
+        print(f"  micro-batch {batch_size:>3}: 峰值 {peak_bytes / 1024 ** 2:.0f} MiB, {probe['samples_per_s']:.1f} samples/s"
+              f"{'' if probe['fits'] else ' (超出预算)'}")
+        if not probe["fits"]:
+            break
+    model.train(was_training)
+
+    fitting = [probe["batch_size"] for probe in probes if probe["fits"]]
+    if not fitting:
+        raise RuntimeError(f"内存预算 {memory_budget / 1024 ** 2:.0f} MiB 内连 micro-batch 1 都放不下。")
+    micro_batch_size = max(fitting)
+    return {
+        "device": str(device),
+        "memory_budget_bytes": memory_budget,
+        "optimizer_state_bytes": optimizer_bytes,
+        "sequence_lengths": sequence_length_stats(lengths),
+        "micro_batch_size": micro_batch_size,
+        "gradient_accumulation_steps": effective_batch_size // micro_batch_size,
+        "effective_batch_size": effective_batch_size,
+        "probes": probes,
+    }
+
+
+# --- 评估 ---
+def generate_batch(model, tokenizer, prompts, **generate_kwargs):
+    """
+    Greedy-decodes `prompts` as one left-padded batch. Returns the decoded continuations and the
+    number of useful generated tokens (stop and padding tokens excluded).
+    """
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    try:
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True, max_length=2048, truncation=True).to(model.device)
+    finally:
+        tokenizer.padding_side = padding_side
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **generate_kwargs)
+
+    new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+    stop_ids = model.generation_config.eos_token_id
+    stop_ids = set(stop_ids if isinstance(stop_ids, (list, tuple)) else [stop_ids])
+    stop_ids.update({generate_kwargs.get("pad_token_id"), tokenizer.pad_token_id})
+    stop_ids.discard(None)
+    useful_tokens = int((~torch.isin(new_tokens, torch.tensor(sorted(stop_ids), device=new_tokens.device))).sum())
+    return tokenizer.batch_decode(new_tokens, skip_special_tokens=True), useful_tokens
+
+
+def plan_eval(model, tokenizer, prompts, memory_budget=None, candidates=EVAL_BATCH_CANDIDATES,
+              max_new_tokens=EVAL_MAX_NEW_TOKENS, seed=0):
+    """
+    Measures generation throughput for each candidate batch size on prompts sampled from the
+    eval set and returns the fastest one that fits `memory_budget`. Probes generate up to the same
+    `max_new_tokens` as evaluate_model, so the measured KV cache matches the real eval.
+    """
+    device = model.device
+    memory_budget = memory_budget or default_memory_budget(device)
+    rng = random.Random(seed)
+    generate_kwargs = dict(max_new_tokens=max_new_tokens, pad_token_id=tokenizer.eos_token_id, do_sample=False, top_p=None, top_k=None)
+    lengths = [len(tokenizer(prompt, max_length=2048, truncation=True)["input_ids"]) for prompt in prompts]
+
+    model.eval()
+    # 预热一次，避免第一个候选承担 kernel 初始化的开销
+    generate_batch(model, tokenizer, prompts[:1], **generate_kwargs)
+
+    probes = []
+    declining = 0
+    for batch_size in candidates:
+        if batch_size > len(prompts):
+            break
+        batch_prompts = rng.sample(prompts, batch_size)
+        probe = {"batch_size": batch_size}
+        try:
+            with PeakMemoryMonitor(device) as monitor:
+                start = time.perf_counter()
+                _, useful_tokens = generate_batch(model, tokenizer, batch_prompts, **generate_kwargs)
+                elapsed = time.perf_counter() - start
+        except RuntimeError as error:
+            if not _is_oom(error):
+                raise
+            probe.update({"fits": False, "oom": True})
+            probes.append(probe)
+            break
+        finally:
+            _release_memory(device)
+
+        probe.update({
+            "peak_bytes": monitor.peak_bytes,
+            "elapsed_s": elapsed,
+            "useful_tokens": useful_tokens,
+            "tokens_per_s": useful_tokens / elapsed if elapsed > 0 else 0,
+            "fits": monitor.peak_bytes <= memory_budget,
+        })
+        probes.append(probe)
+        print(f"  eval batch {batch_size:>3}: 峰值 {monitor.peak_bytes / 1024 ** 2:.0f} MiB, {probe['tokens_per_s']:.1f} tokens/s"
+              f"{'' if probe['fits'] else ' (超出预算)'}")
+        if not probe["fits"]:
+            break
+        best = max(p["tokens_per_s"] for p in probes if p["fits"])
+        # 吞吐连续两次下降就不再尝试更大的 batch
+        declining = declining + 1 if probe["tokens_per_s"] < best else 0
+        if declining >= 2:
+            break
+
+    fitting = [probe for probe in probes if probe["fits"]]
+    chosen = max(fitting, key=lambda probe: probe["tokens_per_s"]) if fitting else {"batch_size": 1}
+    return {
+        "device": str(device),
+        "memory_budget_bytes": memory_budget,
+        "prompt_lengths": sequence_length_stats(lengths),
+        "max_new_tokens": max_new_tokens,
+        "batch_size": chosen["batch_size"],
+        "probes": probes,
+    }
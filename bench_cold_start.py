@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+冷启动基准：每次在新进程里测 import 时间、模型加载时间和首 token 时间，
+对比默认的 from_pretrained(...).to(device) 与 fast_load.load_model_fast (不带 / 带 dtype 快照)。
+
+用法:
+    python bench_cold_start.py --model_path ./models/merged_gemma_lora --repeats 3
+
+注意：文件页缓存是热的 (没有 root 权限无法清空)，测到的是 worker 重启的场景。
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# 这个脚本顶层不能 import torch/transformers，否则子进程测不到真实的 import 开销
+BENCH_START = time.perf_counter()
+
+MODEL_PATH = "./models/merged_gemma_lora"
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "cold_start_benchmark.json")
+MODES = ["standard", "fast", "fast_snapshot"]
+
+
+def run_child(mode, model_path, prompt_file):
+    """Runs in a fresh interpreter and prints one JSON line of timings."""
+    project_root = os.path.dirname(os.path.abspath(__file__))
+    if project_root not in sys.path:
+        sys.path.append(project_root)
+
+    start = time.perf_counter()
+    import torch
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+    import_time = time.perf_counter() - start
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+
+    start = time.perf_counter()
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    load_details = {}
+    if mode == "standard":
+        model = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True, torch_dtype=dtype).to(device)
+    else:
+        from fast_load import load_model_fast
+        model = load_model_fast(model_path, device=device, dtype=dtype, use_snapshot=mode == "fast_snapshot", timings=load_details)
+    model.eval()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    load_time = time.perf_counter() - start
+
+    from data_io import iter_rows
+    prompt = next(iter_rows(prompt_file, batch_size=1, columns=["text"]))["text"]
+    start = time.perf_counter()
+    inputs = tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=1, do_sample=False, top_p=None, top_k=None, pad_token_id=tokenizer.eos_token_id)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    first_token_time = time.perf_counter() - start
+
+    print(json.dumps({
+        "import_s": import_time,
+        "load_s": load_time,
+        "first_token_s": first_token_time,
+        "time_to_first_token_s": time.perf_counter() - BENCH_START,
+        "load_details": load_details,
+    }))
+
+
+def benchmark(model_path, prompt_file, repeats):
+    results = {}
+    for mode in MODES:
+        runs = []
+        for i in range(repeats):
+            start = time.perf_counter()
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", mode, "--model_path", model_path, "--prompt_file", prompt_file],
+                capture_output=True, text=True, check=True,
+            )
+            run = json.loads(completed.stdout.strip().splitlines()[-1])
+            run["process_wall_s"] = time.perf_counter() - start
+            runs.append(run)
+            print(f"  {mode} #{i + 1}: import {run['import_s']:.2f}s, load {run['load_s']:.2f}s, "
+                  f"first token {run['first_token_s']:.2f}s, wall {run['process_wall_s']:.2f}s")
+
+        results[mode] = {
+            metric: statistics.median(run[metric] for run in runs)
+            for metric in ["import_s", "load_s", "first_token_s", "time_to_first_token_s", "process_wall_s"]
+        }
+        results[mode]["runs"] = runs
+
+    results["load_speedup"] = results["standard"]["load_s"] / results["fast"]["load_s"] if results["fast"]["load_s"] > 0 else 0
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold-start benchmark: import, model load and first-token time in fresh processes.")
+    parser.add_argument("--model_path", type=str, default=MODEL_PATH, help="Model directory to load.")
+    parser.add_argument("--prompt_file", type=str, default=PROMPT_VAL_FILE, help="Parquet or CSV file whose first row's text is used as the prompt.")
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh processes per loading mode.")
+    parser.add_argument("--child", type=str, default=None, choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.model_path, args.prompt_file)
+        sys.exit(0)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    print("=" * 30)
+    print(f"🚀 冷启动基准: {args.model_path} ({args.repeats} 次/模式)")
+    print("=" * 30)
+    summary = benchmark(args.model_path, args.prompt_file, args.repeats)
+
+    print("\n--- Cold Start Summary (median) ---")
+    for mode in MODES:
+        print(f"{mode:>13}: import {summary[mode]['import_s']:.2f}s | load {summary[mode]['load_s']:.2f}s | "
+              f"first token {summary[mode]['first_token_s']:.2f}s | total {summary[mode]['time_to_first_token_s']:.2f}s")
+    print(f"load speedup: {summary['load_speedup']:.2f}x")
+
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"\n✅ Benchmark saved to {RESULTS_FILE}")
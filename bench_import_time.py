@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+import 时间基准：在新进程里用 `python -X importtime` 导入 1~7 号脚本 (不执行 __main__)，
+再测一次 `脚本 --help` 的总耗时。列出每个脚本 import 开销最大的顶层包，
+并和上一次保存的结果对比，防止有人又把 torch/transformers 或模型加载放回模块顶层。
+
+用法:
+    python bench_import_time.py --repeats 3
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = [
+    "1.generate_data.py",
+    "2.split_data.py",
+    "3.run_evaluation.py",
+    "4.train_lora.py",
+    "5.eval_lora.py",
+    "6.merge_base_lora.py",
+    "7.push_to_hub.py",
+]
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "import_time_benchmark.json")
+TOP_PACKAGES = 5
+
+# import time: self [us] | cumulative | imported package
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def parse_importtime(stderr):
+    """Total import time (us) and {top-level package: cumulative us} from `-X importtime` output."""
+    total_us, packages = 0, {}
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match.group(1)), int(match.group(2)), match.group(3), match.group(4)
+        total_us += self_us
+        # 缩进一级 (1 个空格) 的是被直接 import 的模块，累计时间已包含它的子模块
+        if len(indent) == 1:
+            package = name.split(".")[0]
+            packages[package] = packages.get(package, 0) + cumulative_us
+    return total_us, packages
+
+
+def measure_script(script):
+    code = f"import sys; sys.path.insert(0, {project_root!r}); from utils import load_script; load_script({script!r})"
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True)
+    total_us, packages = parse_importtime(completed.stderr)
+
+    # 2 没有命令行参数，--help 会直接执行脚本本身，只测 import
+    with open(os.path.join(project_root, script), "r", encoding="utf-8") as f:
+        has_cli = "argparse" in f.read()
+    help_s = None
+    if has_cli:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(project_root, script), "--help"], capture_output=True, stdin=subprocess.DEVNULL, check=True)
+        help_s = time.perf_counter() - start
+    return {"import_s": total_us / 1e6, "help_wall_s": help_s, "packages_s": {k: v / 1e6 for k, v in packages.items()}}
+
+
+def benchmark(repeats):
+    results = {}
+    for script in SCRIPTS:
+        runs = [measure_script(script) for _ in range(repeats)]
+        top = sorted(runs[-1]["packages_s"].items(), key=lambda item: item[1], reverse=True)[:TOP_PACKAGES]
+        results[script] = {
+            "import_s": statistics.median(run["import_s"] for run in runs),
+            "help_wall_s": statistics.median(run["help_wall_s"] for run in runs) if runs[0]["help_wall_s"] is not None else None,
+            "top_packages": dict(top),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import-time benchmark of the numbered pipeline scripts.")
+    parser.add_argument("--repeats", type=int, default=3, help="Fresh processes per script.")
+    args = parser.parse_args()
+
+    previous = None
+    if os.path.exists(RESULTS_FILE):
+        with open(RESULTS_FILE, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    print("=" * 30)
+    print(f"🚀 import 时间基准 ({args.repeats} 次/脚本)")
+    print("=" * 30)
+    summary = benchmark(args.repeats)
+
+    print("\n--- Import Time Summary (median) ---")
+    for script, result in summary.items():
+        line = f"{script:<22} import {result['import_s']:.3f}s"
+        if result["help_wall_s"] is not None:
+            line += f" | --help {result['help_wall_s']:.3f}s"
+        if previous and script in previous:
+            line += f" (上次 import {previous[script]['import_s']:.3f}s)"
+        print(line)
+        top = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in result["top_packages"].items())
+        print(f"{'':<22} {top}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"\n✅ Benchmark saved to {RESULTS_FILE}")
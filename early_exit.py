@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Early-exit 解码。
+
+工具调用输出里大部分 token 几乎是确定的：JSON 标点、键名、工具名第一个子词之后的部分。这些 token
+不需要跑完所有层。这里在若干中间层后面挂轻量的 exit head (一个零初始化的残差线性层 + 最终 RMSNorm
+的拷贝，再接共享的 tied LM head)，用 generate_data 生成的训练数据做自蒸馏：冻结模型，只训练 head，
+让中间层的分布逼近完整模型在答案位置上的分布。
+
+解码时逐层前进，到达 exit 层时如果 head 的最大概率超过阈值，就直接输出这个 token，不再计算更深的层。
+被跳过的层的 KV 不立即补算：这些位置的隐藏状态先挂起，下一个需要走到更深层的 token 经过某一层时，
+把挂起位置和当前 token 拼成一个 chunk 一起算，顺带补上这一层的 KV (lazy KV fill)。
+因为挂起的总是最近的若干位置，每层缓存始终是连续的前缀，chunk 直接接在后面。
+
+训练:
+    python early_exit.py --model_path ./models/merged_gemma_lora --num_samples 1000
+评估 (各阈值下的准确率 / 延迟权衡，默认在 head 训练时的模型上评估):
+    python 3.run_evaluation.py --early_exit_heads ./checkpoints/exit_heads
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from safetensors.torch import save_file, load_file
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from data_io import read_table
+
+MODEL_PATH = "./models/merged_gemma_lora"
+PROMPT_TRAIN_FILE = "./data/train.parquet"
+EXIT_HEADS_DIR = "./checkpoints/exit_heads"
+EXIT_HEADS_WEIGHTS_NAME = "exit_heads.safetensors"
+EXIT_HEADS_CONFIG_NAME = "exit_heads_config.json"
+# 默认在 1/4、1/2、3/4 深度处放 exit head
+DEFAULT_EXIT_FRACTIONS = (0.25, 0.5, 0.75)
+DEFAULT_THRESHOLDS = [0.99, 0.95, 0.9, 0.8]
+
+
+def default_exit_layers(num_layers):
+    return sorted({max(0, min(num_layers - 2, round(num_layers * fraction) - 1)) for fraction in DEFAULT_EXIT_FRACTIONS})
+
+
+def _final_logits(model, normed_hidden):
+    logits = model.lm_head(normed_hidden.to(model.lm_head.weight.dtype))
+    softcap = getattr(model.config, "final_logit_softcapping", None)
+    if softcap is not None:
+        logits = torch.tanh(logits / softcap) * softcap
+    return logits
+
+
+# --- exit heads ---
+class ExitHead(torch.nn.Module):
+    """Zero-initialised residual projection + a copy of the final norm; logits come from the shared LM head."""
+
+    def __init__(self, final_norm):
+        super().__init__()
+        hidden_size = final_norm.weight.shape[0]
+        self.proj = torch.nn.Linear(hidden_size, hidden_size, bias=False)
+        torch.nn.init.zeros_(self.proj.weight)
+        self.norm = copy.deepcopy(final_norm).float()
+
+    def forward(self, hidden, model):
+        hidden = hidden.float()
+        return _final_logits(model, self.norm(hidden + self.proj(hidden)))
+
+
+class ExitHeads(torch.nn.ModuleDict):
+    def __init__(self, model, exit_layers):
+        final_norm = model.model.norm
+        super().__init__({str(layer): ExitHead(final_norm) for layer in exit_layers})
+        self.exit_layers = sorted(exit_layers)
+        self.to(final_norm.weight.device)
+
+
+def _weights_fingerprint(model_dir):
+    """Size and mtime of the model's weight files; they change whenever the model is re-merged."""
+    fingerprint = {}
+    for file_name in sorted(os.listdir(model_dir)):
+        if file_name.endswith(".safetensors"):
+            stat = os.stat(os.path.join(model_dir, file_name))
+            fingerprint[file_name] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def exit_heads_source_model(heads_dir):
+    """The model path the heads were trained on, or None for heads saved without it."""
+    with open(os.path.join(heads_dir, EXIT_HEADS_CONFIG_NAME), "r", encoding="utf-8") as f:
+        return json.load(f).get("source_model_path")
+
+
+def save_exit_heads(heads, output_dir, model, model_path, train_stats=None):
+    os.makedirs(output_dir, exist_ok=True)
+    save_file({name: tensor.contiguous() for name, tensor in heads.state_dict().items()}, os.path.join(output_dir, EXIT_HEADS_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, EXIT_HEADS_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump({
+            "exit_layers": heads.exit_layers,
+            "num_hidden_layers": model.config.num_hidden_layers,
+            "hidden_size": model.config.hidden_size,
+            "source_model_path": model_path,
+            "source_weights": _weights_fingerprint(model_path),
+            "train_stats": train_stats or {},
+        }, f, indent=2)
+
+
+def load_exit_heads(heads_dir, model, model_path=None):
+    """
+    Loads heads for `model`. With `model_path`, refuses heads trained on a different model (base and
+    merged models have the same shape, so the shape check alone cannot tell) and warns when the
+    weights changed since training.
+    """
+    with open(os.path.join(heads_dir, EXIT_HEADS_CONFIG_NAME), "r", encoding="utf-8") as f:
+        config = json.load(f)
+    if (config["num_hidden_layers"], config["hidden_size"]) != (model.config.num_hidden_layers, model.config.hidden_size):
+        raise ValueError(f"exit head 是为 {config['num_hidden_layers']} 层 / hidden {config['hidden_size']} 的模型训练的，与当前模型不匹配。")
+    source_model_path = config.get("source_model_path")
+    if model_path is not None and source_model_path is None:
+        print(f"⚠️ 警告: {heads_dir} 没有记录训练时的模型，无法确认与 {model_path} 匹配")
+    elif model_path is not None:
+        if os.path.abspath(model_path) != os.path.abspath(source_model_path):
+            raise ValueError(f"exit head 是在 {source_model_path} 上训练的，不能用于 {model_path}。")
+        if config.get("source_weights") != _weights_fingerprint(model_path):
+            print(f"⚠️ 警告: {model_path} 的权重在训练 exit head 之后改变过，退出率可能没有意义，建议重新训练")
+    heads = ExitHeads(model, config["exit_layers"])
+    heads.load_state_dict(load_file(os.path.join(heads_dir, EXIT_HEADS_WEIGHTS_NAME), device=str(model.lm_head.weight.device)))
+    heads.eval()
+    return heads
+
+
+# --- 训练 ---
+def train_exit_heads(model, tokenizer, samples, exit_layers, epochs=1, learning_rate=1e-3):
+    """
+    Self-distillation of the frozen model: each head minimises KL(full model || head) on the answer
+    positions of (prompt, label) samples. Returns (heads, stats with per-layer top-1 agreement).
+    """
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    heads = ExitHeads(model, exit_layers)
+    heads.train()
+    optimizer = torch.optim.AdamW(heads.parameters(), lr=learning_rate)
+    agreement = {layer: [0, 0] for layer in exit_layers}
+    total_loss, steps = 0.0, 0
+
+    for epoch in range(epochs):
+        for prompt, label in samples:
+            # 和评估时的输入保持一致：prompt 带 BOS，答案后接 EOS
+            prompt_ids = tokenizer(prompt, max_length=2048, truncation=True)["input_ids"]
+            answer_ids = tokenizer(label, add_special_tokens=False)["input_ids"] + [tokenizer.eos_token_id]
+            input_ids = torch.tensor([prompt_ids + answer_ids], device=model.device)
+            answer = slice(len(prompt_ids) - 1, input_ids.shape[1] - 1)
+            with torch.no_grad():
+                outputs = model(input_ids=input_ids, output_hidden_states=True)
+                teacher = F.log_softmax(outputs.logits[0, answer].float(), dim=-1)
+
+            loss = 0.0
+            for layer in exit_layers:
+                # hidden_states[i + 1] 是第 i 层的输出
+                student = F.log_softmax(heads[str(layer)](outputs.hidden_states[layer + 1][0, answer], model).float(), dim=-1)
+                loss = loss + F.kl_div(student, teacher, log_target=True, reduction="batchmean")
+                if epoch == epochs - 1:
+                    agreement[layer][0] += int((student.argmax(-1) == teacher.argmax(-1)).sum())
+                    agreement[layer][1] += student.shape[0]
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+            total_loss += loss.item()
+            steps += 1
+        print(f"  epoch {epoch + 1}/{epochs}: 平均 loss {total_loss / max(steps, 1):.4f}")
+
+    heads.eval()
+    stats = {
+        "samples": len(samples),
+        "epochs": epochs,
+        "mean_loss": total_loss / max(steps, 1),
+        "top1_agreement": {str(layer): hits / total if total else 0 for layer, (hits, total) in agreement.items()},
+    }
+    return heads, stats
+
+
+# --- 解码 ---
+class EarlyExitStats:
+    def __init__(self, exit_layers, num_layers):
+        self.exit_layers = exit_layers
+        self.num_layers = num_layers
+        self.reset()
+
+    def reset(self):
+        self.tokens = 0
+        self.exits = {layer: 0 for layer in self.exit_layers}
+        self.layer_evals = 0  # 所有 chunk 中 (位置 × 层) 的总数，包括补算的 KV
+
+    def summary(self):
+        exited = sum(self.exits.values())
+        depth = sum((layer + 1) * count for layer, count in self.exits.items()) + (self.tokens - exited) * self.num_layers
+        return {
+            "decoded_tokens": self.tokens,
+            "exit_rate": exited / self.tokens if self.tokens else 0,
+            "exits_per_layer": {str(layer): count for layer, count in self.exits.items()},
+            "avg_emit_depth": depth / (self.tokens * self.num_layers) if self.tokens else 0,
+            "layer_evals_per_token": self.layer_evals / (self.tokens * self.num_layers) if self.tokens else 0,
+        }
+
+
+class EarlyExitDecoder:
+    """
+    Greedy decoding (batch 1) that emits a token at the first exit layer whose head is at least
+    `threshold` confident. The prompt and the first token always use the full model.
+    """
+
+    def __init__(self, model, heads, threshold):
+        self.model = model
+        self.heads = heads
+        self.threshold = threshold
+        # 置信度是 softmax 概率，不会超过 1：阈值 > 1 (例如 inf 基准) 永远不会退出，不必算 head。
+        # head 共享 lm_head，在大词表上一次投影比整个 decoder 还贵，算了会让全深度基准虚高
+        self.evaluate_heads = threshold <= 1.0
+        self.layers = model.model.layers
+        self.sliding_window = getattr(model.config, "sliding_window", None)
+        self.stats = EarlyExitStats(heads.exit_layers, len(self.layers))
+
+    def _mask(self, start, length, is_sliding, dtype, device):
+        query = torch.arange(start, start + length, device=device)[:, None]
+        key = torch.arange(start + length, device=device)[None, :]
+        allowed = key <= query
+        if is_sliding and self.sliding_window:
+            allowed &= (query - key) < self.sliding_window
+        mask = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill(~allowed, torch.finfo(dtype).min)
+        return mask[None, None]
+
+    def _step(self, cache, pending, token_id):
+        """Runs one new token layer by layer; returns (next token id, exit layer or None)."""
+        decoder = self.model.model
+        hidden = decoder.embed_tokens(token_id.view(1, 1))
+        for index, layer in enumerate(self.layers):
+            # 挂起位置的 exit 层都比 index 小，并且都停在 index - 1 层：和当前 token 一起算这一层
+            chunk = [entry for entry in pending if entry[1] < index]
+            states = torch.cat([entry[0] for entry in chunk] + [hidden], dim=1) if chunk else hidden
+            start = cache.get_seq_length(index)
+            positions = torch.arange(start, start + states.shape[1], device=states.device)
+            outputs = layer(
+                states,
+                position_embeddings_global=decoder.rotary_emb(states, positions[None]),
+                position_embeddings_local=decoder.rotary_emb_local(states, positions[None]),
+                attention_mask=self._mask(start, states.shape[1], layer.attention_type == "sliding_attention", states.dtype, states.device),
+                position_ids=positions[None],
+                past_key_value=cache,
+                use_cache=True,
+                cache_position=positions,
+            )
+            states = outputs[0] if isinstance(outputs, tuple) else outputs
+            self.stats.layer_evals += states.shape[1]
+            for offset, entry in enumerate(chunk):
+                entry[0], entry[1] = states[:, offset:offset + 1], index
+            hidden = states[:, -1:]
+
+            if self.evaluate_heads and str(index) in self.heads:
+                probs = F.softmax(self.heads[str(index)](hidden[0, -1], self.model).float(), dim=-1)
+                confidence, next_id = probs.max(dim=-1)
+                if confidence >= self.threshold:
+                    pending.append([hidden, index])
+                    return next_id, index
+
+        pending.clear()
+        return _final_logits(self.model, decoder.norm(hidden[0, -1])).argmax(dim=-1), None
+
+    @torch.no_grad()
+    def generate(self, input_ids, max_new_tokens, stop_token_ids):
+        cache = DynamicCache()
+        outputs = self.model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+        token_id = outputs.logits[0, -1].argmax(dim=-1)
+        generated = [token_id]
+        pending = []
+        while len(generated) < max_new_tokens and int(token_id) not in stop_token_ids:
+            token_id, exit_layer = self._step(cache, pending, token_id)
+            generated.append(token_id)
+            self.stats.tokens += 1
+            if exit_layer is not None:
+                self.stats.exits[exit_layer] += 1
+        return torch.cat([input_ids, torch.stack(generated).view(1, -1)], dim=1)
+
+
+def stop_token_ids(model, tokenizer):
+    ids = model.generation_config.eos_token_id
+    ids = set(ids if isinstance(ids, (list, tuple)) else [ids])
+    ids.add(tokenizer.eos_token_id)
+    ids.discard(None)
+    return ids
+
+
+def summarize_thresholds(full_summary, threshold_summaries):
+    """Accuracy deltas and latency speedup of each threshold against full-depth decoding through the same loop."""
+    metrics = ["exact_match_rate", "tool_name_accuracy", "average_argument_f1"]
+    rows = []
+    for threshold, summary in threshold_summaries:
+        rows.append({
+            "threshold": threshold,
+            **{metric: summary[metric] for metric in metrics},
+            "accuracy_deltas": {metric: summary[metric] - full_summary[metric] for metric in metrics},
+            "average_latency_ms": summary["average_latency_ms"],
+            "latency_speedup": full_summary["average_latency_ms"] / summary["average_latency_ms"] if summary["average_latency_ms"] > 0 else 0,
+            **summary["early_exit"],
+        })
+    return {"full_depth": full_summary, "thresholds": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train early-exit heads by self-distillation of the frozen model.")
+    parser.add_argument("--model_path", type=str, default=MODEL_PATH, help="Model the heads are attached to.")
+    parser.add_argument("--output_dir", type=str, default=EXIT_HEADS_DIR, help="Where to save the heads.")
+    parser.add_argument("--exit_layers", type=int, nargs="*", default=None, help="0-based layers followed by an exit head. Defaults to 1/4, 1/2 and 3/4 depth.")
+    parser.add_argument("--num_samples", type=int, default=1000, help="Training rows from the generated data.")
+    parser.add_argument("--epochs", type=int, default=1, help="Passes over the samples.")
+    parser.add_argument("--learning_rate", type=float, default=1e-3, help="AdamW learning rate for the heads.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(args.model_path, trust_remote_code=True).to(device)
+    exit_layers = args.exit_layers or default_exit_layers(model.config.num_hidden_layers)
+
+    df = read_table(PROMPT_TRAIN_FILE, columns=["text", "label"]).head(args.num_samples)
+    samples = list(zip(df["text"], df["label"]))
+    print(f"🚀 在第 {exit_layers} 层训练 exit head ({len(samples)} 条样本)...")
+    start = time.perf_counter()
+    heads, stats = train_exit_heads(model, tokenizer, samples, exit_layers, epochs=args.epochs, learning_rate=args.learning_rate)
+    stats["train_time_s"] = time.perf_counter() - start
+    save_exit_heads(heads, args.output_dir, model, args.model_path, stats)
+    print(json.dumps(stats, indent=2))
+    print(f"✅ exit head 已保存至: {args.output_dir}")
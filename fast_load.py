@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+快速加载模型。
+
+`from_pretrained(...).to(device)` 会先随机初始化全部权重、再从 safetensors 拷贝、再做一次 dtype
+转换。这里改为：
+  1. 参数建在 meta 设备上 (不分配内存、不做随机初始化)，buffer 正常创建；
+  2. safetensors 用 torch.from_file 私有映射，张量直接指向文件页 (零拷贝)，用 assign 挂到模型上；
+  3. 只在 dtype 不一致时才转换；`use_snapshot=True` 时 (默认关闭，快照和模型一样大) 在
+     ./cached/fast_load/ 下保存一份已转换好目标 dtype、去掉 tied 重复权重的快照，之后的加载完全
+     不需要转换。快照放在模型目录之外，不会混进 models/ 或被推送。
+"""
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+import torch
+from transformers import AutoConfig, AutoModelForCausalLM, GenerationConfig
+
+SNAPSHOT_CACHE_DIR = "./cached/fast_load"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+DTYPE_NAMES = {dtype: name for name, dtype in SAFETENSORS_DTYPES.items()}
+
+
+@contextmanager
+def empty_parameters():
+    """Registers parameters on the meta device so construction allocates and initializes nothing."""
+    register_parameter = torch.nn.Module.register_parameter
+
+    def _register_on_meta(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            param_cls = type(module._parameters[name])
+            module._parameters[name] = param_cls(module._parameters[name].to("meta"), requires_grad=param.requires_grad)
+
+    torch.nn.Module.register_parameter = _register_on_meta
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def mmap_safetensors(path):
+    """
+    Maps a safetensors file copy-on-write and returns {name: tensor} views into it. Pages are
+    only read when touched, and nothing is copied unless a tensor is written to.
+    """
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+
+    storage = torch.from_file(path, shared=False, size=os.path.getsize(path), dtype=torch.uint8)
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        raw = storage[data_start + start:data_start + end]
+        if (data_start + start) % dtype.itemsize != 0:
+            # 未对齐时无法直接 view 成目标 dtype，退化为拷贝
+            raw = raw.clone()
+        tensors[name] = raw.view(dtype).view(info["shape"])
+    return tensors
+
+
+def _weight_files(model_dir):
+    index_file = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    return [os.path.join(model_dir, "model.safetensors")]
+
+
+def _fingerprint(model_dir):
+    """Size and mtime of the source weights; a snapshot is stale when these change."""
+    fingerprint = {}
+    for path in _weight_files(model_dir) + [os.path.join(model_dir, "config.json")]:
+        stat = os.stat(path)
+        fingerprint[os.path.basename(path)] = [stat.st_size, int(stat.st_mtime)]
+    return fingerprint
+
+
+def snapshot_path(model_dir, dtype):
+    """One cache entry per model directory (keyed by its absolute path) and dtype."""
+    model_dir = os.path.abspath(model_dir)
+    entry = f"{os.path.basename(model_dir)}-{hashlib.sha1(model_dir.encode('utf-8')).hexdigest()[:12]}"
+    return os.path.join(SNAPSHOT_CACHE_DIR, entry, f"model-{DTYPE_NAMES[dtype].lower()}.safetensors")
+
+
+def _snapshot_is_fresh(model_dir, dtype):
+    meta_file = snapshot_path(model_dir, dtype) + ".json"
+    if not os.path.exists(meta_file) or not os.path.exists(snapshot_path(model_dir, dtype)):
+        return False
+    with open(meta_file, "r", encoding="utf-8") as f:
+        return json.load(f).get("source") == _fingerprint(model_dir)
+
+
+def save_snapshot(model, model_dir, dtype):
+    """Saves the already-converted weights (tied tensors stored once) under SNAPSHOT_CACHE_DIR."""
+    from safetensors.torch import save_file
+
+    path = snapshot_path(model_dir, dtype)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state_dict = {
+        name: param.detach().contiguous() for name, param in model.named_parameters(remove_duplicate=True)
+    }
+    for name, buffer in model.named_buffers():
+        if name in model.state_dict():
+            state_dict[name] = buffer.detach().contiguous()
+    save_file(state_dict, path, metadata={"format": "pt"})
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump({"dtype": DTYPE_NAMES[dtype], "source": _fingerprint(model_dir)}, f, indent=2)
+
+
+def load_model_fast(model_dir, device="cpu", dtype=None, use_snapshot=False, timings=None):
+    """
+    Drop-in replacement for `AutoModelForCausalLM.from_pretrained(model_dir, torch_dtype=dtype).to(device)`.
+    `dtype=None` keeps the checkpoint dtype. `use_snapshot` reads (and, after a dtype conversion, writes)
+    a converted copy under SNAPSHOT_CACHE_DIR. `timings`, if given, receives per-phase seconds.
+    """
+    start = time.perf_counter()
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    dtype = dtype or getattr(config, "torch_dtype", None) or torch.float32
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+
+    with empty_parameters():
+        model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=dtype)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from_snapshot = use_snapshot and _snapshot_is_fresh(model_dir, dtype)
+    if from_snapshot:
+        state_dict = mmap_safetensors(snapshot_path(model_dir, dtype))
+    else:
+        state_dict = {}
+        for path in _weight_files(model_dir):
+            state_dict.update(mmap_safetensors(path))
+
+    cast_count = 0
+    for name, tensor in state_dict.items():
+        if tensor.is_floating_point() and tensor.dtype != dtype:
+            state_dict[name] = tensor.to(dtype)
+            cast_count += 1
+
+    model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+    still_missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+    if still_missing:
+        raise ValueError(f"权重文件中缺少参数: {still_missing[:5]}")
+    if os.path.exists(os.path.join(model_dir, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+    model.eval()
+    load_time = time.perf_counter() - start
+
+    # 只有真的做了 dtype 转换时才值得保存快照
+    if use_snapshot and not from_snapshot and cast_count > 0:
+        try:
+            save_snapshot(model, model_dir, dtype)
+        except OSError as e:
+            print(f"⚠️ 警告: 无法写入快速加载快照 ({e})，下次仍从原始权重加载。")
+
+    start = time.perf_counter()
+    model = model.to(device)
+    move_time = time.perf_counter() - start
+
+    if timings is not None:
+        timings.update({
+            "build_s": build_time,
+            "load_s": load_time,
+            "move_s": move_time,
+            "from_snapshot": from_snapshot,
+            "cast_tensors": cast_count,
+        })
+    return model
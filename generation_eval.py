@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+训练过程中的生成评估。
+
+Trainer 只看 loss，argument F1 要等训练结束、5.eval_lora.py 单独跑一遍才知道。这里在训练中按固定步数
+(或每个 epoch) 用内存里的模型，对 test 集按工具分层抽出的固定子集做 batch greedy 生成，
+计算和 evaluate_model 相同的 exact match / 工具准确率 / 参数 F1。结果写进 Trainer 的 log_history
+和 output_dir/generation_eval_history.json。
+
+指标创新高时把 adapter 存到 output_dir/best_adapter；连续 `early_stopping_patience` 次没有提升就停止训练。
+
+用法:
+    python 4.train_lora.py --gen_eval --gen_eval_steps 50 --early_stopping_patience 3
+"""
+import os
+import sys
+import json
+import random
+from transformers import TrainerCallback
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from utils import load_script, EVAL_MAX_NEW_TOKENS
+from data_io import read_table
+
+DEFAULT_EVAL_PER_TOOL = 4
+DEFAULT_METRIC = "average_argument_f1"
+BEST_ADAPTER_DIR_NAME = "best_adapter"
+HISTORY_FILE_NAME = "generation_eval_history.json"
+
+
+def stratified_subsample(val_file, per_tool, seed=0):
+    """Up to `per_tool` (prompt, label_json) rows for every labelled tool."""
+    df = read_table(val_file, columns=["text", "label"])
+    by_tool = {}
+    for prompt, label in zip(df["text"], df["label"]):
+        try:
+            label_json = json.loads(label.split("：", 1)[1])
+        except (json.JSONDecodeError, IndexError):
+            continue
+        by_tool.setdefault(label_json.get("tool_name"), []).append((prompt, label_json))
+    rng = random.Random(seed)
+    samples = []
+    for rows in by_tool.values():
+        samples.extend(rng.sample(rows, min(per_tool, len(rows))))
+    return samples
+
+
+def quick_generation_eval(model, tokenizer, samples, batch_size=8):
+    """
+    Greedy-decodes the subsample in left-padded batches and scores each row with evaluate_model's
+    score_prediction. Tokenization and generation settings are the same as evaluate_model's (BOS
+    included), so the numbers are comparable with 5.eval_lora.py's report.
+    """
+    from batch_planner import generate_batch
+    evaluator = load_script("3.run_evaluation.py")
+
+    was_training = model.training
+    use_cache = model.config.use_cache
+    model.eval()
+    model.config.use_cache = True
+    generate_kwargs = dict(
+        max_new_tokens=EVAL_MAX_NEW_TOKENS,
+        pad_token_id=tokenizer.eos_token_id,
+        do_sample=False,
+        top_p=None,
+        top_k=None
+    )
+    results = []
+    try:
+        for i in range(0, len(samples), batch_size):
+            batch = samples[i:i + batch_size]
+            texts, _ = generate_batch(model, tokenizer, [prompt for prompt, _ in batch], **generate_kwargs)
+            results.extend(evaluator.score_prediction(prompt, true_json, text) for text, (prompt, true_json) in zip(texts, batch))
+    finally:
+        model.config.use_cache = use_cache
+        if was_training:
+            model.train()
+
+    total = len(results) or 1
+    return {
+        "exact_match_rate": sum(result["exact_match"] for result in results) / total,
+        "tool_name_accuracy": sum(result["tool_name_match"] for result in results) / total,
+        "average_argument_precision": sum(result["arg_precision"] for result in results) / total,
+        "average_argument_recall": sum(result["arg_recall"] for result in results) / total,
+        "average_argument_f1": sum(result["arg_f1"] for result in results) / total,
+    }
+
+
+class GenerationEvalCallback(TrainerCallback):
+    """
+    Runs quick_generation_eval every `eval_steps` optimizer steps (every epoch if None), keeps the
+    adapter with the best `metric` and optionally stops after `early_stopping_patience` evals
+    without improvement.
+    """
+
+    def __init__(self, tokenizer, samples, output_dir, eval_steps=None, metric=DEFAULT_METRIC,
+                 early_stopping_patience=None, batch_size=8):
+        self.tokenizer = tokenizer
+        self.samples = samples
+        self.output_dir = output_dir
+        self.eval_steps = eval_steps
+        self.metric = metric
+        self.early_stopping_patience = early_stopping_patience
+        self.batch_size = batch_size
+        self.history = []
+        self.best = None
+        self.evals_without_improvement = 0
+
+    def _evaluate(self, state, control, model):
+        metrics = quick_generation_eval(model, self.tokenizer, self.samples, batch_size=self.batch_size)
+        record = {"step": state.global_step, "epoch": state.epoch, **metrics}
+        self.history.append(record)
+        state.log_history.append({"epoch": state.epoch, "step": state.global_step, **{f"gen_eval_{name}": value for name, value in metrics.items()}})
+
+        score = metrics[self.metric]
+        improved = self.best is None or score > self.best[self.metric]
+        print(f"📊 step {state.global_step}: exact {metrics['exact_match_rate']:.3f} | tool {metrics['tool_name_accuracy']:.3f} | "
+              f"arg F1 {metrics['average_argument_f1']:.3f}{' ⭐' if improved else ''}")
+        if improved:
+            self.best = record
+            self.evals_without_improvement = 0
+            best_dir = os.path.join(self.output_dir, BEST_ADAPTER_DIR_NAME)
+            model.save_pretrained(best_dir)
+            with open(os.path.join(best_dir, "generation_eval.json"), "w", encoding="utf-8") as f:
+                json.dump(record, f, indent=2)
+            state.best_metric = score
+            state.best_model_checkpoint = best_dir
+        else:
+            self.evals_without_improvement += 1
+            if self.early_stopping_patience and self.evals_without_improvement >= self.early_stopping_patience:
+                print(f"✂️ {self.metric} 连续 {self.evals_without_improvement} 次评估没有提升，提前停止训练")
+                control.should_training_stop = True
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, HISTORY_FILE_NAME), "w", encoding="utf-8") as f:
+            json.dump({"metric": self.metric, "best": self.best, "history": self.history}, f, indent=2)
+        return control
+
+    def on_step_end(self, args, state, control, model=None, **kwargs):
+        if self.eval_steps and state.global_step % self.eval_steps == 0:
+            return self._evaluate(state, control, model)
+        return control
+
+    def on_epoch_end(self, args, state, control, model=None, **kwargs):
+        if not self.eval_steps:
+            return self._evaluate(state, control, model)
+        return control
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+LoRA 超参数搜索。
+
+4.train_lora.py 里的 LORA_R / LORA_ALPHA / LORA_TARGET_MODULES / 学习率 / epoch 都是模块常量，每个搜索点都要手改一次
+再单独跑。这里按 grid 或 random 规格生成 trial，放到多个 worker 进程里并行训练，每个 worker 分到
+cpu_count / workers 个线程。所有 trial 共用 ./cached 下 memory-mapped 的 tokenized 数据集。
+
+每个 epoch 结束时在按工具分层抽样的小测试集上做一次生成评估 (exact match)，并把分数报告到共享表里。
+某个 trial 的分数低于同一 epoch 其他 trial 的中位数就提前停止 (median stopping rule)。
+最后输出按分数排序的排行榜。
+
+用法:
+    python 4.train_lora.py --sweep sweep.json
+    python lora_sweep.py sweep.json
+
+sweep.json 示例:
+    {
+      "method": "random", "num_trials": 8, "seed": 0, "workers": 2,
+      "params": {
+        "lora_r": [8, 16, 32],
+        "lora_alpha": [16, 32],
+        "learning_rate": {"low": 5e-5, "high": 5e-4, "log": true},
+        "lora_target_modules": [["q_proj", "v_proj"], ["q_proj", "v_proj", "k_proj", "o_proj"]],
+        "num_train_epochs": [3]
+      },
+      "eval_per_tool": 4,
+      "min_reports": 2
+    }
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import itertools
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from utils import load_script
+
+SWEEP_OUTPUT_DIR = "./checkpoints/lora_sweep/"
+RESULTS_DIR = "./results/"
+LEADERBOARD_FILE = os.path.join(RESULTS_DIR, "lora_sweep_leaderboard.json")
+DEFAULT_WORKERS = 2
+DEFAULT_EVAL_PER_TOOL = 4
+DEFAULT_MIN_REPORTS = 2
+
+
+# --- 搜索空间 ---
+def _sample_param(values, rng):
+    if isinstance(values, dict):
+        low, high = values["low"], values["high"]
+        if values.get("log"):
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        return rng.uniform(low, high)
+    return rng.choice(values)
+
+
+def expand_trials(spec):
+    """List of hyperparameter dicts for a grid (all list combinations) or random search spec."""
+    params = spec["params"]
+    if spec.get("method", "grid") == "grid":
+        names = list(params)
+        return [dict(zip(names, combination)) for combination in itertools.product(*(params[name] for name in names))]
+    rng = random.Random(spec.get("seed", 0))
+    return [{name: _sample_param(values, rng) for name, values in params.items()} for _ in range(spec["num_trials"])]
+
+
+# --- worker ---
+def run_trial(trial_id, hyperparams, settings, reports, lock):
+    """Trains one trial in a worker process; prunes itself when it falls below the median of its epoch."""
+    import torch
+    from datasets import load_from_disk
+    from transformers import TrainerCallback
+    from generation_eval import stratified_subsample, quick_generation_eval
+
+    torch.set_num_threads(settings["threads_per_worker"])
+    trainer_module = load_script("4.train_lora.py")
+    tokenizer = trainer_module.get_tokenizer()
+    # save_to_disk 的 Arrow 文件是 memory-mapped 的，多个 worker 共享同一份页缓存
+    train_dataset = load_from_disk(trainer_module.TOKENIZED_TRAIN_PATH)
+    val_dataset = load_from_disk(trainer_module.TOKENIZED_VAL_PATH)
+    if settings.get("max_train_samples"):
+        train_dataset = train_dataset.select(range(min(settings["max_train_samples"], len(train_dataset))))
+    samples = stratified_subsample(trainer_module.PROMPT_VAL_FILE, settings["eval_per_tool"])
+    history = []
+
+    class MedianStoppingCallback(TrainerCallback):
+        def on_epoch_end(self, args, state, control, model=None, **kwargs):
+            metrics = quick_generation_eval(model, tokenizer, samples)
+            rung = str(round(state.epoch))
+            history.append({"epoch": state.epoch, **metrics})
+            score = metrics["exact_match_rate"]
+            with lock:
+                others = list(reports.get(rung, []))
+                reports[rung] = others + [score]
+            if len(others) >= settings["min_reports"] and score < statistics.median(others):
+                print(f"✂️ trial {trial_id}: epoch {rung} 分数 {score:.3f} 低于中位数 {statistics.median(others):.3f}，提前停止")
+                control.should_training_stop = True
+            return control
+
+    output_dir = os.path.join(SWEEP_OUTPUT_DIR, f"trial_{trial_id:03d}")
+    start = time.perf_counter()
+    model, trainer = trainer_module.train_lora(
+        train_dataset, val_dataset,
+        output_dir=output_dir,
+        callbacks=[MedianStoppingCallback()],
+        training_overrides={"save_strategy": "no", "disable_tqdm": True},
+        **hyperparams,
+    )
+    pruned = trainer.state.epoch < hyperparams.get("num_train_epochs", trainer_module.NUM_TRAIN_EPOCHS) - 1e-6
+    if not pruned:
+        model.save_pretrained(output_dir)
+        tokenizer.save_pretrained(output_dir)
+    final = history[-1] if history else {}
+    return {
+        "trial_id": trial_id,
+        "hyperparams": hyperparams,
+        "status": "pruned" if pruned else "completed",
+        "epochs_trained": trainer.state.epoch,
+        "train_time_s": time.perf_counter() - start,
+        "score": final.get("exact_match_rate", 0.0),
+        "final_metrics": final,
+        "history": history,
+        "adapter_path": None if pruned else output_dir,
+    }
+
+
+def run_sweep(spec_path):
+    with open(spec_path, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+    trials = expand_trials(spec)
+    workers = min(spec.get("workers", DEFAULT_WORKERS), len(trials))
+    settings = {
+        "threads_per_worker": max(1, (os.cpu_count() or 1) // workers),
+        "eval_per_tool": spec.get("eval_per_tool", DEFAULT_EVAL_PER_TOOL),
+        "min_reports": spec.get("min_reports", DEFAULT_MIN_REPORTS),
+        "max_train_samples": spec.get("max_train_samples"),
+    }
+    print(f"🔍 {len(trials)} 个 trial，{workers} 个 worker，每个 worker {settings['threads_per_worker']} 个线程")
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    # 在父进程里先确保 tokenized 数据集已经缓存好，worker 只做 memory-map 加载
+    load_script("4.train_lora.py").build_or_load_datasets()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        reports, lock = manager.dict(), manager.Lock()
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(run_trial, trial_id, hyperparams, settings, reports, lock) for trial_id, hyperparams in enumerate(trials)]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(f"✅ trial {result['trial_id']}: {result['status']}, score {result['score']:.3f}")
+
+    leaderboard = sorted(
+        results,
+        key=lambda r: (r["status"] == "completed", r["score"], r["final_metrics"].get("average_argument_f1", 0)),
+        reverse=True,
+    )
+    print("\n--- LoRA Sweep Leaderboard ---")
+    for rank, result in enumerate(leaderboard, 1):
+        print(f"{rank:>2}. trial {result['trial_id']:03d} {result['status']:<9} score={result['score']:.3f} "
+              f"epochs={result['epochs_trained']:.1f} {json.dumps(result['hyperparams'])}")
+    with open(LEADERBOARD_FILE, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "leaderboard": leaderboard}, f, indent=2)
+    print(f"\n✅ Leaderboard saved to {LEADERBOARD_FILE}")
+    return leaderboard
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a parallel LoRA hyperparameter sweep.")
+    parser.add_argument("spec", type=str, help="JSON sweep spec.")
+    args = parser.parse_args()
+    run_sweep(args.spec)
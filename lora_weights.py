@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+读取 PEFT LoRA 适配器的权重。
+
+6.merge_base_lora.py 的流式合并和 multi_lora.py 的多适配器服务都需要把适配器读成
+{模块名: (lora_A, lora_B, scaling)}，不经过 PeftModel。scaling 按 adapter_config 的
+rank_pattern / alpha_pattern / use_rslora 计算，与 PEFT 一致。
+"""
+import os
+import re
+import json
+
+
+def pattern_value(patterns, module_name, default):
+    """PEFT rank_pattern / alpha_pattern lookup: the first pattern matching the end of `module_name`."""
+    for pattern, value in patterns.items():
+        if re.match(rf"(.*\.)?{pattern}$", module_name):
+            return value
+    return default
+
+
+def load_lora_deltas(lora_path):
+    """
+    Reads the adapter into {module_name: (lora_A, lora_B, scaling)}. Module names are relative to
+    the base model (the PEFT "base_model.model." prefix is stripped).
+    """
+    with open(os.path.join(lora_path, "adapter_config.json"), "r", encoding="utf-8") as f:
+        adapter_config = json.load(f)
+    if adapter_config.get("use_dora"):
+        raise ValueError("不支持 DoRA 适配器 (只读取 lora_A / lora_B)，请使用 PEFT 的默认合并方式。")
+    import torch
+    from safetensors import safe_open
+
+    tensors = {}
+    adapter_file = os.path.join(lora_path, "adapter_model.safetensors")
+    if os.path.exists(adapter_file):
+        with safe_open(adapter_file, framework="pt") as f:
+            for key in f.keys():
+                tensors[key] = f.get_tensor(key)
+    else:
+        tensors = torch.load(os.path.join(lora_path, "adapter_model.bin"), map_location="cpu", weights_only=True)
+
+    deltas = {}
+    for key, lora_a in tensors.items():
+        if ".lora_A." not in key:
+            continue
+        module_name = key.split(".lora_A.")[0]
+        if module_name.startswith("base_model.model."):
+            module_name = module_name[len("base_model.model."):]
+        lora_b = tensors[key.replace(".lora_A.", ".lora_B.")]
+
+        r = pattern_value(adapter_config.get("rank_pattern") or {}, module_name, adapter_config["r"])
+        alpha = pattern_value(adapter_config.get("alpha_pattern") or {}, module_name, adapter_config["lora_alpha"])
+        scaling = alpha / (r ** 0.5) if adapter_config.get("use_rslora") else alpha / r
+        deltas[module_name] = (lora_a, lora_b, scaling)
+    return deltas, adapter_config.get("fan_in_fan_out", False)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+内容寻址的模型导出包 + 增量发布。
+
+导出: 把合并后的模型重新切成 safetensors 分片，分片文件名取内容的 sha256 (model-<hash>.safetensors)，
+同时写 HF 能直接加载的 model.safetensors.index.json。张量先按"角色" (去掉层号后的名字，例如
+model.layers.*.self_attn.q_proj.weight) 分组，再在组内按大小切分：LoRA 只改动了目标模块，
+embedding、norm、未训练的投影所在的分片在两次发布之间字节完全相同。
+tokenizer / config 等其余文件原样复制，评估结果放在 eval/ 下。
+bundle_manifest.json 记录每个文件的 sha256 和大小。
+
+发布: 读取目标上的 manifest，只传输 hash 变了的文件，删除不再引用的旧分片，manifest 最后写入。
+目标上还没有 manifest 时 (例如旧版 upload_folder 上传的仓库)，全部上传，并删除 bundle 之外的权重文件。
+目标可以是 Hugging Face Hub 仓库 (一次 commit 完成)，也可以是本地目录 (测试时代替 Hub)。
+
+用法:
+    python 7.push_to_hub.py --target_dir ./export/hub_mirror
+    python 7.push_to_hub.py --repo_id user/merged_gemma_lora
+"""
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+from safetensors import safe_open
+from safetensors.torch import save_file
+from huggingface_hub import HfApi, CommitOperationAdd, CommitOperationDelete, hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError, RepositoryNotFoundError
+
+MANIFEST_NAME = "bundle_manifest.json"
+WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+EVAL_DIR_NAME = "eval"
+DEFAULT_BUNDLE_SHARD_SIZE = "64MB"
+HASH_CHUNK_BYTES = 8 * 1024 ** 2
+MANIFEST_FORMAT = 1
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin", ".pt", ".pth", ".ckpt")
+SAFETENSORS_DTYPE_SIZES = {"F64": 8, "F32": 4, "F16": 2, "BF16": 2, "I64": 8, "I32": 4, "I16": 2, "I8": 1, "U8": 1, "BOOL": 1}
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _weight_files(model_dir):
+    index_file = os.path.join(model_dir, WEIGHTS_INDEX_NAME)
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as f:
+            weight_map = json.load(f)["weight_map"]
+        return [os.path.join(model_dir, name) for name in sorted(set(weight_map.values()))]
+    return [os.path.join(model_dir, "model.safetensors")]
+
+
+def _natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def _tensor_role(name):
+    return re.sub(r"\.\d+\.", ".*.", name)
+
+
+def plan_shards(tensor_sizes, shard_size):
+    """Groups {name: nbytes} by tensor role, then splits each group into shards of at most `shard_size` bytes."""
+    groups = {}
+    for name in sorted(tensor_sizes, key=_natural_key):
+        groups.setdefault(_tensor_role(name), []).append(name)
+    shards = []
+    for names in groups.values():
+        current, current_bytes = [], 0
+        for name in names:
+            if current and current_bytes + tensor_sizes[name] > shard_size:
+                shards.append(current)
+                current, current_bytes = [], 0
+            current.append(name)
+            current_bytes += tensor_sizes[name]
+        shards.append(current)
+    return shards
+
+
+# --- 导出 ---
+def export_bundle(model_dir, bundle_dir, shard_size, eval_files=()):
+    """
+    Writes the content-addressed bundle for `model_dir` to `bundle_dir` (replacing it) and returns the manifest.
+    Tensors are read one shard at a time, so peak memory is about one shard.
+    """
+    tmp_dir = bundle_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    sources, tensor_sizes = {}, {}
+    for path in _weight_files(model_dir):
+        handle = safe_open(path, framework="pt")
+        for name in handle.keys():
+            # 只读 header 里的 dtype 和 shape，不把张量读进内存
+            tensor_slice = handle.get_slice(name)
+            nbytes = SAFETENSORS_DTYPE_SIZES[tensor_slice.get_dtype()]
+            for dim in tensor_slice.get_shape():
+                nbytes *= dim
+            sources[name] = handle
+            tensor_sizes[name] = nbytes
+
+    files = {}
+    weight_map = {}
+    for names in plan_shards(tensor_sizes, shard_size):
+        tmp_path = os.path.join(tmp_dir, "shard.tmp")
+        save_file({name: sources[name].get_tensor(name) for name in names}, tmp_path, metadata={"format": "pt"})
+        sha256 = file_sha256(tmp_path)
+        shard_name = f"model-{sha256[:16]}.safetensors"
+        os.replace(tmp_path, os.path.join(tmp_dir, shard_name))
+        files[shard_name] = {"sha256": sha256, "size": os.path.getsize(os.path.join(tmp_dir, shard_name)), "kind": "shard", "tensors": names}
+        weight_map.update({name: shard_name for name in names})
+
+    with open(os.path.join(tmp_dir, WEIGHTS_INDEX_NAME), "w", encoding="utf-8") as f:
+        json.dump({"metadata": {"total_size": sum(tensor_sizes.values())}, "weight_map": dict(sorted(weight_map.items()))}, f, indent=2)
+
+    # tokenizer / config 等其余文件原样复制
+    weight_names = {os.path.basename(path) for path in _weight_files(model_dir)} | {WEIGHTS_INDEX_NAME}
+    for file_name in sorted(os.listdir(model_dir)):
+        source = os.path.join(model_dir, file_name)
+        if os.path.isfile(source) and file_name not in weight_names:
+            shutil.copy2(source, os.path.join(tmp_dir, file_name))
+    for path in eval_files:
+        if os.path.isfile(path):
+            os.makedirs(os.path.join(tmp_dir, EVAL_DIR_NAME), exist_ok=True)
+            shutil.copy2(path, os.path.join(tmp_dir, EVAL_DIR_NAME, os.path.basename(path)))
+
+    for root, _, file_names in os.walk(tmp_dir):
+        for file_name in file_names:
+            relpath = os.path.relpath(os.path.join(root, file_name), tmp_dir).replace(os.sep, "/")
+            if relpath not in files:
+                path = os.path.join(root, file_name)
+                kind = "eval" if relpath.startswith(EVAL_DIR_NAME + "/") else "file"
+                files[relpath] = {"sha256": file_sha256(path), "size": os.path.getsize(path), "kind": kind}
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "source": os.path.abspath(model_dir),
+        "shard_size": shard_size,
+        "files": dict(sorted(files.items())),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.replace(tmp_dir, bundle_dir)
+    return manifest
+
+
+def load_manifest(bundle_dir):
+    with open(os.path.join(bundle_dir, MANIFEST_NAME), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def is_weight_file(relpath):
+    name = os.path.basename(relpath)
+    return name.endswith(WEIGHT_FILE_SUFFIXES) or name in (WEIGHTS_INDEX_NAME, "pytorch_model.bin.index.json")
+
+
+def diff_manifests(local, remote, remote_files=()):
+    """
+    (files to upload, files to delete) turning the target into `local`. Without a remote manifest
+    (empty target, or one published before bundles existed) everything is uploaded and the target's
+    existing weight files (`remote_files`) that the bundle does not contain are deleted.
+    """
+    if remote is None:
+        upload = list(local["files"])
+        delete = [path for path in remote_files if is_weight_file(path) and path not in local["files"]]
+        return upload, delete
+    upload = [path for path, entry in local["files"].items()
+              if remote["files"].get(path, {}).get("sha256") != entry["sha256"]]
+    delete = [path for path in remote["files"] if path not in local["files"]]
+    return upload, delete
+
+
+# --- 发布目标 ---
+class LocalDirTarget:
+    """
+    A directory standing in for a hub repo. Changed files are copied in atomically, the manifest
+    is written last, and files no longer referenced are removed afterwards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def read_manifest(self):
+        try:
+            return load_manifest(self.path)
+        except FileNotFoundError:
+            return None
+
+    def list_files(self):
+        files = []
+        for root, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                files.append(os.path.relpath(os.path.join(root, file_name), self.path).replace(os.sep, "/"))
+        return files
+
+    def apply(self, bundle_dir, upload, delete, message):
+        os.makedirs(self.path, exist_ok=True)
+        for relpath in upload:
+            destination = os.path.join(self.path, relpath)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copy2(os.path.join(bundle_dir, relpath), destination + ".tmp")
+            os.replace(destination + ".tmp", destination)
+        shutil.copy2(os.path.join(bundle_dir, MANIFEST_NAME), os.path.join(self.path, MANIFEST_NAME + ".tmp"))
+        os.replace(os.path.join(self.path, MANIFEST_NAME + ".tmp"), os.path.join(self.path, MANIFEST_NAME))
+        for relpath in delete:
+            path = os.path.join(self.path, relpath)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class HubTarget:
+    """A Hugging Face Hub repo; uploads, deletions and the manifest land in a single commit."""
+
+    def __init__(self, repo_id, repo_type="model"):
+        self.repo_id = repo_id
+        self.repo_type = repo_type
+        self.api = HfApi()
+
+    def __str__(self):
+        return f"https://huggingface.co/{self.repo_id}"
+
+    def read_manifest(self):
+        try:
+            path = hf_hub_download(self.repo_id, MANIFEST_NAME, repo_type=self.repo_type)
+        except (EntryNotFoundError, RepositoryNotFoundError):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def list_files(self):
+        try:
+            return self.api.list_repo_files(self.repo_id, repo_type=self.repo_type)
+        except RepositoryNotFoundError:
+            return []
+
+    def apply(self, bundle_dir, upload, delete, message):
+        self.api.create_repo(repo_id=self.repo_id, repo_type=self.repo_type, exist_ok=True)
+        operations = [CommitOperationAdd(path_in_repo=relpath, path_or_fileobj=os.path.join(bundle_dir, relpath)) for relpath in upload]
+        operations.append(CommitOperationAdd(path_in_repo=MANIFEST_NAME, path_or_fileobj=os.path.join(bundle_dir, MANIFEST_NAME)))
+        operations.extend(CommitOperationDelete(path_in_repo=relpath) for relpath in delete)
+        self.api.create_commit(repo_id=self.repo_id, repo_type=self.repo_type, operations=operations, commit_message=message)
+
+
+def publish_bundle(bundle_dir, target, message="Update model bundle", dry_run=False):
+    """Transfers only the files whose hash differs from the target's manifest; returns a transfer report."""
+    local = load_manifest(bundle_dir)
+    remote = target.read_manifest()
+    # 没有 manifest 的目标 (例如旧脚本 upload_folder 上传的仓库) 可能还留着 model.safetensors，
+    # transformers 会优先加载它而不是 index，所以要列出目标上的文件把旧权重删掉
+    upload, delete = diff_manifests(local, remote, target.list_files() if remote is None else ())
+
+    bundle_bytes = sum(entry["size"] for entry in local["files"].values())
+    upload_bytes = sum(local["files"][path]["size"] for path in upload)
+    report = {
+        "target": str(target),
+        "files_total": len(local["files"]),
+        "files_uploaded": len(upload),
+        "files_deleted": len(delete),
+        "shards_uploaded": sum(local["files"][path]["kind"] == "shard" for path in upload),
+        "shards_total": sum(entry["kind"] == "shard" for entry in local["files"].values()),
+        "bundle_bytes": bundle_bytes,
+        "uploaded_bytes": upload_bytes,
+        "uploaded_fraction": upload_bytes / bundle_bytes if bundle_bytes else 0,
+        "uploaded": upload,
+        "deleted": delete,
+        "dry_run": dry_run,
+    }
+    if (upload or delete) and not dry_run:
+        target.apply(bundle_dir, upload, delete, message)
+    return report
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+一个基础模型同时服务多个 LoRA 适配器。
+
+基础模型只加载一份，目标线性层 (默认 q/k/v/o_proj) 被替换成 MultiLoraLinear：每个适配器
+占一个槽位，A/B 矩阵按槽位堆叠在一起，前向时按每一行的槽位索引 gather 出各自的 A/B，
+用 bmm 一次算完整个 batch 的 LoRA 增量。因此同一个 batch 里的不同行可以使用不同的适配器
+(不同租户 / 不同工具集)。槽位满了之后按 LRU 淘汰最久未使用的适配器。
+
+用法:
+    python multi_lora.py --adapters toolset_a=./checkpoints/lora_a toolset_b=./checkpoints/lora_b --verify
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import OrderedDict
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from lora_weights import load_lora_deltas
+from data_io import read_table
+
+BASE_MODEL_PATH = "./models/gemma-3-270m-it"
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "multi_lora_results.json")
+
+DEFAULT_TARGET_MODULES = ["q_proj", "v_proj", "k_proj", "o_proj"]
+DEFAULT_MAX_ADAPTERS = 8
+DEFAULT_MAX_RANK = 64
+BASE_ADAPTER = "base"  # 不使用适配器的行
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class MultiLoraLinear(torch.nn.Module):
+    """
+    Wraps a base nn.Linear and adds a per-row LoRA delta. Slot 0 is all zeros and stands for
+    "no adapter"; slots 1..N hold loaded adapters.
+    """
+
+    def __init__(self, base_layer, engine, num_slots, max_rank):
+        super().__init__()
+        self.base_layer = base_layer
+        self.engine = engine
+        weight = base_layer.weight
+        self.register_buffer(
+            "lora_A", torch.zeros(num_slots, max_rank, base_layer.in_features, dtype=weight.dtype, device=weight.device), persistent=False
+        )
+        self.register_buffer(
+            "lora_B", torch.zeros(num_slots, base_layer.out_features, max_rank, dtype=weight.dtype, device=weight.device), persistent=False
+        )
+
+    def set_slot(self, slot, lora_a, lora_b):
+        self.lora_A[slot].zero_()
+        self.lora_B[slot].zero_()
+        if lora_a is not None:
+            rank = lora_a.shape[0]
+            self.lora_A[slot, :rank].copy_(lora_a)
+            self.lora_B[slot, :, :rank].copy_(lora_b)
+
+    def forward(self, x):
+        output = self.base_layer(x)
+        row_slots = self.engine.row_slots
+        if row_slots is None:
+            return output
+        # (batch, seq, in) @ (batch, in, r) @ (batch, r, out)，每行用自己的槽位
+        lora_a = self.lora_A.index_select(0, row_slots)
+        lora_b = self.lora_B.index_select(0, row_slots)
+        delta = torch.bmm(torch.bmm(x.to(lora_a.dtype), lora_a.transpose(1, 2)), lora_b.transpose(1, 2))
+        return output + (delta * self.engine.row_scalings.view(-1, 1, 1)).to(output.dtype)
+
+
+class MultiLoraEngine:
+    """One resident base model serving up to `max_adapters` LoRA adapters with LRU eviction."""
+
+    def __init__(self, model, tokenizer, max_adapters=DEFAULT_MAX_ADAPTERS,
+                 target_modules=DEFAULT_TARGET_MODULES, max_rank=DEFAULT_MAX_RANK):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_adapters = max_adapters
+        self.max_rank = max_rank
+        self.adapter_paths = {}
+        self.loaded = OrderedDict()  # name -> slot，按最近使用排序
+        self.free_slots = list(range(1, max_adapters + 1))
+        self.slot_scalings = torch.zeros(max_adapters + 1, device=model.device)
+        self.row_slots = None
+        self.row_scalings = None
+        self.stats = {"loads": 0, "evictions": 0, "hits": 0}
+
+        self.lora_modules = {}
+        for name, module in list(model.named_modules()):
+            for child_name, child in list(module.named_children()):
+                if child_name in target_modules and isinstance(child, torch.nn.Linear):
+                    wrapped = MultiLoraLinear(child, self, max_adapters + 1, max_rank)
+                    setattr(module, child_name, wrapped)
+                    self.lora_modules[f"{name}.{child_name}" if name else child_name] = wrapped
+
+    # --- 适配器管理 ---
+    def register_adapter(self, name, path):
+        """Records where an adapter lives; it is loaded on first use."""
+        self.adapter_paths[name] = path
+
+    def load_adapter(self, name, protected=()):
+        if name in self.loaded:
+            self.loaded.move_to_end(name)
+            self.stats["hits"] += 1
+            return self.loaded[name]
+
+        if not self.free_slots:
+            victim = next((loaded for loaded in self.loaded if loaded not in protected), None)
+            if victim is None:
+                raise RuntimeError(f"同一个 batch 里的适配器数量超过了槽位数 {self.max_adapters}")
+            self.unload_adapter(victim)
+            self.stats["evictions"] += 1
+
+        deltas, fan_in_fan_out = load_lora_deltas(self.adapter_paths[name])
+        if fan_in_fan_out:
+            raise ValueError(f"适配器 '{name}' 使用了 fan_in_fan_out，暂不支持。")
+
+        slot = self.free_slots.pop(0)
+        scalings = set()
+        for module_name, (lora_a, lora_b, scaling) in deltas.items():
+            if module_name not in self.lora_modules:
+                raise ValueError(f"适配器 '{name}' 的模块 {module_name} 不在引擎的目标模块里。")
+            if lora_a.shape[0] > self.max_rank:
+                raise ValueError(f"适配器 '{name}' 的 rank {lora_a.shape[0]} 超过 max_rank {self.max_rank}。")
+            self.lora_modules[module_name].set_slot(slot, lora_a, lora_b)
+            scalings.add(scaling)
+        if len(scalings) > 1:
+            # 每个模块的缩放不同 (rank/alpha pattern)，直接折叠进 B
+            for module_name, (lora_a, lora_b, scaling) in deltas.items():
+                self.lora_modules[module_name].set_slot(slot, lora_a, lora_b * scaling)
+            self.slot_scalings[slot] = 1.0
+        else:
+            self.slot_scalings[slot] = scalings.pop() if scalings else 0.0
+
+        self.loaded[name] = slot
+        self.stats["loads"] += 1
+        return slot
+
+    def unload_adapter(self, name):
+        slot = self.loaded.pop(name)
+        for module in self.lora_modules.values():
+            module.set_slot(slot, None, None)
+        self.slot_scalings[slot] = 0.0
+        self.free_slots.append(slot)
+
+    # --- 推理 ---
+    @torch.no_grad()
+    def generate(self, prompts, adapter_names, max_new_tokens=150):
+        """Generates one batch where row i uses adapter `adapter_names[i]` (or "base")."""
+        batch_adapters = {name for name in adapter_names if name != BASE_ADAPTER}
+        slots = [
+            0 if name == BASE_ADAPTER else self.load_adapter(name, protected=batch_adapters)
+            for name in adapter_names
+        ]
+
+        padding_side = self.tokenizer.padding_side
+        self.tokenizer.padding_side = "left"
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, max_length=2048, truncation=True).to(self.model.device)
+        self.tokenizer.padding_side = padding_side
+
+        self.row_slots = torch.tensor(slots, dtype=torch.long, device=self.model.device)
+        self.row_scalings = self.slot_scalings.index_select(0, self.row_slots)
+        try:
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+                do_sample=False,
+                top_p=None,
+                top_k=None
+            )
+        finally:
+            self.row_slots = None
+            self.row_scalings = None
+        return self.tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+
+def _reference_outputs(adapter_path, prompts, tokenizer, dtype):
+    """Single-adapter PeftModel outputs, used by --verify."""
+    from peft import PeftModel
+
+    base_model = AutoModelForCausalLM.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True, torch_dtype=dtype).to(device)
+    model = PeftModel.from_pretrained(base_model, adapter_path).to(device).eval()
+    texts = []
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+        with torch.no_grad():
+            outputs = model.generate(**inputs, max_new_tokens=150, pad_token_id=tokenizer.eos_token_id, do_sample=False, top_p=None, top_k=None)
+        texts.append(tokenizer.decode(outputs[0][len(inputs["input_ids"][0]):], skip_special_tokens=True))
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched inference with one base model and many LoRA adapters.")
+    parser.add_argument("--adapters", nargs="+", required=True, help="Adapters as name=path, e.g. toolset_a=./checkpoints/lora_gemma_generation")
+    parser.add_argument("--num_samples", type=int, default=16, help="Number of test.parquet rows to run.")
+    parser.add_argument("--batch_size", type=int, default=8, help="Rows per mixed-adapter batch.")
+    parser.add_argument("--max_adapters", type=int, default=DEFAULT_MAX_ADAPTERS, help="Adapter slots kept in memory (LRU).")
+    parser.add_argument("--max_rank", type=int, default=DEFAULT_MAX_RANK, help="Largest LoRA rank the slots can hold.")
+    parser.add_argument("--verify", action="store_true", help="Compare every row against a single-adapter PeftModel run.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+
+    print("Loading base model and tokenizer...")
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(BASE_MODEL_PATH, trust_remote_code=True, torch_dtype=dtype).to(device)
+
+    engine = MultiLoraEngine(model, tokenizer, max_adapters=args.max_adapters, max_rank=args.max_rank)
+    adapter_names = []
+    for spec in args.adapters:
+        name, path = spec.split("=", 1)
+        engine.register_adapter(name, path)
+        adapter_names.append(name)
+
+    df = read_table(PROMPT_VAL_FILE, columns=["text"]).head(args.num_samples)
+    prompts = df["text"].tolist()
+    # 按行轮流分配适配器，模拟不同租户混在同一个 batch 里
+    row_adapters = [adapter_names[i % len(adapter_names)] for i in range(len(prompts))]
+
+    generated = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(prompts), args.batch_size):
+        generated.extend(engine.generate(
+            prompts[batch_start:batch_start + args.batch_size],
+            row_adapters[batch_start:batch_start + args.batch_size],
+        ))
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "rows": len(prompts),
+        "adapters": adapter_names,
+        "batch_size": args.batch_size,
+        "total_time_s": elapsed,
+        "rows_per_second": len(prompts) / elapsed if elapsed > 0 else 0,
+        "adapter_stats": engine.stats,
+    }
+
+    if args.verify:
+        mismatched = 0
+        for name in adapter_names:
+            rows = [i for i, row_adapter in enumerate(row_adapters) if row_adapter == name]
+            reference = _reference_outputs(engine.adapter_paths[name], [prompts[i] for i in rows], tokenizer, dtype)
+            mismatched += sum(generated[i] != text for i, text in zip(rows, reference))
+        summary["verified_rows"] = len(prompts)
+        summary["mismatched_rows"] = mismatched
+
+    print("\n--- Multi-LoRA Summary ---")
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    print(f"\n✅ Summary saved to {RESULTS_FILE}")
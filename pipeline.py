@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+流水线入口：把 1~7 号脚本组织成一个 DAG。
+
+每个阶段声明自己的输入和输出。运行前计算 "输入内容 + 代码 + 参数" 的哈希 (fingerprint)，
+和上次成功运行时记录的一致并且输出没有被改动，就跳过这个阶段；改了某个阶段的代码只会重跑它和它下游
+真正受影响的阶段。没有依赖关系的阶段 (基座模型评估和 LoRA 训练) 并行运行。
+
+代码哈希包括脚本本身、阶段在默认参数下会用到的仓库内模块 (Stage.code，脚本里的重依赖都是在函数内按需导入的，
+静态分析分不清哪些只在某个可选参数下才用到)，以及这些文件在模块顶层 import 的仓库内模块。
+只在可选功能里用到的模块 (例如 4 的 --gen_eval 会间接用到评估代码) 改动时不会触发重跑。
+文件哈希按 (size, mtime) 缓存，模型权重不会每次都重新读一遍。
+
+用法:
+    python pipeline.py                      # 除导出以外的所有阶段
+    python pipeline.py --target export      # 导出及其上游
+    python pipeline.py --dry_run            # 只打印哪些阶段会运行
+    python pipeline.py --force train        # 强制重跑某些阶段 (下游按哈希决定)
+"""
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+STATE_FILE = "./.pipeline_state.json"
+LOG_DIR = "./results/pipeline_logs/"
+DEFAULT_JOBS = 2
+HASH_CHUNK_SIZE = 1 << 20
+
+# 只匹配顶层 (不缩进) 的 import；函数里的按需导入由 Stage.code 显式声明
+TOP_LEVEL_IMPORT_PATTERN = re.compile(r"^(?:from\s+(\w+)\s+import|import\s+(\w+))", re.MULTILINE)
+
+
+class Stage:
+    def __init__(self, name, script, inputs, outputs, deps=(), args=(), code=()):
+        self.name = name
+        self.script = script
+        self.code = list(code)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.args = list(args)
+
+
+STAGES = [
+    Stage("generate", "1.generate_data.py", [], ["./data/finetuning_data.parquet"]),
+    Stage("split", "2.split_data.py", ["./data/finetuning_data.parquet"],
+          ["./data/train.parquet", "./data/test.parquet"], deps=["generate"]),
+    Stage("base_eval", "3.run_evaluation.py", ["./data/test.parquet", "./models/gemma-3-270m"],
+          ["./results/evaluation_results.json", "./results/detailed_evaluation_results.csv"], deps=["split"],
+          code=["prompt_lookup.py", "batch_planner.py", "data_io.py"]),
+    Stage("train", "4.train_lora.py", ["./data/train.parquet", "./data/test.parquet", "./models/gemma-3-270m"],
+          ["./checkpoints/lora_gemma_generation"], deps=["split"]),
+    Stage("lora_eval", "5.eval_lora.py",
+          ["./data/test.parquet", "./models/gemma-3-270m-it", "./checkpoints/lora_gemma_generation"],
+          ["./results/lora_evaluation_results.json", "./results/lora_detailed_evaluation_results.csv"], deps=["train"],
+          code=["3.run_evaluation.py", "prompt_lookup.py", "batch_planner.py", "data_io.py"]),
+    Stage("merge", "6.merge_base_lora.py", ["./models/gemma-3-270m-it", "./checkpoints/lora_gemma_generation"],
+          ["./models/merged_gemma_lora"], deps=["train"]),
+    Stage("export", "7.push_to_hub.py", ["./models/merged_gemma_lora"], [], deps=["merge"], code=["model_bundle.py"]),
+]
+STAGES_BY_NAME = {stage.name: stage for stage in STAGES}
+
+
+# --- 哈希 ---
+class HashCache:
+    """sha256 of files, memoized on (size, mtime_ns) so unchanged model weights are not re-read."""
+
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        cached = self.entries.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        self.entries[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+        return digest.hexdigest()
+
+    def path_hash(self, path):
+        """Hash of a file, or of every file under a directory (hidden entries skipped); None if missing."""
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        digest = hashlib.sha256()
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names[:] = sorted(d for d in dir_names if not d.startswith("."))
+            for file_name in sorted(f for f in file_names if not f.startswith(".")):
+                full_path = os.path.join(dir_path, file_name)
+                digest.update(os.path.relpath(full_path, path).encode())
+                digest.update(self.file_hash(full_path).encode())
+        return digest.hexdigest()
+
+
+def code_files(stage):
+    """The stage's script and declared modules plus the repo modules they import at top level, transitively."""
+    seen, pending = set(), [stage.script] + stage.code
+    while pending:
+        file_name = pending.pop()
+        path = os.path.join(project_root, file_name)
+        if file_name in seen or not os.path.isfile(path):
+            continue
+        seen.add(file_name)
+        with open(path, "r", encoding="utf-8") as f:
+            source = f.read()
+        for match in TOP_LEVEL_IMPORT_PATTERN.finditer(source):
+            pending.append((match.group(1) or match.group(2)) + ".py")
+    return sorted(seen)
+
+
+def stage_fingerprint(stage, hash_cache):
+    digest = hashlib.sha256()
+    for file_name in code_files(stage):
+        digest.update(f"code:{file_name}:{hash_cache.file_hash(os.path.join(project_root, file_name))}".encode())
+    for path in stage.inputs:
+        digest.update(f"input:{path}:{hash_cache.path_hash(path)}".encode())
+    digest.update(f"args:{json.dumps(stage.args)}".encode())
+    return digest.hexdigest()
+
+
+# --- 状态 ---
+def load_state():
+    if not os.path.exists(STATE_FILE):
+        return {"stages": {}, "hash_cache": {}}
+    with open(STATE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state):
+    with open(STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def is_up_to_date(stage, fingerprint, state, hash_cache):
+    record = state["stages"].get(stage.name)
+    if record is None or record["fingerprint"] != fingerprint:
+        return False
+    return all(hash_cache.path_hash(path) == record["outputs"].get(path) for path in stage.outputs)
+
+
+# --- 调度 ---
+def select_stages(target=None):
+    """`target` and all of its ancestors (default: every stage but export), in declaration (topological) order."""
+    if target is None:
+        return [stage for stage in STAGES if stage.name != "export"]
+    needed, pending = set(), [target]
+    while pending:
+        name = pending.pop()
+        if name not in needed:
+            needed.add(name)
+            pending.extend(STAGES_BY_NAME[name].deps)
+    return [stage for stage in STAGES if stage.name in needed]
+
+
+def run_stage(stage):
+    """Runs one script in a child process; stdout/stderr go to a per-stage log file."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path = os.path.join(LOG_DIR, f"{stage.name}.log")
+    start = time.perf_counter()
+    command = [sys.executable, os.path.join(project_root, stage.script), *stage.args]
+    if stage.name == "export":
+        # 导出阶段需要交互输入，直接用当前终端
+        return subprocess.call(command), time.perf_counter() - start, None
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        # 不接 stdin，避免并行阶段抢输入
+        returncode = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    return returncode, time.perf_counter() - start, log_path
+
+
+def run_pipeline(target=None, force=(), jobs=DEFAULT_JOBS, dry_run=False):
+    stages = select_stages(target)
+    state = load_state()
+    hash_cache = HashCache(state.get("hash_cache"))
+    status = {}  # name -> "skipped" / "done" / "would_run" / "failed" / "blocked"
+    running = {}
+
+    def ready(stage):
+        return stage.name not in status and stage.name not in running.values() and all(
+            status.get(dep) in ("skipped", "done", "would_run") for dep in stage.deps
+        )
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while len(status) < len(stages):
+            for stage in stages:
+                if not ready(stage):
+                    if stage.name not in status and any(status.get(dep) in ("failed", "blocked") for dep in stage.deps):
+                        status[stage.name] = "blocked"
+                        print(f"⛔ {stage.name}: 上游失败，跳过")
+                    continue
+                fingerprint = stage_fingerprint(stage, hash_cache)
+                if stage.name not in force and is_up_to_date(stage, fingerprint, state, hash_cache):
+                    status[stage.name] = "skipped"
+                    print(f"⏭️  {stage.name}: 输入、代码和参数都没有变化，跳过")
+                elif dry_run:
+                    # 上游会重跑时下游的输入哈希还无法确定，按会运行处理
+                    status[stage.name] = "would_run"
+                    print(f"▶️  {stage.name}: 将会运行")
+                elif len(running) < jobs:
+                    print(f"🚀 {stage.name}: 开始运行 {stage.script}")
+                    running[executor.submit(run_stage, stage)] = stage.name
+                    state["stages"].pop(stage.name, None)
+                    state.setdefault("pending_fingerprints", {})[stage.name] = fingerprint
+
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                stage = STAGES_BY_NAME[name]
+                returncode, elapsed, log_path = future.result()
+                if returncode != 0:
+                    status[name] = "failed"
+                    print(f"❌ {name}: 失败 (exit {returncode})，日志见 {log_path}")
+                    continue
+                status[name] = "done"
+                state["stages"][name] = {
+                    "fingerprint": state["pending_fingerprints"].pop(name),
+                    "outputs": {path: hash_cache.path_hash(path) for path in stage.outputs},
+                    "elapsed_s": elapsed,
+                }
+                print(f"✅ {name}: 完成，用时 {elapsed:.1f}s")
+            state["hash_cache"] = hash_cache.entries
+            save_state(state)
+
+    state.pop("pending_fingerprints", None)
+    state["hash_cache"] = hash_cache.entries
+    if not dry_run:
+        save_state(state)
+    return status
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run pipeline stages 1-7, skipping the ones whose inputs, code and config are unchanged.")
+    parser.add_argument("--target", type=str, default=None, choices=list(STAGES_BY_NAME), help="Stage to bring up to date together with its ancestors. Defaults to every stage except export.")
+    parser.add_argument("--force", nargs="*", default=[], choices=list(STAGES_BY_NAME), help="Stages to rerun even if up to date.")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help="Independent stages run in parallel.")
+    parser.add_argument("--dry_run", action="store_true", help="Only print which stages would run.")
+    args = parser.parse_args()
+
+    status = run_pipeline(args.target, set(args.force), args.jobs, args.dry_run)
+    print("\n--- Pipeline ---")
+    for name, result in status.items():
+        print(f"  {name:<10} {result}")
+    if any(result in ("failed", "blocked") for result in status.values()):
+        sys.exit(1)
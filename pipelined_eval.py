@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+流水线评估。
+
+evaluate_model 默认逐 batch 串行执行: 分词 → 生成 → 解码 → 正则解析 JSON → 打分，模型在做 Python 工作时空闲。
+这里拆成三段同时进行:
+  1. 分词: 线程池提前把后面的 batch 分好词 (左 padding)，最多 `prefetch` 个放在有界队列里等待；
+  2. 生成: 主线程只做 generate，新 token 搬回 CPU 后立刻交给下一段；
+  3. 后处理: 另一个线程池解码、extract_json_output 解析并计算逐行指标。
+torch 和 Rust tokenizer 计算时会释放 GIL，三段可以真正重叠。
+
+每段汇报忙碌时间和利用率 (忙碌时间 / (墙钟时间 × 线程数))，生成段另外汇报等分词的时间，
+利用率最高的一段就是瓶颈。
+
+用法:
+    python 3.run_evaluation.py --pipelined --batch_size 8
+    python 5.eval_lora.py --pipelined --batch_size 8
+"""
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+DEFAULT_TOKENIZE_WORKERS = 2
+DEFAULT_POSTPROCESS_WORKERS = 2
+DEFAULT_PREFETCH_BATCHES = 4
+MAX_PROMPT_LENGTH = 2048
+
+
+class StageTimer:
+    """Thread-safe busy-time and item counter for one pipeline stage."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.busy_s = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def track(self, items):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.busy_s += elapsed
+                self.items += items
+
+    def summary(self, wall_s):
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "busy_s": self.busy_s,
+            "utilization": self.busy_s / (wall_s * self.workers) if wall_s > 0 else 0,
+        }
+
+
+def run_pipeline(tokenizer, batches, generate_fn, postprocess_fn, tokenize_workers=DEFAULT_TOKENIZE_WORKERS,
+                 postprocess_workers=DEFAULT_POSTPROCESS_WORKERS, prefetch=DEFAULT_PREFETCH_BATCHES, desc="Evaluating"):
+    """
+    `batches` is a list of [(key, prompt), ...]. For each batch, `generate_fn(inputs)` runs on the
+    calling thread and returns the generated token ids (prompt stripped, on CPU); `postprocess_fn(key, text)`
+    runs in the post-processing pool on every decoded row. Returns ({key: postprocess result}, stage report).
+    """
+    tokenize_timer = StageTimer(tokenize_workers)
+    generate_timer = StageTimer(1)
+    postprocess_timer = StageTimer(postprocess_workers)
+    tokenize_kwargs = dict(return_tensors="pt", padding=True, max_length=MAX_PROMPT_LENGTH, truncation=True)
+
+    def tokenize(batch):
+        with tokenize_timer.track(len(batch)):
+            return tokenizer([prompt for _, prompt in batch], **tokenize_kwargs)
+
+    def postprocess(batch, new_tokens):
+        with postprocess_timer.track(len(batch)):
+            texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+            return [(key, postprocess_fn(key, text)) for (key, _), text in zip(batch, texts)]
+
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    results = {}
+    waiting_for_input_s = 0.0
+    try:
+        if batches:
+            # 先在主线程用同样的参数分一次词：fast tokenizer 第一次调用会修改 truncation/padding 设置，
+            # 多个线程同时修改会报 "Already borrowed"，之后设置不变就只有只读访问
+            tokenizer([batches[0][0][1]], **tokenize_kwargs)
+
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(tokenize_workers, thread_name_prefix="eval-tokenize") as tokenize_pool, \
+                ThreadPoolExecutor(postprocess_workers, thread_name_prefix="eval-postprocess") as postprocess_pool:
+            tokenized = deque(tokenize_pool.submit(tokenize, batch) for batch in batches[:prefetch])
+            next_batch = len(tokenized)
+            postprocessed = []
+            for batch in tqdm(batches, desc=desc):
+                start = time.perf_counter()
+                inputs = tokenized.popleft().result()
+                waiting_for_input_s += time.perf_counter() - start
+                if next_batch < len(batches):
+                    tokenized.append(tokenize_pool.submit(tokenize, batches[next_batch]))
+                    next_batch += 1
+
+                with generate_timer.track(len(batch)):
+                    new_tokens = generate_fn(inputs)
+                postprocessed.append(postprocess_pool.submit(postprocess, batch, new_tokens))
+
+            generation_done = time.perf_counter()
+            for future in postprocessed:
+                results.update(future.result())
+        wall_s = time.perf_counter() - wall_start
+    finally:
+        tokenizer.padding_side = padding_side
+
+    stages = {
+        "tokenize": tokenize_timer.summary(wall_s),
+        "generate": {**generate_timer.summary(wall_s), "waiting_for_input_s": waiting_for_input_s},
+        "postprocess": postprocess_timer.summary(wall_s),
+    }
+    report = {
+        "wall_s": wall_s,
+        "prefetch_batches": prefetch,
+        # 生成结束后还要等后处理收尾的时间；很长说明后处理跟不上
+        "postprocess_drain_s": wall_s - (generation_done - wall_start),
+        "stages": stages,
+        "bottleneck": max(stages, key=lambda name: stages[name]["utilization"]),
+    }
+    return results, report
+
+
+def print_stage_report(report):
+    """One line per stage: busy time and utilization."""
+    print(f"\n--- Pipeline stages (wall {report['wall_s']:.2f}s, bottleneck: {report['bottleneck']}) ---")
+    for name, stage in report["stages"].items():
+        print(f"{name:>11} | {stage['workers']} worker(s) | busy {stage['busy_s']:7.2f}s | utilization {stage['utilization']:6.1%}")
+    print(f"生成线程等待分词 {report['stages']['generate']['waiting_for_input_s']:.2f}s，"
+          f"生成结束后等待后处理 {report['postprocess_drain_s']:.2f}s")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Prompt-lookup 投机解码。
+
+工具调用的参数 (keyword / title / date) 基本都是从用户问题里原样复制的，
+所以直接用已生成序列的末尾 n-gram 去 prompt 里匹配，把匹配位置之后的 token
+作为草稿，一次前向同时验证，接受与 greedy 预测一致的最长前缀。
+输出与 greedy 解码逐 token 相同。
+"""
+import time
+import torch
+from transformers import DynamicCache
+
+# --- 默认配置 ---
+PROMPT_LOOKUP_MAX_NGRAM = 3
+PROMPT_LOOKUP_NUM_TOKENS = 10
+
+
+def find_draft_tokens(input_ids, max_ngram_size=PROMPT_LOOKUP_MAX_NGRAM, num_pred_tokens=PROMPT_LOOKUP_NUM_TOKENS):
+    """
+    Matches the trailing n-gram of `input_ids` (1-D tensor) against earlier positions and
+    returns the tokens that followed the most recent match. Longer n-grams are tried first.
+    """
+    seq_len = input_ids.shape[0]
+    for ngram_size in range(min(max_ngram_size, seq_len - 1), 0, -1):
+        ngram = input_ids[-ngram_size:]
+        windows = input_ids[:-1].unfold(0, ngram_size, 1)
+        match_starts = (windows == ngram).all(dim=1).nonzero().flatten()
+        # 从最近的匹配开始找，跳过没有后续 token 的匹配
+        for start in reversed(match_starts.tolist()):
+            draft_start = start + ngram_size
+            if draft_start < seq_len:
+                return input_ids[draft_start:draft_start + num_pred_tokens]
+    return input_ids.new_empty(0)
+
+
+class PromptLookupStats:
+    """Accumulates acceptance and timing counters across evaluation rows."""
+
+    def __init__(self):
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.new_tokens = 0
+        self.forward_passes = 0
+        self.lookup_time = 0.0
+        self.generate_time = 0.0
+        self.compared_rows = 0
+        self.mismatched_rows = 0
+
+    def summary(self):
+        return {
+            "acceptance_rate": self.accepted_tokens / self.draft_tokens if self.draft_tokens > 0 else 0,
+            "draft_tokens": self.draft_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "tokens_per_forward": self.new_tokens / self.forward_passes if self.forward_passes > 0 else 0,
+            "prompt_lookup_time_s": self.lookup_time,
+            "generate_time_s": self.generate_time,
+            "speedup": self.generate_time / self.lookup_time if self.lookup_time > 0 else 0,
+            "compared_rows": self.compared_rows,
+            "mismatched_rows": self.mismatched_rows,
+        }
+
+
+@torch.no_grad()
+def prompt_lookup_generate(model, input_ids, max_new_tokens=150, eos_token_id=None,
+                           max_ngram_size=PROMPT_LOOKUP_MAX_NGRAM,
+                           num_pred_tokens=PROMPT_LOOKUP_NUM_TOKENS, stats=None):
+    """
+    Greedy decoding with prompt-lookup drafts. `input_ids` is a (1, seq_len) tensor;
+    returns a (1, seq_len + new_tokens) tensor like `model.generate`.
+    """
+    if eos_token_id is None:
+        eos_token_id = model.generation_config.eos_token_id
+    eos_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+
+    cache = DynamicCache()
+    outputs = model(input_ids=input_ids, past_key_values=cache, use_cache=True)
+    next_token = outputs.logits[0, -1].argmax()
+    sequence = torch.cat([input_ids[0], next_token.view(1)])
+    forward_passes = 1
+    new_tokens = 1
+
+    while new_tokens < max_new_tokens and next_token.item() not in eos_ids:
+        draft = find_draft_tokens(sequence, max_ngram_size, num_pred_tokens)
+        draft = draft[:max_new_tokens - new_tokens - 1]
+
+        # 一次前向：[next_token] + 草稿，得到每个位置的 greedy 预测
+        verify_ids = torch.cat([next_token.view(1), draft]).unsqueeze(0)
+        outputs = model(input_ids=verify_ids, past_key_values=cache, use_cache=True)
+        predictions = outputs.logits[0].argmax(dim=-1)
+        forward_passes += 1
+
+        accepted = 0
+        while accepted < draft.shape[0] and draft[accepted] == predictions[accepted]:
+            accepted += 1
+
+        # 丢弃未被接受的草稿对应的 KV
+        cache.crop(sequence.shape[0] + accepted)
+
+        emitted = torch.cat([draft[:accepted], predictions[accepted:accepted + 1]])
+        for position, token in enumerate(emitted.tolist()):
+            if token in eos_ids:
+                emitted = emitted[:position + 1]
+                break
+
+        if stats is not None:
+            stats.draft_tokens += draft.shape[0]
+            stats.accepted_tokens += accepted
+
+        sequence = torch.cat([sequence, emitted])
+        new_tokens += emitted.shape[0]
+        next_token = emitted[-1]
+
+    if stats is not None:
+        stats.new_tokens += new_tokens
+        stats.forward_passes += forward_passes
+
+    return sequence[:input_ids.shape[1] + max_new_tokens].unsqueeze(0)
+
+
+def generate_and_compare(model, inputs, stats, **generate_kwargs):
+    """
+    Runs prompt-lookup decoding and plain `model.generate` on the same inputs, records both
+    timings in `stats`, and returns the prompt-lookup output.
+    """
+    max_new_tokens = generate_kwargs.get("max_new_tokens", 150)
+
+    start = time.perf_counter()
+    lookup_outputs = prompt_lookup_generate(
+        model, inputs["input_ids"], max_new_tokens=max_new_tokens, stats=stats
+    )
+    stats.lookup_time += time.perf_counter() - start
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        reference_outputs = model.generate(**inputs, **generate_kwargs)
+    stats.generate_time += time.perf_counter() - start
+
+    stats.compared_rows += 1
+    if not torch.equal(lookup_outputs[0], reference_outputs[0]):
+        stats.mismatched_rows += 1
+
+    return lookup_outputs
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+路由场景的词表裁剪。
+
+Gemma-3 的 ~256k 词表 (embedding 与 tied LM head) 占了大部分参数，但中文工具路由只会用到
+其中很小一部分。这里扫描训练语料、BASE_PROMPT 和 TOOLS 里出现过的 token，只保留这些行，
+并提供一个把原 token id 映射到新 id 的 tokenizer 包装。裁剪后会在 test.parquet 上对比 greedy
+输出，确认与裁剪前完全一致。
+
+用法 (在 6.merge_base_lora.py 之后运行):
+    python prune_vocab.py --model_path ./models/merged_gemma_lora
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModelForCausalLM, BatchEncoding
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from utils import load_script
+from data_io import read_table
+
+MERGED_MODEL_PATH = "./models/merged_gemma_lora"
+PRUNED_MODEL_PATH = "./models/merged_gemma_lora_pruned"
+CORPUS_DATA_FILES = ["./data/finetuning_data.parquet", "./data/train.parquet", "./data/test.parquet"]
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+REPORT_FILE = os.path.join(RESULTS_DIR, "vocab_pruning_report.json")
+VOCAB_MAP_NAME = "vocab_map.json"
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+BYTE_TOKEN_PATTERN = re.compile(r"^<0x[0-9A-F]{2}>$")
+
+
+# --- 统计用到的 token ---
+def collect_corpus_texts():
+    """Training/test data rows plus every string the generator can put into a prompt or label."""
+    generator = load_script("1.generate_data.py")
+    texts = []
+
+    for data_file in CORPUS_DATA_FILES:
+        if os.path.exists(data_file):
+            df = read_table(data_file, columns=["text", "label"])
+            texts.extend(df["text"].astype(str).tolist())
+            texts.extend(df["label"].astype(str).tolist())
+        else:
+            print(f"⚠️ 警告: 语料文件 '{data_file}' 不存在，跳过。")
+
+    for tool_name, tool_info in generator.TOOLS.items():
+        definition = json.dumps(tool_info["definition"], ensure_ascii=False, indent=2)
+        texts.append(generator.BASE_PROMPT.format(tool_definition=definition, user_question=""))
+        texts.extend(tool_info["question_templates"])
+        for samples in tool_info["arguments_samples"].values():
+            texts.extend(str(sample) for sample in samples)
+        texts.append("output：" + json.dumps({"tool_name": tool_name, "arguments": {}}, ensure_ascii=False))
+    return texts
+
+
+def collect_used_token_ids(tokenizer, texts, generation_config=None):
+    used_ids = set(tokenizer.all_special_ids)
+    for token_id in (tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id, tokenizer.unk_token_id):
+        if token_id is not None:
+            used_ids.add(token_id)
+    if generation_config is not None and generation_config.eos_token_id is not None:
+        eos = generation_config.eos_token_id
+        used_ids.update(eos if isinstance(eos, (list, tuple)) else [eos])
+
+    # 保留 byte-fallback token，裁剪后遇到词表外的 token 时可以退化成字节序列
+    for token, token_id in tokenizer.get_vocab().items():
+        if BYTE_TOKEN_PATTERN.match(token):
+            used_ids.add(token_id)
+
+    for start in tqdm(range(0, len(texts), 256), desc="Scanning corpus"):
+        encoded = tokenizer(texts[start:start + 256], add_special_tokens=True)["input_ids"]
+        for ids in encoded:
+            used_ids.update(ids)
+    return sorted(used_ids)
+
+
+# --- 裁剪后的 tokenizer 包装 ---
+class PrunedTokenizer:
+    """
+    Wraps the original tokenizer and remaps token ids between the full vocabulary and the
+    pruned one. Tokens outside the pruned vocabulary are re-encoded as byte-fallback tokens
+    when possible, otherwise mapped to the unk token.
+    """
+
+    def __init__(self, tokenizer, kept_ids):
+        self.tokenizer = tokenizer
+        self.kept_ids = list(kept_ids)
+        self.old_to_new = {old_id: new_id for new_id, old_id in enumerate(self.kept_ids)}
+        self.oov_count = 0
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+    def __len__(self):
+        return len(self.kept_ids)
+
+    def _map_id(self, token_id):
+        return self.old_to_new.get(token_id) if token_id is not None else None
+
+    @property
+    def bos_token_id(self):
+        return self._map_id(self.tokenizer.bos_token_id)
+
+    @property
+    def eos_token_id(self):
+        return self._map_id(self.tokenizer.eos_token_id)
+
+    @property
+    def pad_token_id(self):
+        return self._map_id(self.tokenizer.pad_token_id)
+
+    @property
+    def unk_token_id(self):
+        return self._map_id(self.tokenizer.unk_token_id)
+
+    def _encode_oov(self, old_id):
+        self.oov_count += 1
+        token = self.tokenizer.convert_ids_to_tokens(old_id)
+        byte_ids = [
+            self.old_to_new.get(self.tokenizer.convert_tokens_to_ids(f"<0x{byte:02X}>"))
+            for byte in token.replace("▁", " ").encode("utf-8")
+        ]
+        if byte_ids and all(byte_id is not None for byte_id in byte_ids):
+            return byte_ids
+        return [self.unk_token_id]
+
+    def to_new_ids(self, ids):
+        new_ids = []
+        for old_id in ids:
+            new_id = self.old_to_new.get(old_id)
+            if new_id is None:
+                new_ids.extend(self._encode_oov(old_id))
+            else:
+                new_ids.append(new_id)
+        return new_ids
+
+    def to_old_ids(self, ids):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.tolist()
+        return [self.kept_ids[new_id] for new_id in ids]
+
+    def __call__(self, text, return_tensors=None, max_length=None, truncation=False, padding=False, **kwargs):
+        encoded = self.tokenizer(text, **kwargs)
+        is_batched = not isinstance(text, str)
+        rows = encoded["input_ids"] if is_batched else [encoded["input_ids"]]
+        rows = [self.to_new_ids(row) for row in rows]
+        if truncation and max_length is not None:
+            if self.tokenizer.truncation_side == "left":
+                rows = [row[-max_length:] for row in rows]
+            else:
+                rows = [row[:max_length] for row in rows]
+        attention_mask = [[1] * len(row) for row in rows]
+        if padding:
+            # 映射后各行长度可能变化 (OOV 拆成字节)，所以在映射之后再补齐
+            width = max(len(row) for row in rows)
+            pads = [width - len(row) for row in rows]
+            if self.padding_side == "left":
+                rows = [[self.pad_token_id] * pad + row for row, pad in zip(rows, pads)]
+                attention_mask = [[0] * pad + mask for mask, pad in zip(attention_mask, pads)]
+            else:
+                rows = [row + [self.pad_token_id] * pad for row, pad in zip(rows, pads)]
+                attention_mask = [mask + [0] * pad for mask, pad in zip(attention_mask, pads)]
+        # 与 HF tokenizer 一致：返回张量时单条文本也带 batch 维度
+        if is_batched or return_tensors is not None:
+            data = {"input_ids": rows, "attention_mask": attention_mask}
+        else:
+            data = {"input_ids": rows[0], "attention_mask": attention_mask[0]}
+        return BatchEncoding(data, tensor_type=return_tensors)
+
+    def decode(self, ids, **kwargs):
+        return self.tokenizer.decode(self.to_old_ids(ids), **kwargs)
+
+    def batch_decode(self, sequences, **kwargs):
+        return [self.decode(ids, **kwargs) for ids in sequences]
+
+    def save_pretrained(self, output_dir):
+        self.tokenizer.save_pretrained(output_dir)
+        with open(os.path.join(output_dir, VOCAB_MAP_NAME), "w", encoding="utf-8") as f:
+            json.dump({"kept_ids": self.kept_ids}, f)
+
+    @classmethod
+    def from_pretrained(cls, model_dir, **kwargs):
+        tokenizer = AutoTokenizer.from_pretrained(model_dir, **kwargs)
+        with open(os.path.join(model_dir, VOCAB_MAP_NAME), "r", encoding="utf-8") as f:
+            kept_ids = json.load(f)["kept_ids"]
+        return cls(tokenizer, kept_ids)
+
+
+# --- 裁剪模型 ---
+def prune_model(model, kept_ids):
+    """Slices the input embedding and LM head rows down to `kept_ids` (in place)."""
+    old_to_new = {old_id: new_id for new_id, old_id in enumerate(kept_ids)}
+    index = torch.tensor(kept_ids, dtype=torch.long, device=model.get_input_embeddings().weight.device)
+
+    embeddings = model.get_input_embeddings()
+    embeddings.weight = torch.nn.Parameter(embeddings.weight.data.index_select(0, index).clone())
+    embeddings.num_embeddings = len(kept_ids)
+    if embeddings.padding_idx is not None:
+        embeddings.padding_idx = old_to_new.get(embeddings.padding_idx)
+
+    lm_head = model.get_output_embeddings()
+    if getattr(model.config, "tie_word_embeddings", False):
+        lm_head.weight = embeddings.weight
+    else:
+        lm_head.weight = torch.nn.Parameter(lm_head.weight.data.index_select(0, index).clone())
+    lm_head.out_features = len(kept_ids)
+
+    def _remap(token_id):
+        if isinstance(token_id, (list, tuple)):
+            return [old_to_new[t] for t in token_id if t in old_to_new]
+        return old_to_new.get(token_id) if token_id is not None else None
+
+    model.config.vocab_size = len(kept_ids)
+    for config in (model.config, model.generation_config):
+        for attr in ("bos_token_id", "eos_token_id", "pad_token_id"):
+            if getattr(config, attr, None) is not None:
+                setattr(config, attr, _remap(getattr(config, attr)))
+    return model
+
+
+# --- 校验 ---
+def verify_outputs(original_model, original_tokenizer, pruned_model, pruned_tokenizer, val_file, num_samples=None):
+    """Greedy-decodes test.parquet prompts with both models and counts rows whose output tokens differ."""
+    df = read_table(val_file, columns=["text"])
+    if num_samples:
+        df = df.head(num_samples)
+
+    mismatches = []
+    for i, row in tqdm(df.iterrows(), total=df.shape[0], desc="Verifying"):
+        prompt = row["text"]
+
+        inputs = original_tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+        with torch.no_grad():
+            outputs = original_model.generate(
+                **inputs, max_new_tokens=150, pad_token_id=original_tokenizer.eos_token_id, do_sample=False, top_p=None, top_k=None
+            )
+        original_ids = outputs[0][len(inputs["input_ids"][0]):].tolist()
+
+        pruned_inputs = pruned_tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+        with torch.no_grad():
+            pruned_outputs = pruned_model.generate(
+                **pruned_inputs, max_new_tokens=150, pad_token_id=pruned_tokenizer.eos_token_id, do_sample=False, top_p=None, top_k=None
+            )
+        pruned_ids = pruned_tokenizer.to_old_ids(pruned_outputs[0][len(pruned_inputs["input_ids"][0]):])
+
+        if original_ids != pruned_ids:
+            mismatches.append({
+                "row": int(i),
+                "original": original_tokenizer.decode(original_ids, skip_special_tokens=True),
+                "pruned": original_tokenizer.decode(pruned_ids, skip_special_tokens=True),
+            })
+    return df.shape[0], mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prune the vocabulary of the merged model to the tokens used by the routing domain.")
+    parser.add_argument("--model_path", type=str, default=MERGED_MODEL_PATH, help="Merged model to prune.")
+    parser.add_argument("--output_path", type=str, default=PRUNED_MODEL_PATH, help="Where to save the pruned model and tokenizer.")
+    parser.add_argument("--num_samples", type=int, default=None, help="Number of test.parquet rows to verify. Defaults to all.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+
+    print(f"🔄 正在从 '{args.model_path}' 加载模型和分词器...")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(args.model_path, trust_remote_code=True, torch_dtype=dtype).to(device)
+    model.eval()
+    original_params = sum(p.numel() for p in model.parameters())
+
+    print("🔄 正在扫描语料、BASE_PROMPT 和 TOOLS 中用到的 token...")
+    kept_ids = collect_used_token_ids(tokenizer, collect_corpus_texts(), model.generation_config)
+    print(f"✅ 保留 {len(kept_ids)} / {len(tokenizer)} 个 token。")
+
+    pruned_model = AutoModelForCausalLM.from_pretrained(args.model_path, trust_remote_code=True, torch_dtype=dtype).to(device)
+    pruned_model = prune_model(pruned_model, kept_ids).eval()
+    pruned_tokenizer = PrunedTokenizer(tokenizer, kept_ids)
+    pruned_params = sum(p.numel() for p in pruned_model.parameters())
+    print(f"✅ 参数量 {original_params / 1e6:.1f}M -> {pruned_params / 1e6:.1f}M")
+
+    print(f"🔄 正在 {PROMPT_VAL_FILE} 上校验裁剪前后输出是否一致...")
+    total_rows, mismatches = verify_outputs(model, tokenizer, pruned_model, pruned_tokenizer, PROMPT_VAL_FILE, args.num_samples)
+
+    report = {
+        "original_vocab_size": len(tokenizer),
+        "pruned_vocab_size": len(kept_ids),
+        "original_parameters": original_params,
+        "pruned_parameters": pruned_params,
+        "verified_rows": total_rows,
+        "mismatched_rows": len(mismatches),
+        "oov_tokens_during_verification": pruned_tokenizer.oov_count,
+        "mismatches": mismatches,
+    }
+    with open(REPORT_FILE, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 报告已保存至: {REPORT_FILE}")
+
+    if mismatches:
+        print(f"❌ 有 {len(mismatches)} / {total_rows} 条输出与裁剪前不一致，未保存裁剪模型。")
+        sys.exit(1)
+
+    pruned_model.save_pretrained(args.output_path)
+    pruned_tokenizer.save_pretrained(args.output_path)
+    print(f"🎉 输出完全一致，裁剪后的模型已保存至: {args.output_path}")
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+合并后模型的 int8 动态量化 (CPU 推理)。
+
+线性层权重离线量化为 int8，激活在推理时动态量化；embedding 保持原精度。
+量化后的模型无法用 save_pretrained 保存，这里保存 config + tokenizer + state_dict，
+加载时先按 config 建出同结构的量化模型再载入权重。
+"""
+import os
+import json
+import torch
+from torch.ao.quantization import quantize_dynamic
+from transformers import AutoConfig, AutoModelForCausalLM, AutoTokenizer
+
+QUANTIZED_WEIGHTS_NAME = "quantized_model.pt"
+QUANTIZATION_CONFIG_NAME = "quantization_config.json"
+
+
+def quantize_int8(model):
+    """Applies int8 dynamic quantization to every nn.Linear (including lm_head)."""
+    model = model.to("cpu", dtype=torch.float32).eval()
+    return quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def save_quantized_model(quantized_model, tokenizer, output_dir, source_model_path=None):
+    """`source_model_path` is the fp model that was quantized; 3.run_evaluation uses it as the reference."""
+    os.makedirs(output_dir, exist_ok=True)
+    quantized_model.config.save_pretrained(output_dir)
+    quantized_model.generation_config.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    torch.save(quantized_model.state_dict(), os.path.join(output_dir, QUANTIZED_WEIGHTS_NAME))
+    with open(os.path.join(output_dir, QUANTIZATION_CONFIG_NAME), "w", encoding="utf-8") as f:
+        json.dump({
+            "method": "dynamic",
+            "dtype": "qint8",
+            "modules": ["Linear"],
+            "torch_version": torch.__version__,
+            "source_model_path": source_model_path,
+        }, f, indent=2)
+
+
+def quantized_source_model(model_dir):
+    """The fp model a quantized artifact was made from, or None for artifacts saved without it."""
+    config_file = os.path.join(model_dir, QUANTIZATION_CONFIG_NAME)
+    if not os.path.exists(config_file):
+        return None
+    with open(config_file, "r", encoding="utf-8") as f:
+        return json.load(f).get("source_model_path")
+
+
+def load_quantized_model(model_dir):
+    """Rebuilds the quantized module structure from config and loads the saved int8 weights."""
+    config = AutoConfig.from_pretrained(model_dir, trust_remote_code=True)
+    model = AutoModelForCausalLM.from_config(config, trust_remote_code=True, torch_dtype=torch.float32)
+    model = quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    # packed params 不是普通张量，不能用 weights_only 加载
+    state_dict = torch.load(os.path.join(model_dir, QUANTIZED_WEIGHTS_NAME), map_location="cpu", weights_only=False)
+    model.load_state_dict(state_dict)
+    model.generation_config = model.generation_config.from_pretrained(model_dir)
+    tokenizer = AutoTokenizer.from_pretrained(model_dir, trust_remote_code=True)
+    return model, tokenizer
+
+
+def model_memory_bytes(model):
+    """Bytes held by parameters, buffers and packed quantized weights (tied tensors counted once)."""
+    seen = set()
+    total = 0
+
+    def _add(tensor):
+        nonlocal total
+        if not isinstance(tensor, torch.Tensor):
+            return
+        key = (tensor.untyped_storage().data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if key in seen:
+            return
+        seen.add(key)
+        total += tensor.numel() * tensor.element_size()
+
+    for tensor in model.state_dict().values():
+        if isinstance(tensor, tuple):
+            for item in tensor:
+                _add(item)
+        else:
+            _add(tensor)
+    return total
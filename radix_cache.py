@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+基于 radix tree 的前缀 KV 缓存。
+
+不同请求暴露的工具子集不同，渲染出的 prompt 共享 BASE_PROMPT 的头部，然后在工具定义块处分叉。
+单一的全局前缀缓存无法覆盖这种情况。这里以 token id 为键建一棵 radix tree，每条边保存这段
+token 的 past_key_values 片段：头部是一条边，"头部 + 某个工具组合" 在分叉处各自成为子节点。
+新请求沿树匹配最长前缀 (边的中间也可以命中，因果注意力下前缀的 KV 不依赖后面的 token)，
+只需要 prefill 没见过的后缀。节点带引用计数，总显存/内存超过预算时按 LRU 淘汰叶子节点。
+
+只缓存到工具定义块结束为止，用户问题部分每次都不同，不进入缓存。
+
+用法:
+    python radix_cache.py --num_requests 50 --top_k 2 --max_cache_mb 512
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from data_io import read_table
+from utils import load_script, extract_user_question, TOOL_BLOCK_END
+
+BASE_MODEL_PATH = "./models/gemma-3-270m-it"
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "radix_cache_results.json")
+DEFAULT_MAX_CACHE_MB = 512
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _layer_kv(cache):
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+class RadixNode:
+    __slots__ = ("token_ids", "kv", "children", "parent", "ref_count", "last_access")
+
+    def __init__(self, token_ids=(), kv=(), parent=None):
+        self.token_ids = tuple(token_ids)
+        self.kv = kv  # 每层 (key, value)，形状 (1, heads, len(token_ids), head_dim)
+        self.children = {}
+        self.parent = parent
+        self.ref_count = 0
+        self.last_access = time.monotonic()
+
+    def nbytes(self):
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in self.kv)
+
+
+class RadixKVCache:
+    """Token-id radix tree whose edges hold the KV cache segment for their tokens."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_CACHE_MB * 1024 ** 2):
+        self.root = RadixNode()
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hit_depths = []
+        self.prompt_lengths = []
+        self.evictions = 0
+
+    # --- 查找 ---
+    def match(self, token_ids):
+        """
+        Longest cached prefix of `token_ids`. Returns (path, depth) where path is a list of
+        (node, used_length) pairs; the last node may be matched only partially.
+        """
+        node, depth, path = self.root, 0, []
+        while depth < len(token_ids):
+            child = node.children.get(token_ids[depth])
+            if child is None:
+                break
+            matched = 0
+            edge = child.token_ids
+            while matched < len(edge) and depth + matched < len(token_ids) and edge[matched] == token_ids[depth + matched]:
+                matched += 1
+            path.append((child, matched))
+            depth += matched
+            if matched < len(edge):
+                break
+            node = child
+        return path, depth
+
+    def acquire(self, path):
+        now = time.monotonic()
+        for node, _ in path:
+            node.ref_count += 1
+            node.last_access = now
+
+    def release(self, path):
+        for node, _ in path:
+            node.ref_count -= 1
+
+    def build_cache(self, path):
+        """Concatenates the KV segments along `path` into a fresh DynamicCache for one request."""
+        cache = DynamicCache()
+        if not path:
+            return cache
+        num_layers = len(path[0][0].kv)
+        for layer_idx in range(num_layers):
+            keys = torch.cat([node.kv[layer_idx][0][:, :, :used] for node, used in path], dim=2)
+            values = torch.cat([node.kv[layer_idx][1][:, :, :used] for node, used in path], dim=2)
+            cache.update(keys, values, layer_idx)
+        return cache
+
+    # --- 插入 ---
+    def _split(self, node, offset):
+        """Splits `node`'s edge at `offset`; returns the new upper node."""
+        upper = RadixNode(
+            node.token_ids[:offset],
+            [(k[:, :, :offset].clone(), v[:, :, :offset].clone()) for k, v in node.kv],
+            node.parent,
+        )
+        # 持有引用的请求记录的是原节点 (现在的下半段)，release 只会减它；新的上半段从 0 开始，
+        # 只要下半段还在，上半段就不是叶子，不会被淘汰
+        upper.last_access = node.last_access
+        old_bytes = node.nbytes()
+        node.parent.children[node.token_ids[0]] = upper
+        node.token_ids = node.token_ids[offset:]
+        node.kv = [(k[:, :, offset:].clone(), v[:, :, offset:].clone()) for k, v in node.kv]
+        node.parent = upper
+        upper.children[node.token_ids[0]] = node
+        self.total_bytes += upper.nbytes() + node.nbytes() - old_bytes
+        return upper
+
+    def insert(self, token_ids, cache):
+        """Stores the KV for `token_ids` (the first len(token_ids) positions of `cache`)."""
+        layer_kv = _layer_kv(cache)
+        node, depth = self.root, 0
+        while depth < len(token_ids):
+            child = node.children.get(token_ids[depth])
+            if child is None:
+                new_node = RadixNode(
+                    token_ids[depth:],
+                    [(k[:, :, depth:len(token_ids)].clone(), v[:, :, depth:len(token_ids)].clone()) for k, v in layer_kv],
+                    node,
+                )
+                node.children[token_ids[depth]] = new_node
+                self.total_bytes += new_node.nbytes()
+                break
+            edge = child.token_ids
+            matched = 0
+            while matched < len(edge) and depth + matched < len(token_ids) and edge[matched] == token_ids[depth + matched]:
+                matched += 1
+            if matched < len(edge):
+                child = self._split(child, matched)
+            child.last_access = time.monotonic()
+            node = child
+            depth += matched
+        self._evict()
+
+    # --- 淘汰 ---
+    def _remove(self, node):
+        self.total_bytes -= node.nbytes()
+        del node.parent.children[node.token_ids[0]]
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            leaves = []
+            stack = list(self.root.children.values())
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node.ref_count == 0:
+                    leaves.append(node)
+            if not leaves:
+                break
+            self._remove(min(leaves, key=lambda n: n.last_access))
+            self.evictions += 1
+
+    # --- 统计 ---
+    def record(self, hit_depth, prompt_length):
+        self.hit_depths.append(hit_depth)
+        self.prompt_lengths.append(prompt_length)
+
+    def summary(self):
+        depths = np.array(self.hit_depths or [0])
+        lengths = np.array(self.prompt_lengths or [1])
+        return {
+            "requests": len(self.hit_depths),
+            "hit_rate": float((depths > 0).mean()),
+            "mean_hit_depth": float(depths.mean()),
+            "hit_depth_percentiles": {p: float(np.percentile(depths, p)) for p in (0, 25, 50, 75, 90, 100)},
+            "reused_token_ratio": float(depths.sum() / lengths.sum()),
+            "cached_mib": self.total_bytes / 1024 ** 2,
+            "evictions": self.evictions,
+        }
+
+
+def tool_block_end(tokenizer, prompt, input_ids):
+    """Token index where the tool-definition block ends (the cacheable prefix length)."""
+    char_end = prompt.rfind(TOOL_BLOCK_END)
+    if char_end < 0:
+        return 0
+    if tokenizer.is_fast:
+        offsets = tokenizer(prompt, return_offsets_mapping=True)["offset_mapping"]
+        for token_index, (start, end) in enumerate(offsets):
+            if end > char_end:
+                return token_index
+        return len(input_ids)
+    return len(tokenizer(prompt[:char_end])["input_ids"])
+
+
+@torch.no_grad()
+def generate_with_radix_cache(model, tokenizer, radix_cache, prompt, max_new_tokens=150):
+    """Greedy generation that reuses and extends the radix cache. Returns the generated text."""
+    inputs = tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+    input_ids = inputs["input_ids"]
+    token_ids = input_ids[0].tolist()
+    cache_end = min(tool_block_end(tokenizer, prompt, token_ids), len(token_ids) - 1)
+
+    path, depth = radix_cache.match(token_ids[:len(token_ids) - 1])
+    radix_cache.acquire(path)
+    try:
+        cache = radix_cache.build_cache(path)
+        radix_cache.record(depth, len(token_ids))
+
+        # 先 prefill 到工具定义块末尾，并把这段前缀写回树里
+        if depth < cache_end:
+            model(input_ids=input_ids[:, depth:cache_end], past_key_values=cache, use_cache=True)
+            radix_cache.insert(token_ids[:cache_end], cache)
+
+        outputs = model.generate(
+            **inputs,
+            past_key_values=cache,
+            max_new_tokens=max_new_tokens,
+            pad_token_id=tokenizer.eos_token_id,
+            do_sample=False,
+            top_p=None,
+            top_k=None
+        )
+    finally:
+        radix_cache.release(path)
+    return tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the radix-tree prefix KV cache on prompts with varying tool subsets.")
+    parser.add_argument("--model_path", type=str, default=BASE_MODEL_PATH, help="Model to run.")
+    parser.add_argument("--num_requests", type=int, default=50, help="Number of test.parquet questions to replay.")
+    parser.add_argument("--top_k", type=int, default=2, help="Tools rendered per prompt by the retriever; different questions get different subsets.")
+    parser.add_argument("--max_cache_mb", type=float, default=DEFAULT_MAX_CACHE_MB, help="Memory budget of the radix cache.")
+    parser.add_argument("--max_new_tokens", type=int, default=150, help="Tokens generated per request.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    generator = load_script("1.generate_data.py")
+    from tool_retrieval import ToolRetriever
+    retriever = ToolRetriever(generator.TOOLS)
+
+    df = read_table(PROMPT_VAL_FILE, columns=["text"]).head(args.num_requests)
+    prompts = [
+        retriever.build_prompt(generator.BASE_PROMPT, extract_user_question(text), args.top_k) for text in df["text"]
+    ]
+
+    print("Loading tokenizer and model...")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_path,
+        trust_remote_code=True,
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+    ).to(device).eval()
+
+    radix_cache = RadixKVCache(max_bytes=int(args.max_cache_mb * 1024 ** 2))
+    start = time.perf_counter()
+    cached_texts = [generate_with_radix_cache(model, tokenizer, radix_cache, prompt, args.max_new_tokens) for prompt in prompts]
+    cached_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    plain_texts = []
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt", max_length=2048, truncation=True).to(device)
+        with torch.no_grad():
+            outputs = model.generate(**inputs, max_new_tokens=args.max_new_tokens, pad_token_id=tokenizer.eos_token_id, do_sample=False, top_p=None, top_k=None)
+        plain_texts.append(tokenizer.decode(outputs[0][inputs["input_ids"].shape[1]:], skip_special_tokens=True))
+    plain_time = time.perf_counter() - start
+
+    summary = radix_cache.summary()
+    summary.update({
+        "radix_cache_time_s": cached_time,
+        "plain_generate_time_s": plain_time,
+        "speedup": plain_time / cached_time if cached_time > 0 else 0,
+        "mismatched_outputs": sum(a != b for a, b in zip(cached_texts, plain_texts)),
+    })
+    print("\n--- Radix Cache Summary ---")
+    print(json.dumps(summary, indent=2))
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"\n✅ Summary saved to {RESULTS_FILE}")
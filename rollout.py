@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+多轮工具链 rollout。
+
+评估脚本只给第一步打分，但 BASE_PROMPT 里的链式调用 (get_current_date -> create_calendar_event_api -> 最终回答)
+需要多次调用模型。这里给 TOOLS 里的每个工具提供本地 mock 实现，把 `[tool_code]` / `[tool_result]` 块按
+BASE_PROMPT 示例的格式追加到 prompt 里，一直跑到模型给出自然语言回答 (或超过最大轮数)。
+所有对话按轮次同步 (lockstep) 批量生成：每一轮把仍在进行中的对话拼成一个 batch。
+
+统计端到端成功率、每个任务的模型调用次数和整条链的耗时。模型调用次数决定了线上路由的真实成本。
+成功要求第一步调用的工具正确，并且最后一次工具调用 (工具名 + 参数) 与数据里记录的完整链 (chain 列) 的最后一步一致；
+多步链里的相对日期 ("今天"、"明天") 按 mock 的当前日期换算。第一步的工具准确率单独统计。
+
+用法:
+    python rollout.py --num_samples 100 --batch_size 16
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+from collections import Counter
+import numpy as np
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from data_io import read_table
+from utils import load_script, extract_user_question
+
+MERGED_MODEL_PATH = "./models/merged_gemma_lora"
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "rollout_results.json")
+DETAILED_RESULTS_FILE = os.path.join(RESULTS_DIR, "rollout_detailed_results.jsonl")
+DEFAULT_MAX_TURNS = 4
+
+# mock 环境里的 "今天"，与 BASE_PROMPT 示例保持一致
+MOCK_CURRENT_DATE = "2025-08-07"
+RELATIVE_DATE_OFFSETS = {"今天": 0, "明天": 1}
+MOCK_SUCCESS_MESSAGES = {
+    "clear_all_cache": "缓存已清除",
+    "clear_message_cache": "消息缓存已清除",
+    "clear_miniprogram_cache": "小程序缓存已清除",
+    "create_calendar_event_api": "日程已创建",
+    "create_calendar_event": "已打开页面",
+    "decrease_font_size": "字体已减小",
+    "get_calendar_events": "查询成功",
+    "increase_font_size": "字体已增大",
+    "search_contact": "查询成功",
+    "set_font_size": "已打开页面",
+    "upload_log": "已打开页面",
+}
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+generator = load_script("1.generate_data.py")
+evaluator = load_script("3.run_evaluation.py")
+
+
+def call_mock_tool(tool_name, arguments):
+    """
+    Local stand-in for a tool. Returns (result, ok); `ok` is False for unknown tools or missing
+    required arguments, which ends the rollout as a failure.
+    """
+    if tool_name not in generator.TOOLS:
+        return json.dumps({"status": "error", "message": f"未知工具: {tool_name}"}, ensure_ascii=False), False
+    if not isinstance(arguments, dict):
+        arguments = {}
+    required = generator.TOOLS[tool_name]["definition"].get("arguments", {}).get("required", [])
+    missing = [name for name in required if not arguments.get(name)]
+    if missing:
+        return json.dumps({"status": "error", "message": f"缺少参数: {', '.join(missing)}"}, ensure_ascii=False), False
+
+    if tool_name == "get_current_date":
+        return MOCK_CURRENT_DATE, True
+    result = {"status": "success", "message": MOCK_SUCCESS_MESSAGES.get(tool_name, "已完成")}
+    if tool_name == "get_calendar_events":
+        result["events"] = [{"title": "项目周会", "start_time": f"{arguments['date']} 10:00:00"}]
+    elif tool_name == "search_contact":
+        result["contacts"] = [{"name": arguments["keyword"], "employee_id": "12345"}]
+    return json.dumps(result, ensure_ascii=False), True
+
+
+def resolve_relative_dates(arguments):
+    """Replaces relative dates ("今天", "明天") with absolute dates in the mock environment."""
+    today = datetime.date.fromisoformat(MOCK_CURRENT_DATE)
+    return {
+        name: (today + datetime.timedelta(days=RELATIVE_DATE_OFFSETS[value])).isoformat() if value in RELATIVE_DATE_OFFSETS else value
+        for name, value in arguments.items()
+    }
+
+
+def render_history(steps):
+    """`[tool_code]` / `[tool_result]` blocks in the format of the BASE_PROMPT examples."""
+    blocks = []
+    for call, result in steps:
+        blocks.append(f"[tool_code]\n{json.dumps(call, ensure_ascii=False)}\n[/tool_code]")
+        blocks.append(f"[tool_result]\n{call['tool_name']}() -> {json.dumps(result, ensure_ascii=False)}\n[/tool_result]")
+    return "\n".join(blocks)
+
+
+def build_turn_prompt(first_prompt, steps):
+    """The first-turn prompt with the tool history inserted at the end of the user turn."""
+    if not steps:
+        return first_prompt
+    user_turn_end = first_prompt.rfind("<|im_end|>")
+    return first_prompt[:user_turn_end] + render_history(steps) + "\n" + first_prompt[user_turn_end:]
+
+
+class Conversation:
+    def __init__(self, question, prompt, label_tool, expected_chain=None):
+        self.question = question
+        self.prompt = prompt
+        self.label_tool = label_tool
+        # 期望的调用链，None 表示数据里没有记录 (旧数据中的 get_current_date 样本)，不参与成功率统计
+        self.expected_chain = expected_chain
+        self.steps = []
+        self.outputs = []
+        self.final_answer = None
+        self.error = None
+        self.model_calls = 0
+        self.latency = 0.0
+
+    @property
+    def done(self):
+        return self.final_answer is not None or self.error is not None
+
+    @property
+    def first_call_correct(self):
+        return bool(self.steps) and self.steps[0][0]["tool_name"] == self.label_tool
+
+    @property
+    def final_call(self):
+        return self.steps[-1][0] if self.steps else None
+
+    @property
+    def expected_final_call(self):
+        if not self.expected_chain:
+            return None
+        expected = self.expected_chain[-1]
+        arguments = expected.get("arguments", {})
+        # 只有先调用 get_current_date 的链才需要把相对日期换算成绝对日期；单步标签里的 "今天" 原样保留
+        if len(self.expected_chain) > 1:
+            arguments = resolve_relative_dates(arguments)
+        return {"tool_name": expected["tool_name"], "arguments": arguments}
+
+    @property
+    def final_call_correct(self):
+        expected = self.expected_final_call
+        if expected is None:
+            return None
+        return self.final_call == expected
+
+    @property
+    def success(self):
+        if self.expected_chain is None:
+            return None
+        return self.error is None and self.final_answer is not None and self.first_call_correct and self.final_call_correct
+
+    def to_dict(self):
+        return {
+            "question": self.question,
+            "label_tool": self.label_tool,
+            "expected_final_call": self.expected_final_call,
+            "tool_calls": [call for call, _ in self.steps],
+            "outputs": self.outputs,
+            "final_answer": self.final_answer,
+            "error": self.error,
+            "model_calls": self.model_calls,
+            "latency_s": self.latency,
+            "first_call_correct": self.first_call_correct,
+            "final_call_correct": self.final_call_correct,
+            "success": self.success,
+        }
+
+
+@torch.no_grad()
+def generate_batch(model, tokenizer, prompts, max_new_tokens=150):
+    padding_side = tokenizer.padding_side
+    tokenizer.padding_side = "left"
+    inputs = tokenizer(prompts, return_tensors="pt", padding=True, max_length=2048, truncation=True).to(model.device)
+    tokenizer.padding_side = padding_side
+    outputs = model.generate(
+        **inputs,
+        max_new_tokens=max_new_tokens,
+        pad_token_id=tokenizer.pad_token_id,
+        do_sample=False,
+        top_p=None,
+        top_k=None
+    )
+    return tokenizer.batch_decode(outputs[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True)
+
+
+def step(conversation, output):
+    """Applies one model output: runs the mock tool for a call, or records the final answer."""
+    conversation.outputs.append(output)
+    call = evaluator.extract_json_output(output)
+    if not isinstance(call, dict) or "tool_name" not in call:
+        conversation.final_answer = output.strip()
+        return
+    call = {"tool_name": call["tool_name"], "arguments": call.get("arguments", {})}
+    if any(call == previous for previous, _ in conversation.steps):
+        # 成功结果之后又重复调用同一个工具，违反 "判断任务完成" 规则
+        conversation.error = "repeated_call"
+        return
+    result, ok = call_mock_tool(call["tool_name"], call["arguments"])
+    conversation.steps.append((call, result))
+    if not ok:
+        conversation.error = "invalid_call"
+
+
+def run_rollouts(model, tokenizer, conversations, batch_size=16, max_turns=DEFAULT_MAX_TURNS, max_new_tokens=150):
+    """Runs every conversation to completion, batching the still-active ones turn by turn."""
+    for turn in range(max_turns):
+        active = [c for c in conversations if not c.done]
+        if not active:
+            break
+        for i in tqdm(range(0, len(active), batch_size), desc=f"Turn {turn + 1}"):
+            batch = active[i:i + batch_size]
+            start = time.perf_counter()
+            outputs = generate_batch(model, tokenizer, [build_turn_prompt(c.prompt, c.steps) for c in batch], max_new_tokens)
+            elapsed = time.perf_counter() - start
+            for conversation, output in zip(batch, outputs):
+                conversation.model_calls += 1
+                conversation.latency += elapsed
+                step(conversation, output)
+    for conversation in conversations:
+        if not conversation.done:
+            conversation.error = "max_turns"
+    return conversations
+
+
+def summarize(conversations):
+    calls = np.array([c.model_calls for c in conversations])
+    latencies = np.array([c.latency for c in conversations])
+    scored = [c for c in conversations if c.expected_chain is not None]
+    final_f1 = [
+        evaluator.calculate_argument_f1(c.final_call["arguments"], c.expected_final_call["arguments"])[2]
+        if c.final_call and c.final_call["tool_name"] == c.expected_final_call["tool_name"] else 0.0
+        for c in scored
+    ]
+    return {
+        "total_tasks": len(conversations),
+        "scored_tasks": len(scored),
+        "end_to_end_success_rate": float(np.mean([c.success for c in scored])) if scored else 0.0,
+        "first_call_accuracy": float(np.mean([c.first_call_correct for c in conversations])),
+        "final_call_tool_accuracy": float(np.mean([
+            c.final_call is not None and c.final_call["tool_name"] == c.expected_final_call["tool_name"] for c in scored
+        ])) if scored else 0.0,
+        "final_call_exact_match": float(np.mean([c.final_call_correct for c in scored])) if scored else 0.0,
+        "final_call_argument_f1": float(np.mean(final_f1)) if scored else 0.0,
+        "average_model_calls": float(calls.mean()),
+        "model_calls_distribution": {int(k): v for k, v in sorted(Counter(calls.tolist()).items())},
+        "average_chain_latency_s": float(latencies.mean()),
+        "p90_chain_latency_s": float(np.percentile(latencies, 90)),
+        "errors": dict(Counter(c.error for c in conversations if c.error)),
+    }
+
+
+def load_conversations(val_file, num_samples=None, retrieval_top_k=None):
+    """
+    Builds rollouts from test.parquet questions. The prompt is re-rendered with the whole catalog
+    (or the retriever's top-k) so later steps of a chain can see the tools they need.
+    """
+    df = read_table(val_file)
+    if num_samples:
+        df = df.head(num_samples)
+    retriever = None
+    if retrieval_top_k:
+        from tool_retrieval import ToolRetriever
+        retriever = ToolRetriever(generator.TOOLS)
+    full_catalog = "\n".join(
+        json.dumps(info["definition"], ensure_ascii=False, indent=2) for info in generator.TOOLS.values()
+    )
+
+    if "chain" not in df.columns:
+        print("⚠️ 数据里没有 chain 列 (旧版 1.generate_data.py 生成)，以 get_current_date 开头的链无法给最终调用打分，不计入成功率")
+
+    conversations = []
+    for _, row in df.iterrows():
+        label = evaluator.extract_json_output(row["label"].split("：", 1)[-1])
+        if "chain" in df.columns:
+            expected_chain = json.loads(row["chain"])
+        elif label and label.get("tool_name") != "get_current_date":
+            expected_chain = [label]
+        else:
+            expected_chain = None
+        question = extract_user_question(row["text"])
+        if retriever is not None:
+            prompt = retriever.build_prompt(generator.BASE_PROMPT, question, retrieval_top_k)
+        else:
+            prompt = generator.BASE_PROMPT.format(tool_definition=full_catalog, user_question=question)
+        conversations.append(Conversation(question, prompt, label.get("tool_name") if label else None, expected_chain))
+    return conversations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run multi-turn tool chains against local mock tools.")
+    parser.add_argument("--model_path", type=str, default=MERGED_MODEL_PATH, help="Model to roll out.")
+    parser.add_argument("--num_samples", type=int, default=None, help="Number of test.parquet rows. Defaults to all.")
+    parser.add_argument("--batch_size", type=int, default=16, help="Conversations generated together in each turn.")
+    parser.add_argument("--max_turns", type=int, default=DEFAULT_MAX_TURNS, help="Model calls allowed per task.")
+    parser.add_argument("--max_new_tokens", type=int, default=150, help="Tokens generated per model call.")
+    parser.add_argument("--retrieval_top_k", type=int, default=None, help="Render only the retriever's top-k tools instead of the whole catalog.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    print("Loading tokenizer and model...")
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_path,
+        trust_remote_code=True,
+        torch_dtype=torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+    ).to(device).eval()
+
+    conversations = load_conversations(PROMPT_VAL_FILE, args.num_samples, args.retrieval_top_k)
+    run_rollouts(model, tokenizer, conversations, args.batch_size, args.max_turns, args.max_new_tokens)
+
+    summary = summarize(conversations)
+    print("\n--- Rollout Summary ---")
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+    with open(DETAILED_RESULTS_FILE, "w", encoding="utf-8") as f:
+        for conversation in conversations:
+            f.write(json.dumps(conversation.to_dict(), ensure_ascii=False) + "\n")
+    print(f"\n✅ Summary saved to {RESULTS_FILE}")
+    print(f"✅ Per-task rollouts saved to {DETAILED_RESULTS_FILE}")
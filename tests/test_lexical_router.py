@@ -0,0 +1,51 @@
+import os
+import sys
+import json
+import random
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import load_script, extract_user_question
+from lexical_router import LexicalRouter
+
+TOOLS = load_script("1.generate_data.py").TOOLS
+MAX_COMBINATIONS_PER_TEMPLATE = 50
+
+
+def _questions(tool_info):
+    """Every question template filled with (up to MAX_COMBINATIONS_PER_TEMPLATE) argument sample combinations."""
+    samples = tool_info.get("arguments_samples", {})
+    names = list(samples)
+    for template in tool_info.get("question_templates", []):
+        for values in itertools.islice(itertools.product(*(samples[name] for name in names)), MAX_COMBINATIONS_PER_TEMPLATE):
+            yield template.format(**{name: "" if value is None else value for name, value in zip(names, values)})
+
+
+def test_templates_route_only_to_their_own_argument_free_tool():
+    router = LexicalRouter(TOOLS)
+    for tool_name, tool_info in TOOLS.items():
+        takes_arguments = bool(tool_info["definition"].get("arguments"))
+        for question in _questions(tool_info):
+            routed = router.route(question)
+            if takes_arguments:
+                assert routed is None, (tool_name, question, routed)
+            else:
+                # 无参数工具的模板原文一定精确命中
+                assert routed == {"tool_name": tool_name, "arguments": {}}, (tool_name, question, routed)
+
+
+def test_routes_on_generated_data_match_the_label():
+    router = LexicalRouter(TOOLS)
+    random.seed(0)
+    rows = load_script("1.generate_data.py").generate_data(1000)
+    routed = 0
+    for row in rows:
+        label = json.loads(row["label"].split("：", 1)[1])
+        predicted = router.route(extract_user_question(row["text"]))
+        if predicted is not None:
+            routed += 1
+            assert predicted == label, (row["text"], predicted)
+            assert not TOOLS[label["tool_name"]]["definition"].get("arguments")
+    # 覆盖率明显下降说明归一化或模板匹配出了问题
+    assert routed / len(rows) >= 0.6
@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+
+import torch
+from safetensors.torch import save_file
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_bundle import export_bundle, publish_bundle, load_manifest, LocalDirTarget
+
+SHARD_SIZE = 1024 ** 2
+
+
+def _tensors():
+    generator = torch.Generator().manual_seed(0)
+    return {
+        "model.embed_tokens.weight": torch.randn(16, 8, generator=generator),
+        "model.layers.0.self_attn.q_proj.weight": torch.randn(8, 8, generator=generator),
+        "model.layers.1.self_attn.q_proj.weight": torch.randn(8, 8, generator=generator),
+        "model.layers.0.mlp.up_proj.weight": torch.randn(16, 8, generator=generator),
+        "model.layers.1.mlp.up_proj.weight": torch.randn(16, 8, generator=generator),
+        "model.norm.weight": torch.ones(8),
+    }
+
+
+def _write_model(model_dir, tensors):
+    os.makedirs(model_dir, exist_ok=True)
+    save_file(tensors, os.path.join(model_dir, "model.safetensors"), metadata={"format": "pt"})
+    with open(os.path.join(model_dir, "config.json"), "w", encoding="utf-8") as f:
+        json.dump({"model_type": "tiny"}, f)
+
+
+def _shard_of(manifest, tensor_name):
+    return next(path for path, entry in manifest["files"].items()
+                if entry["kind"] == "shard" and tensor_name in entry["tensors"])
+
+
+def test_republish_uploads_only_the_changed_shard(tmp_path):
+    model_dir, bundle_dir = str(tmp_path / "model"), str(tmp_path / "bundle")
+    target = LocalDirTarget(str(tmp_path / "target"))
+    tensors = _tensors()
+    _write_model(model_dir, tensors)
+    export_bundle(model_dir, bundle_dir, SHARD_SIZE)
+    first = publish_bundle(bundle_dir, target)
+    assert first["files_uploaded"] == first["files_total"]
+
+    changed = "model.layers.0.self_attn.q_proj.weight"
+    old_shard = _shard_of(load_manifest(bundle_dir), changed)
+    tensors[changed] = tensors[changed] + 1
+    _write_model(model_dir, tensors)
+    manifest = export_bundle(model_dir, bundle_dir, SHARD_SIZE)
+    new_shard = _shard_of(manifest, changed)
+    second = publish_bundle(bundle_dir, target)
+
+    assert new_shard != old_shard
+    # 只有改动的分片和引用它的 index 需要重新上传
+    assert sorted(second["uploaded"]) == sorted([new_shard, "model.safetensors.index.json"])
+    assert second["deleted"] == [old_shard]
+    assert not os.path.exists(os.path.join(target.path, old_shard))
+    assert sorted(target.list_files()) == sorted([*manifest["files"], "bundle_manifest.json"])
+
+    assert publish_bundle(bundle_dir, target)["files_uploaded"] == 0
+
+
+def test_target_without_manifest_loses_stale_weights(tmp_path):
+    model_dir, bundle_dir = str(tmp_path / "model"), str(tmp_path / "bundle")
+    target = LocalDirTarget(str(tmp_path / "target"))
+    _write_model(model_dir, _tensors())
+    # 旧版 upload_folder 上传的仓库：没有 manifest，只有单文件权重
+    _write_model(target.path, _tensors())
+    export_bundle(model_dir, bundle_dir, SHARD_SIZE)
+
+    report = publish_bundle(bundle_dir, target)
+    assert report["deleted"] == ["model.safetensors"]
+    assert not os.path.exists(os.path.join(target.path, "model.safetensors"))
+    assert os.path.exists(os.path.join(target.path, "config.json"))
+    assert os.path.exists(os.path.join(target.path, "model.safetensors.index.json"))
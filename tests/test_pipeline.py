@@ -0,0 +1,92 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pipeline
+from pipeline import Stage
+
+# 每个脚本把自己的名字追加到 runs.log，再把输入转成大写写到输出
+SCRIPT = '''import sys
+with open("runs.log", "a") as f:
+    f.write("{name}\\n")
+with open("{source}") as f:
+    text = f.read()
+with open("{target}", "w") as f:
+    f.write(text.upper() + " ".join(sys.argv[1:]))
+'''
+
+
+def _write(path, text):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def _runs(tmp_path):
+    path = tmp_path / "runs.log"
+    runs = path.read_text().split() if path.exists() else []
+    path.unlink(missing_ok=True)
+    return runs
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    """Two chained stages in a scratch project: prepare (raw.txt -> prepared.txt) -> build (-> built.txt)."""
+    _write(tmp_path / "prepare.py", SCRIPT.format(name="prepare", source="raw.txt", target="prepared.txt"))
+    _write(tmp_path / "build.py", SCRIPT.format(name="build", source="prepared.txt", target="built.txt"))
+    _write(tmp_path / "helper.py", "VALUE = 1\n")
+    _write(tmp_path / "raw.txt", "hello")
+    stages = [
+        Stage("prepare", "prepare.py", ["raw.txt"], ["prepared.txt"], code=["helper.py"]),
+        Stage("build", "build.py", ["prepared.txt"], ["built.txt"], deps=["prepare"]),
+    ]
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(pipeline, "project_root", str(tmp_path))
+    monkeypatch.setattr(pipeline, "STAGES", stages)
+    monkeypatch.setattr(pipeline, "STAGES_BY_NAME", {stage.name: stage for stage in stages})
+    monkeypatch.setattr(pipeline, "STATE_FILE", str(tmp_path / "state.json"))
+    monkeypatch.setattr(pipeline, "LOG_DIR", str(tmp_path / "logs"))
+
+    assert pipeline.run_pipeline() == {"prepare": "done", "build": "done"}
+    assert _runs(tmp_path) == ["prepare", "build"]
+    return tmp_path
+
+
+def test_unchanged_pipeline_is_skipped(project):
+    assert pipeline.run_pipeline() == {"prepare": "skipped", "build": "skipped"}
+    assert _runs(project) == []
+
+
+def test_changed_input_reruns_stage_and_downstream(project):
+    _write(project / "raw.txt", "changed")
+    assert pipeline.run_pipeline() == {"prepare": "done", "build": "done"}
+    assert _runs(project) == ["prepare", "build"]
+
+
+def test_changed_declared_code_reruns_stage(project):
+    _write(project / "helper.py", "VALUE = 2\n")
+    # prepare 的输出内容没变，build 的输入哈希不变，不需要重跑
+    assert pipeline.run_pipeline() == {"prepare": "done", "build": "skipped"}
+    assert _runs(project) == ["prepare"]
+
+
+def test_changed_args_rerun_stage(project):
+    pipeline.STAGES_BY_NAME["build"].args = ["--flag"]
+    assert pipeline.run_pipeline() == {"prepare": "skipped", "build": "done"}
+    assert _runs(project) == ["build"]
+
+
+def test_modified_output_reruns_stage(project):
+    _write(project / "built.txt", "edited by hand")
+    assert pipeline.run_pipeline() == {"prepare": "skipped", "build": "done"}
+
+
+def test_failed_upstream_blocks_downstream(project):
+    _write(project / "prepare.py", "import sys\nsys.exit(1)\n")
+    assert pipeline.run_pipeline() == {"prepare": "failed", "build": "blocked"}
+    assert _runs(project) == []
+    # 失败的阶段不记录 fingerprint，恢复后重新运行
+    _write(project / "prepare.py", SCRIPT.format(name="prepare", source="raw.txt", target="prepared.txt"))
+    assert pipeline.run_pipeline()["prepare"] == "done"
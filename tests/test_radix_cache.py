@@ -0,0 +1,69 @@
+import os
+import sys
+
+import torch
+from transformers import DynamicCache
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from radix_cache import RadixKVCache
+
+
+def _cache(length, num_layers=2):
+    cache = DynamicCache()
+    for layer_idx in range(num_layers):
+        cache.update(torch.randn(1, 1, length, 4), torch.randn(1, 1, length, 4), layer_idx)
+    return cache
+
+
+def _serve(radix_cache, token_ids):
+    path, _ = radix_cache.match(token_ids)
+    radix_cache.acquire(path)
+    radix_cache.insert(token_ids, _cache(len(token_ids)))
+    radix_cache.release(path)
+
+
+def _nodes(radix_cache):
+    stack, nodes = list(radix_cache.root.children.values()), []
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.children.values())
+    return nodes
+
+
+def test_split_then_release_leaves_no_references():
+    radix_cache = RadixKVCache()
+    radix_cache.insert([1, 2, 3, 4, 5, 6], _cache(6))
+    _serve(radix_cache, [1, 2, 3, 9, 9])
+
+    upper = radix_cache.root.children[1]
+    assert upper.token_ids == (1, 2, 3)
+    assert all(node.ref_count == 0 for node in _nodes(radix_cache))
+
+
+def test_split_nodes_are_evictable_after_release():
+    radix_cache = RadixKVCache()
+    radix_cache.insert([1, 2, 3, 4, 5, 6], _cache(6))
+    _serve(radix_cache, [1, 2, 3, 9, 9])
+
+    radix_cache.max_bytes = 0
+    radix_cache._evict()
+    assert radix_cache.root.children == {}
+    assert radix_cache.total_bytes == 0
+
+
+def test_held_path_survives_eviction():
+    radix_cache = RadixKVCache()
+    radix_cache.insert([1, 2, 3, 4, 5, 6], _cache(6))
+    path, depth = radix_cache.match([1, 2, 3, 4, 5, 6])
+    radix_cache.acquire(path)
+    radix_cache.insert([1, 2, 3, 9, 9], _cache(5))
+
+    radix_cache.max_bytes = 0
+    radix_cache._evict()
+    # 持有的 [4, 5, 6] 和它的父节点 [1, 2, 3] 都不能被淘汰
+    assert radix_cache.match([1, 2, 3, 4, 5, 6])[1] == 6
+    radix_cache.release(path)
+    radix_cache._evict()
+    assert radix_cache.root.children == {}
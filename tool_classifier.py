@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+两阶段路由：轻量工具分类器 + 模型填参数。
+
+tool_name 的准确率已经接近 100%，但每次都要完整解码一遍才能拿到它。第一阶段用 train.parquet 训练一个
+字符 n-gram TF-IDF + LogisticRegression 分类器 (scikit-learn)，亚毫秒级给出 tool_name 和置信度:
+- 置信度 >= 阈值且工具没有参数：直接输出 `{"tool_name": ..., "arguments": {}}`，不调用模型
+- 置信度 >= 阈值且工具有参数：把 `output：{"tool_name": "X", "arguments": ` 作为前缀强制写进 prompt，
+  模型只生成 arguments 对象
+- 置信度不足：退回完整的模型解码
+
+标签不只取决于问题，还取决于 prompt 里渲染了哪些工具 (同一句 "查一下明天的日程"，渲染的是 get_current_date
+时标签是 get_current_date，渲染的是 get_calendar_events 时才是它)。所以分类器的输入是问题加上渲染出的工具名，
+每个工具名映射成一个私用区 Unicode 字符，字符 n-gram 能直接把它当作特征，问题文本里不会出现这些字符。
+强制前缀取自完整标签的分词结果，在 arguments 值之前截断，保证和训练时的 token 切分一致。
+
+用法:
+    python tool_classifier.py --train                    # 训练并保存到 ./checkpoints/tool_classifier.joblib
+    python tool_classifier.py --num_samples 100 --compare_full_lm
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+import joblib
+import numpy as np
+import torch
+from tqdm import tqdm
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from data_io import read_table
+from utils import load_script, extract_user_question, extract_rendered_tool_names
+
+MERGED_MODEL_PATH = "./models/merged_gemma_lora"
+PROMPT_TRAIN_FILE = "./data/train.parquet"
+PROMPT_VAL_FILE = "./data/test.parquet"
+CLASSIFIER_PATH = "./checkpoints/tool_classifier.joblib"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "two_stage_evaluation_results.json")
+DEFAULT_THRESHOLD = 0.9
+LABEL_PREFIX = "output："
+TOOL_FEATURE_CODEPOINT = 0xE000
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+generator = load_script("1.generate_data.py")
+evaluator = load_script("3.run_evaluation.py")
+
+
+def classifier_input(prompt):
+    """The user question followed by one private-use character per rendered tool."""
+    tool_ids = {name: index for index, name in enumerate(sorted(generator.TOOLS))}
+    markers = [chr(TOOL_FEATURE_CODEPOINT + tool_ids[name]) for name in extract_rendered_tool_names(prompt) if name in tool_ids]
+    return " ".join([extract_user_question(prompt)] + markers)
+
+
+def load_labelled_questions(data_file):
+    """(classifier inputs, tool_names) from a text/label data file; rows with unparsable labels are skipped."""
+    df = read_table(data_file, columns=["text", "label"])
+    questions, tool_names = [], []
+    for _, row in df.iterrows():
+        try:
+            tool_names.append(json.loads(row["label"].split("：", 1)[1])["tool_name"])
+        except (json.JSONDecodeError, IndexError, KeyError):
+            continue
+        questions.append(classifier_input(row["text"]))
+    return questions, tool_names
+
+
+def train_classifier(train_file):
+    questions, tool_names = load_labelled_questions(train_file)
+    classifier = make_pipeline(
+        TfidfVectorizer(analyzer="char_wb", ngram_range=(1, 3), sublinear_tf=True),
+        LogisticRegression(C=10.0, max_iter=2000),
+    )
+    classifier.fit(questions, tool_names)
+    return classifier
+
+
+def predict_tool(classifier, question):
+    """(tool_name, confidence) for one classifier_input() string."""
+    # 直接算 softmax(Wx + b)，跳过 predict_proba 的输入校验，单条预测从 ~1ms 降到 ~0.3ms
+    vectorizer, linear = classifier[0], classifier[-1]
+    logits = (vectorizer.transform([question]) @ linear.coef_.T).ravel() + linear.intercept_
+    probabilities = np.exp(logits - logits.max())
+    probabilities /= probabilities.sum()
+    best = int(np.argmax(probabilities))
+    return linear.classes_[best], float(probabilities[best])
+
+
+class TwoStageRouter:
+    """Classifier picks the tool; the model only fills in the arguments."""
+
+    def __init__(self, classifier, model, tokenizer, threshold=DEFAULT_THRESHOLD, max_new_tokens=150):
+        self.classifier = classifier
+        self.model = model
+        self.tokenizer = tokenizer
+        self.threshold = threshold
+        self.max_new_tokens = max_new_tokens
+
+    @torch.no_grad()
+    def _generate(self, prompt_ids):
+        input_ids = torch.tensor([prompt_ids], device=self.model.device)
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=self.max_new_tokens,
+            pad_token_id=self.tokenizer.eos_token_id,
+            do_sample=False,
+            top_p=None,
+            top_k=None
+        )
+        return self.tokenizer.decode(outputs[0][input_ids.shape[1]:], skip_special_tokens=True)
+
+    def _forced_prefix(self, tool_name):
+        """
+        Text and token ids of the label up to (not including) the arguments value. Tokenizing the
+        prefix on its own would end in a lone ' ' token where training saw e.g. ' {'; instead the full
+        rendered label is tokenized and cut at the last token boundary before the value.
+        """
+        label = LABEL_PREFIX + json.dumps({"tool_name": tool_name, "arguments": {}}, ensure_ascii=False)
+        boundary = label.rindex('"arguments":') + len('"arguments":')
+        encoded = self.tokenizer(label, add_special_tokens=False, return_offsets_mapping=True)
+        keep = 0
+        while keep < len(encoded["input_ids"]) and encoded["offset_mapping"][keep][1] <= boundary:
+            keep += 1
+        end = encoded["offset_mapping"][keep - 1][1] if keep else 0
+        return label[:end], encoded["input_ids"][:keep]
+
+    def route(self, prompt):
+        """Returns (generated_text, stage, tool_confidence)."""
+        tool_name, confidence = predict_tool(self.classifier, classifier_input(prompt))
+        if confidence < self.threshold or tool_name not in generator.TOOLS:
+            prompt_ids = self.tokenizer(prompt, max_length=2048, truncation=True)["input_ids"]
+            return self._generate(prompt_ids), "full_lm", confidence
+
+        if not generator.TOOLS[tool_name]["definition"].get("arguments"):
+            return LABEL_PREFIX + json.dumps({"tool_name": tool_name, "arguments": {}}, ensure_ascii=False), "classifier", confidence
+
+        # 与训练时一样，prompt 和答案分开分词后拼接
+        prompt_ids = self.tokenizer(prompt, add_special_tokens=False)["input_ids"]
+        forced_prefix, prefix_ids = self._forced_prefix(tool_name)
+        return forced_prefix + self._generate(prompt_ids + prefix_ids), "classifier+lm", confidence
+
+
+def evaluate_two_stage(router, val_file, num_samples=None, compare_full_lm=False):
+    """Accuracy and latency of the two-stage router, optionally next to plain full decoding."""
+    df = read_table(val_file, columns=["text", "label"])
+    if num_samples:
+        df = df.head(num_samples)
+
+    stats = Counter()
+    latencies, classifier_latencies, full_lm_latencies = [], [], []
+    for _, row in tqdm(df.iterrows(), total=df.shape[0], desc="Evaluating two-stage router"):
+        try:
+            true_json = json.loads(row["label"].split("：", 1)[1])
+        except (json.JSONDecodeError, IndexError):
+            continue
+        prompt = row["text"]
+
+        start = time.perf_counter()
+        predict_tool(router.classifier, classifier_input(prompt))
+        classifier_latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        generated_text, stage, _ = router.route(prompt)
+        latencies.append(time.perf_counter() - start)
+
+        predicted_json = evaluator.extract_json_output(generated_text)
+        stats["total"] += 1
+        stats[stage] += 1
+        if predicted_json:
+            stats["exact_match"] += predicted_json == true_json
+            stats["tool_name_match"] += predicted_json.get("tool_name") == true_json.get("tool_name")
+            stats["arg_f1"] += evaluator.calculate_argument_f1(predicted_json.get("arguments", {}), true_json.get("arguments", {}))[2]
+
+        if compare_full_lm:
+            start = time.perf_counter()
+            full_text = router._generate(router.tokenizer(prompt, max_length=2048, truncation=True)["input_ids"])
+            full_lm_latencies.append(time.perf_counter() - start)
+            full_json = evaluator.extract_json_output(full_text)
+            stats["full_lm_exact_match"] += bool(full_json) and full_json == true_json
+
+    total = stats["total"] or 1
+    summary = {
+        "total_samples": stats["total"],
+        "threshold": router.threshold,
+        "exact_match_rate": stats["exact_match"] / total,
+        "tool_name_accuracy": stats["tool_name_match"] / total,
+        "average_argument_f1": stats["arg_f1"] / total,
+        "stage_counts": {stage: stats[stage] for stage in ("classifier", "classifier+lm", "full_lm")},
+        "average_latency_ms": float(np.mean(latencies or [0]) * 1000),
+        "average_classifier_latency_us": float(np.mean(classifier_latencies or [0]) * 1e6),
+    }
+    if compare_full_lm:
+        full_lm_ms = float(np.mean(full_lm_latencies or [0]) * 1000)
+        summary["full_lm"] = {
+            "exact_match_rate": stats["full_lm_exact_match"] / total,
+            "average_latency_ms": full_lm_ms,
+        }
+        summary["latency_speedup"] = full_lm_ms / summary["average_latency_ms"] if summary["average_latency_ms"] > 0 else 0
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or evaluate the two-stage (classifier + LM arguments) router.")
+    parser.add_argument("--train", action="store_true", help="Train the classifier on train.parquet and save it.")
+    parser.add_argument("--classifier_path", type=str, default=CLASSIFIER_PATH, help="Where the classifier is saved / loaded.")
+    parser.add_argument("--model_path", type=str, default=MERGED_MODEL_PATH, help="Model that fills in the arguments.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Classifier confidence below which the full LM decodes instead.")
+    parser.add_argument("--num_samples", type=int, default=None, help="Number of test.parquet rows. Defaults to all.")
+    parser.add_argument("--compare_full_lm", action="store_true", help="Also time plain full decoding on every row.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+
+    if args.train:
+        print(f"Training tool classifier on {PROMPT_TRAIN_FILE}...")
+        classifier = train_classifier(PROMPT_TRAIN_FILE)
+        os.makedirs(os.path.dirname(args.classifier_path), exist_ok=True)
+        joblib.dump(classifier, args.classifier_path)
+        questions, tool_names = load_labelled_questions(PROMPT_VAL_FILE)
+        predictions = classifier.predict(questions)
+        confidences = classifier.predict_proba(questions).max(axis=1)
+        confident = confidences >= args.threshold
+        print(f"  test.parquet accuracy: {np.mean(predictions == np.array(tool_names)):.4f}")
+        print(f"  confident (>= {args.threshold}): {confident.mean():.4f}, accuracy on those: "
+              f"{np.mean(predictions[confident] == np.array(tool_names)[confident]) if confident.any() else 0:.4f}")
+        print(f"✅ Classifier saved to {args.classifier_path}")
+    else:
+        classifier = joblib.load(args.classifier_path)
+        print("Loading tokenizer and model...")
+        tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_path,
+            trust_remote_code=True,
+            torch_dtype=torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float32
+        ).to(device).eval()
+
+        router = TwoStageRouter(classifier, model, tokenizer, threshold=args.threshold)
+        summary = evaluate_two_stage(router, PROMPT_VAL_FILE, args.num_samples, args.compare_full_lm)
+
+        print("\n--- Two-Stage Router Summary ---")
+        print(json.dumps(summary, indent=2))
+        with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"\n✅ Summary saved to {RESULTS_FILE}")
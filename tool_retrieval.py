@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+工具检索索引。
+
+生产环境要暴露整个工具目录，如果把所有工具定义都渲染进 `{tool_definition}`，prompt 长度和
+prefill 开销会随工具数量线性增长。这里用字符 n-gram TF-IDF (scikit-learn，本地、无网络)
+对 TOOLS 的定义和 question_templates 建索引，每个问题只渲染 top-k 个候选工具。
+工具描述里声明的前置工具 (例如 get_current_date) 会随候选一起渲染。
+
+1.generate_data.py --retrieval_top_k 使用同一个检索器生成训练数据，保证训练和推理一致。
+
+用法 (在 test.parquet 上统计 recall@k):
+    python tool_retrieval.py --target_recall 1.0
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+# --- 路径配置 ---
+project_root = os.path.dirname(os.path.abspath(__file__))
+if project_root not in sys.path:
+    sys.path.append(project_root)
+
+from data_io import read_table
+from utils import load_script, extract_user_question
+
+PROMPT_VAL_FILE = "./data/test.parquet"
+RESULTS_DIR = "./results/"
+RESULTS_FILE = os.path.join(RESULTS_DIR, "tool_retrieval_recall.json")
+DEFAULT_NGRAM_RANGE = (1, 3)
+
+
+class ToolRetriever:
+    """Character n-gram TF-IDF index over tool definitions and question templates."""
+
+    def __init__(self, tools, ngram_range=DEFAULT_NGRAM_RANGE):
+        self.tools = tools
+        self.tool_names = list(tools)
+        self.vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=ngram_range, sublinear_tf=True)
+        self.matrix = self.vectorizer.fit_transform([self._tool_document(info) for info in tools.values()])
+        # 描述里提到的其他工具视为前置条件，例如日程工具依赖 get_current_date
+        self.prerequisites = {
+            name: [other for other in tools if other != name and other in info["definition"]["tool_description"]]
+            for name, info in tools.items()
+        }
+
+    @staticmethod
+    def _tool_document(tool_info):
+        definition = tool_info["definition"]
+        parts = [definition["tool_name"].replace("_", " "), definition["tool_description"]]
+        for arg_name, arg_info in definition.get("arguments", {}).get("properties", {}).items():
+            parts.append(f"{arg_name} {arg_info.get('description', '')}")
+        for template in tool_info.get("question_templates", []):
+            parts.append(re.sub(r"\{\w+\}", " ", template))
+        for samples in tool_info.get("arguments_samples", {}).values():
+            parts.extend(str(sample) for sample in samples)
+        return "\n".join(parts)
+
+    def scores(self, query):
+        # TF-IDF 行向量已做 L2 归一化，点积就是余弦相似度
+        return (self.matrix @ self.vectorizer.transform([query]).T).toarray().ravel()
+
+    def top_k(self, query, k, with_prerequisites=True):
+        """The k best-matching tool names, followed by any prerequisites they declare."""
+        ranked = np.argsort(-self.scores(query), kind="stable")[:k]
+        names = [self.tool_names[i] for i in ranked]
+        return self.with_prerequisites(names) if with_prerequisites else names
+
+    def with_prerequisites(self, tool_names):
+        """`tool_names` followed by the prerequisites they declare that are not already listed."""
+        names = list(tool_names)
+        for name in tool_names:
+            names.extend(p for p in self.prerequisites[name] if p not in names)
+        return names
+
+    def render(self, tool_names):
+        """Tool definitions in the same format generate_data puts into `{tool_definition}`."""
+        return "\n".join(
+            json.dumps(self.tools[name]["definition"], ensure_ascii=False, indent=2) for name in tool_names
+        )
+
+    def build_prompt(self, base_prompt, user_question, k):
+        return base_prompt.format(
+            tool_definition=self.render(self.top_k(user_question, k)),
+            user_question=user_question,
+        )
+
+
+def recall_at_k(retriever, val_file, with_prerequisites=True):
+    """recall@k for every k: the fraction of test.parquet rows whose labelled tool is among the rendered tools."""
+    df = read_table(val_file, columns=["text", "label"])
+    questions, label_tools = [], []
+    for _, row in df.iterrows():
+        try:
+            label_tools.append(json.loads(row["label"].split("：", 1)[1])["tool_name"])
+        except (json.JSONDecodeError, IndexError, KeyError):
+            continue
+        questions.append(extract_user_question(row["text"]))
+
+    recalls = {}
+    for k in range(1, len(retriever.tool_names) + 1):
+        hits = sum(
+            label in retriever.top_k(question, k, with_prerequisites)
+            for question, label in zip(questions, label_tools)
+        )
+        recalls[k] = hits / len(questions) if questions else 0
+    return recalls, len(questions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report recall@k of the tool retrieval index on test.parquet.")
+    parser.add_argument("--val_file", type=str, default=PROMPT_VAL_FILE, help="Parquet or CSV file with text/label columns.")
+    parser.add_argument("--target_recall", type=float, default=1.0, help="Recall the recommended k must reach.")
+    parser.add_argument("--no_prerequisites", action="store_true", help="Do not add prerequisite tools to the candidates.")
+    args = parser.parse_args()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    generator = load_script("1.generate_data.py")
+    retriever = ToolRetriever(generator.TOOLS)
+    recalls, total = recall_at_k(retriever, args.val_file, with_prerequisites=not args.no_prerequisites)
+
+    print(f"--- Tool retrieval recall@k ({total} samples) ---")
+    for k, recall in recalls.items():
+        print(f"  k={k:>2}: {recall:.4f}")
+    recommended_k = next((k for k, recall in recalls.items() if recall >= args.target_recall), None)
+    if recommended_k is None:
+        print(f"⚠️ 没有任何 k 能达到 recall {args.target_recall}")
+    else:
+        print(f"✅ 达到 recall {args.target_recall} 的最小 k = {recommended_k}")
+
+    with open(RESULTS_FILE, "w", encoding="utf-8") as f:
+        json.dump({
+            "total_samples": total,
+            "with_prerequisites": not args.no_prerequisites,
+            "recall_at_k": recalls,
+            "target_recall": args.target_recall,
+            "recommended_k": recommended_k,
+        }, f, indent=2)
+    print(f"✅ Recall report saved to {RESULTS_FILE}")
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import importlib.util
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+
+# BASE_PROMPT 末尾的用户问题: prompt:<|im_start|>user\n"{user_question}"\n<|im_end|>
+USER_QUESTION_PATTERN = re.compile(r'<\|im_start\|>user\n"(.*)"\n<\|im_end\|>', re.DOTALL)
+# BASE_PROMPT 里工具定义块前后的固定文本，块内每个定义都有 "tool_name": "..."
+TOOL_BLOCK_START = "可用的工具列表如下:\n"
+TOOL_BLOCK_END = "\n\n---\nprompt:"
+TOOL_NAME_PATTERN = re.compile(r'"tool_name":\s*"([^"]+)"')
+
+# 所有评估 (3/5、训练中的生成评估、sweep) 共用的生成长度上限。
+# create_calendar_event_api 的标签约 154 个字符，Gemma 把日期时间的每个数字切成单独的 token，上限太小会截断输出
+EVAL_MAX_NEW_TOKENS = 150
+
+
+def load_script(file_name):
+    """
+    Imports one of the numbered pipeline scripts (e.g. "1.generate_data.py") as a module.
+    Their file names are not valid module names, so a plain `import` does not work.
+    """
+    module_name = "_script_" + os.path.splitext(file_name)[0].replace(".", "_")
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(project_root, file_name))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def extract_user_question(prompt):
+    """Returns the user question rendered into a BASE_PROMPT prompt, or the prompt itself if not found."""
+    match = USER_QUESTION_PATTERN.search(prompt)
+    return match.group(1) if match else prompt
+
+
+def extract_rendered_tool_names(prompt):
+    """Names of the tools rendered into a BASE_PROMPT prompt's tool block (the few-shot examples are skipped)."""
+    start = prompt.find(TOOL_BLOCK_START)
+    if start < 0:
+        return []
+    start += len(TOOL_BLOCK_START)
+    end = prompt.find(TOOL_BLOCK_END, start)
+    return TOOL_NAME_PATTERN.findall(prompt[start:end if end >= 0 else len(prompt)])
+
+
+def parse_size(size):
+    """"2GB" / "500MB" / 1048576 -> bytes."""
+    if isinstance(size, int):
+        return size
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?B)?\s*", size.upper())
+    if not match:
+        raise ValueError(f"无法解析大小: {size}")
+    units = {None: 1, "B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+    return int(float(match.group(1)) * units[match.group(2)])